@@ -0,0 +1,62 @@
+import math
+import os
+
+import psycopg as pg
+
+import query_cache
+import sqlite_backend
+
+# approximate answers for dashboards: rows are read from a random sample of
+# the table (TABLESAMPLE SYSTEM, whole pages, so the scan shrinks with the
+# sample) and every estimate comes with a 95% error bound. There are no
+# approximate top-N lists, get_top_n_books and get_top_n_authors read n rows
+# of an index on their summary tables, exact and faster than any sample.
+DEFAULT_PERCENT = float(os.environ.get('BOOKS_APPROX_PERCENT', 5))
+Z95 = 1.96
+
+
+def _sample(conn: pg.Connection, table: str, percent: float) -> str:
+    """
+    FROM clause item for a percent sample of table, aliased as the table
+    """
+    if sqlite_backend.is_sqlite(conn):
+        # no TABLESAMPLE, filter rows instead (still a full scan)
+        return f"(SELECT * FROM {table} WHERE abs(random()) % 1000000 < {int(percent * 10_000)}) AS {table}"
+    return f"{table} TABLESAMPLE SYSTEM ({float(percent)})"
+
+
+@query_cache.cached('books', 'ratings', normalize=query_cache.match_key)
+def avg_rating_by_author(conn: pg.Connection, name: str,
+                         percent: float = DEFAULT_PERCENT) -> list[tuple[float, int, float]] | None:
+    """
+    approximate Ratings.get_avg_rating_by_author, the number of books is exact
+    :return: [(estimated average rating, number of books, +/- bound)] or None
+    """
+    key = query_cache.match_key(name)
+    cmd = f"""
+        SELECT count(*), avg(book_rating), avg(book_rating * book_rating)
+        FROM {_sample(conn, 'ratings', percent)} JOIN books USING (isbn)
+        WHERE author_key = lower(%s)
+        """
+    cur = conn.cursor()
+    try:
+        cur.execute(cmd, (key,))
+        count, mean, square = cur.fetchone()
+        cur.execute("SELECT count(*) FROM books WHERE author_key = lower(%s)", (key,))
+        num_books = cur.fetchone()[0]
+    except pg.Error as e:
+        print(f"Error: {e}")
+        conn.rollback()
+        return None
+    cur.close()
+    conn.rollback()
+
+    if not count:
+        # too rare for the sample, the exact query is cheap for such authors
+        from ratings import Ratings
+        exact = Ratings.get_avg_rating_by_author(conn, name)
+        return [(avg, books, 0.0) for avg, books in exact] if exact else None
+
+    mean, square = float(mean), float(square)
+    variance = max(square - mean * mean, 0.0) * count / max(count - 1, 1)
+    return [(round(mean, 1), num_books, round(Z95 * math.sqrt(variance / count), 2))]
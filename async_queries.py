@@ -0,0 +1,151 @@
+import asyncio
+import sys
+
+import psycopg as pg
+from psycopg_pool import AsyncConnectionPool
+
+import connect_books as cb
+from books import Books
+from ratings import Ratings
+
+
+class AsyncQueryEngine:
+    """
+    async versions of the Books/Ratings queries over a psycopg_pool
+    AsyncConnectionPool
+
+    at most concurrency queries run at once, each on its own connection, and
+    every call is cancelled after timeout seconds. Pooled connections are
+    checked before they are handed out and recycled after
+    BOOKS_POOL_MAX_LIFETIME / BOOKS_POOL_MAX_IDLE seconds, like the sync pool.
+    Use fan_out to run many independent lookups concurrently:
+
+        async with AsyncQueryEngine(concurrency=20) as engine:
+            ratings = await engine.fan_out(engine.get_avg_rating_by_author, authors)
+    """
+
+    def __init__(self, info: str = None, concurrency: int = 10, timeout: float = 10.0):
+        self.info = info
+        self.concurrency = max(concurrency, 1)
+        self.timeout = timeout
+        self._sem = None
+        self._pool = None
+
+    async def open(self) -> None:
+        conf = cb.settings()
+        if self.info is None:
+            self.info = cb.conninfo(conf)
+        self._sem = asyncio.Semaphore(self.concurrency)
+        self._pool = AsyncConnectionPool(self.info,
+                                         min_size=min(conf['min_size'], self.concurrency),
+                                         max_size=self.concurrency,
+                                         max_idle=conf['max_idle'],
+                                         max_lifetime=conf['max_lifetime'],
+                                         timeout=conf['timeout'],
+                                         check=AsyncConnectionPool.check_connection,
+                                         open=False)
+        await self._pool.open()
+
+    async def close(self) -> None:
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            await pool.close()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _discard(self, conn: pg.AsyncConnection) -> None:
+        # stop the query on the server without blocking the event loop, the
+        # pool replaces the closed connection
+        try:
+            await conn.cancel_safe(timeout=5)
+        except pg.Error:
+            pass
+        await conn.close()
+
+    async def _fetch(self, cmd: str, params: tuple = (), timeout: float = None) -> list:
+        """
+        run one query on a free connection
+        :return: all rows
+        :raise asyncio.TimeoutError: the query took longer than timeout seconds
+        """
+        timeout = self.timeout if timeout is None else timeout
+        # the semaphore queues calls past concurrency, so they never hit the
+        # pool's own wait timeout
+        async with self._sem:
+            conn = await self._pool.getconn()
+            try:
+                async def run():
+                    cur = await conn.execute(cmd, params)
+                    rows = await cur.fetchall()
+                    await conn.rollback()
+                    return rows
+
+                return await asyncio.wait_for(run(), timeout)
+            except BaseException:
+                # the connection may be mid-query, don't hand it out again
+                await self._discard(conn)
+                raise
+            finally:
+                await self._pool.putconn(conn)
+
+    async def fan_out(self, method, args: list, return_exceptions: bool = True) -> list:
+        """
+        call method once per item of args concurrently, bounded by the
+        engine's concurrency
+        :param method: one of the engine's query methods
+        :param args: one argument (or tuple of arguments) per call
+        :param return_exceptions: put failures (including timeouts) in the
+            result list instead of raising the first one
+        :return: results in the same order as args
+        """
+        calls = [method(*arg) if isinstance(arg, tuple) else method(arg) for arg in args]
+        return await asyncio.gather(*calls, return_exceptions=return_exceptions)
+
+    # queries, same arguments and results as the sync static methods
+
+    async def get_title_by_isbn(self, isbn: str, timeout: float = None) -> str | None:
+        rows = await self._fetch(Books.q_title_by_isbn, (isbn.strip(),), timeout)
+        return rows[0][0] if rows else None
+
+    async def get_books_by_author(self, author: str, timeout: float = None) -> list | None:
+        author = Books.remove_punctuation(author)
+        rows = await self._fetch(Books.q_books_by_author, (author,), timeout)
+        return rows or None
+
+    async def get_top_n_authors(self, n: int, timeout: float = None) -> list | None:
+        rows = await self._fetch(Books.q_top_n_authors, (n,), timeout)
+        return rows or None
+
+    async def get_avg_rating_by_author(self, name: str, timeout: float = None) -> list | None:
+        name = Ratings.remove_punctuation(name)
+        rows = await self._fetch(Ratings.q_avg_rating_by_author, (name, name), timeout)
+        return rows or None
+
+    async def get_books_avg_rating(self, title: str, author: str, timeout: float = None) -> list | None:
+        title = Ratings.remove_punctuation(title)
+        author = Ratings.remove_punctuation(author)
+        rows = await self._fetch(Ratings.q_books_avg_rating, (title, author), timeout)
+        return rows or None
+
+    async def get_avg_rating_from_most_reviews(self, timeout: float = None) -> float | None:
+        rows = await self._fetch(Ratings.q_avg_rating_from_most_reviews, (), timeout)
+        return rows[0][0] if rows else None
+
+    async def get_top_n_books(self, n: int, timeout: float = None) -> list | None:
+        rows = await self._fetch(Ratings.q_top_n_books, (n,), timeout)
+        return rows or None
+
+
+def run(coro):
+    """
+    run a coroutine from sync code, psycopg's async mode needs a selector
+    event loop on windows
+    """
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    return asyncio.run(coro)
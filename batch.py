@@ -0,0 +1,149 @@
+import argparse
+import csv
+import json
+import sys
+import time
+from itertools import islice
+
+import connect_books as cb
+import query_cache
+from books import Books
+from ratings import Ratings
+
+DEFAULT_CHUNK = 5000
+
+
+def read_queries(f):
+    """
+    one query per line, blank lines are skipped
+    """
+    for line in f:
+        line = line.rstrip('\r\n')
+        if line.strip():
+            yield line
+
+
+def chunks(items, size: int):
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# every lookup takes a chunk of queries and returns (query, result row) pairs
+# in input order, result row is None when nothing matched
+
+def lookup_isbns(conn, queries: list[str]):
+    titles = Books.get_titles_by_isbns(conn, queries)
+    for isbn in queries:
+        title = titles.get(isbn.strip())
+        yield isbn, None if title is None else {'title': title}
+
+
+def lookup_authors(conn, queries: list[str]):
+    books = Books.get_books_by_authors(conn, queries)
+    for author in queries:
+        rows = books.get(query_cache.match_key(author))
+        if rows is None:
+            yield author, None
+        for title, year, publisher, isbn in rows or ():
+            yield author, {'title': title, 'year': year, 'publisher': publisher, 'isbn': isbn}
+
+
+def lookup_author_ratings(conn, queries: list[str]):
+    ratings = Ratings.get_avg_ratings_by_authors(conn, queries)
+    for author in queries:
+        rv = ratings.get(query_cache.match_key(author))
+        yield author, None if rv is None else {'avg_rating': rv[0], 'num_books': rv[1]}
+
+
+LOOKUPS = {
+    'isbn': (lookup_isbns, ['title']),
+    'author': (lookup_authors, ['title', 'year', 'publisher', 'isbn']),
+    'author-rating': (lookup_author_ratings, ['avg_rating', 'num_books']),
+}
+
+
+class CsvWriter:
+    def __init__(self, out, fields: list[str]):
+        self.fields = fields
+        self.writer = csv.writer(out)
+        self.writer.writerow(['query', 'found'] + fields)
+
+    def write(self, query: str, row: dict | None):
+        if row is None:
+            self.writer.writerow([query, 'false'] + [''] * len(self.fields))
+        else:
+            self.writer.writerow([query, 'true'] + [row[field] for field in self.fields])
+
+
+class JsonWriter:
+    def __init__(self, out, fields: list[str]):
+        self.out = out
+
+    def write(self, query: str, row: dict | None):
+        rv = {'query': query, 'found': row is not None}
+        rv.update(row or {})
+        self.out.write(json.dumps(rv, default=str) + '\n')
+
+
+def run(kind: str, queries, out, fmt: str = 'csv', chunk_size: int = DEFAULT_CHUNK) -> dict:
+    """
+    resolve every query with one set-based SQL statement per chunk
+    :param kind: isbn, author or author-rating
+    :param queries: iterable of query strings
+    :param out: text file the results are written to
+    :param fmt: csv or json (json lines)
+    :param chunk_size: queries per round trip
+    :return: counters with queries, rows, found and seconds
+    """
+    lookup, fields = LOOKUPS[kind]
+    writer = (JsonWriter if fmt == 'json' else CsvWriter)(out, fields)
+    stats = {'queries': 0, 'found': 0, 'rows': 0, 'round_trips': 0}
+
+    start = time.perf_counter()
+    with cb.connection() as conn:
+        for chunk in chunks(queries, chunk_size):
+            stats['queries'] += len(chunk)
+            stats['round_trips'] += 1
+            found = set()
+            for query, row in lookup(conn, chunk):
+                writer.write(query, row)
+                if row is not None:
+                    stats['rows'] += 1
+                    found.add(query)
+            stats['found'] += len(found)
+    stats['seconds'] = time.perf_counter() - start
+    return stats
+
+
+def main(argv: list[str] = None) -> None:
+    parser = argparse.ArgumentParser(description="resolve many ISBN/author lookups from a file")
+    parser.add_argument('kind', choices=sorted(LOOKUPS))
+    parser.add_argument('input', nargs='?', default='-', help="one query per line, - for stdin")
+    parser.add_argument('-o', '--output', default='-', help="output file, - for stdout")
+    parser.add_argument('-f', '--format', choices=['csv', 'json'], default='csv')
+    parser.add_argument('--chunk', type=int, default=DEFAULT_CHUNK, help="queries per SQL statement")
+    args = parser.parse_args(argv)
+
+    fin = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')
+    fout = sys.stdout if args.output == '-' else open(args.output, 'w', newline='', encoding='utf-8')
+    try:
+        stats = run(args.kind, read_queries(fin), fout, args.format, args.chunk)
+    finally:
+        if fin is not sys.stdin:
+            fin.close()
+        if fout is not sys.stdout:
+            fout.close()
+
+    rate = stats['queries'] / stats['seconds'] if stats['seconds'] else 0
+    # report on stderr so it never mixes with results written to stdout
+    print(f"{stats['queries']} queries ({stats['found']} found, {stats['rows']} rows) "
+          f"in {stats['round_trips']} round trips, {stats['seconds']:.2f}s, {rate:,.0f} queries/sec",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+import argparse
+import csv
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+import connect_books as cb
+import gen_data
+import query_cache
+import summaries
+from books import Books
+from ratings import Ratings
+from users import Users
+
+
+def summarize(samples: list[float]) -> dict:
+    """
+    :param samples: seconds per call
+    :return: milliseconds min/median/mean/p95/max and the sample count
+    """
+    ms = sorted(s * 1000 for s in samples)
+    return {
+        'n': len(ms),
+        'min_ms': round(ms[0], 3),
+        'median_ms': round(statistics.median(ms), 3),
+        'mean_ms': round(statistics.fmean(ms), 3),
+        'p95_ms': round(ms[min(int(len(ms) * 0.95), len(ms) - 1)], 3),
+        'max_ms': round(ms[-1], 3),
+    }
+
+
+def time_calls(func, args: list, warmup: int, repeat: int) -> dict:
+    """
+    time func(*arg) for every arg, warmup untimed passes then repeat timed ones
+    """
+    for _ in range(warmup):
+        for arg in args:
+            func(*arg)
+
+    samples = []
+    for _ in range(repeat):
+        for arg in args:
+            start = time.perf_counter()
+            func(*arg)
+            samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def load(conn, data_dir: str) -> dict:
+    """
+    drop, create and load the three tables from data_dir, timing each loader
+    :return: seconds per step
+    """
+    books, users, ratings = Books(conn), Users(conn), Ratings(conn)
+    rv = {}
+
+    # ratings references books and users, drop it first and load it last
+    ratings.drop_table()
+    books.drop_table()
+    users.drop_table()
+    books.create_table()
+    users.create_table()
+    ratings.create_table()
+
+    for name, loader_ in [('load_books', lambda: books.load_books(os.path.join(data_dir, 'books.csv'), resume=False)),
+                          ('load_users', lambda: users.load_users(os.path.join(data_dir, 'users.csv'), resume=False)),
+                          ('load_ratings', lambda: ratings.load_ratings(os.path.join(data_dir, 'ratings.csv'), resume=False)),
+                          ('rebuild_summaries', lambda: summaries.rebuild(conn))]:
+        start = time.perf_counter()
+        loader_()
+        rv[name] = round(time.perf_counter() - start, 3)
+        print(f"{name}: {rv[name]}s")
+    return rv
+
+
+def sample_params(conn, data_dir: str, count: int, seed: int) -> dict:
+    """
+    pick isbns, authors and title/author pairs to query, a mix of popular
+    and random ones
+    """
+    rng = random.Random(seed)
+    rows = []
+    with open(os.path.join(data_dir, 'books.csv'), newline='', encoding='utf-8') as f:
+        # reservoir sample so large files are never read into memory
+        for i, row in enumerate(csv.reader(f, delimiter=';')):
+            if len(rows) < count:
+                rows.append(row)
+            elif (j := rng.randint(0, i)) < count:
+                rows[j] = row
+
+    popular = [row[0] for row in Books.get_top_n_authors.uncached(conn, max(count // 4, 1)) or []]
+    return {
+        'isbns': [row[0] for row in rows],
+        'authors': popular + [row[2] for row in rows[:count - len(popular)]],
+        'titles': [(row[1], row[2]) for row in rows],
+    }
+
+
+def run_queries(conn, params: dict, warmup: int, repeat: int) -> dict:
+    ids = itertools.count(10 ** 8)
+    isbns = itertools.count(10 ** 8)
+
+    def new_user(conn):
+        Users.insert_user(conn, next(ids), 'benchmark, nowhere, none', '')
+
+    def new_book(conn):
+        Books.insert_book(conn, f"B{next(isbns):09d}", 'Benchmark', 'Bench Mark', 2000, 'None')
+
+    def new_review(conn, isbn):
+        user_id = next(ids)
+        Users.insert_user(conn, user_id, 'benchmark, nowhere, none', '')
+        Ratings.insert_review(conn, user_id, isbn, 5)
+
+    # (name, function, argument tuples), conn is always the first argument
+    ops = [
+        ('get_title_by_isbn', Books.get_title_by_isbn.uncached, [(isbn,) for isbn in params['isbns']]),
+        ('get_books_by_author', Books.get_books_by_author.uncached, [(a,) for a in params['authors']]),
+        ('get_avg_rating_by_author', Ratings.get_avg_rating_by_author.uncached, [(a,) for a in params['authors']]),
+        ('get_books_avg_rating', Ratings.get_books_avg_rating.uncached, params['titles']),
+        ('get_avg_rating_from_most_reviews', Ratings.get_avg_rating_from_most_reviews.uncached, [()]),
+        ('get_top_n_authors_10', Books.get_top_n_authors.uncached, [(10,)]),
+        ('get_top_n_authors_1000', Books.get_top_n_authors.uncached, [(1000,)]),
+        ('get_top_n_books_10', Ratings.get_top_n_books.uncached, [(10,)]),
+        ('get_top_n_books_1000', Ratings.get_top_n_books.uncached, [(1000,)]),
+        ('insert_user', new_user, [()]),
+        ('insert_book', new_book, [()]),
+        ('insert_review', new_review, [(isbn,) for isbn in params['isbns'][:10]]),
+    ]
+
+    rv = {}
+    for name, func, args in ops:
+        rv[name] = time_calls(lambda *a: func(conn, *a), args, warmup, repeat)
+        print(f"{name}: median {rv[name]['median_ms']} ms, p95 {rv[name]['p95_ms']} ms")
+    return rv
+
+
+def run_approx(conn, params: dict, percent: float, warmup: int, repeat: int) -> dict:
+    """
+    time the approximate methods against the exact ones and report how far
+    their answers are from the exact answers
+    """
+    import approx
+    rv = {}
+    errors = []
+    covered = []
+    for author in params['authors']:
+        exact = Ratings.get_avg_rating_by_author.uncached(conn, author)
+        estimate = approx.avg_rating_by_author.uncached(conn, author, percent)
+        if exact and estimate:
+            errors.append(abs(float(estimate[0][0]) - float(exact[0][0])))
+            covered.append(errors[-1] <= estimate[0][2] + 0.05)
+    rv['avg_rating_by_author'] = {
+        'exact': time_calls(Ratings.get_avg_rating_by_author.uncached,
+                            [(conn, a) for a in params['authors']], warmup, repeat),
+        'approx': time_calls(lambda a: approx.avg_rating_by_author.uncached(conn, a, percent),
+                             [(a,) for a in params['authors']], warmup, repeat),
+        'mean_abs_error': round(statistics.fmean(errors), 3) if errors else None,
+        'within_bound': round(sum(covered) / len(covered), 3) if covered else None,
+    }
+
+    for name, r in rv.items():
+        speedup = r['exact']['median_ms'] / r['approx']['median_ms'] if r['approx']['median_ms'] else 0
+        extra = {k: v for k, v in r.items() if k not in ('exact', 'approx')}
+        print(f"{name}: exact {r['exact']['median_ms']} ms, approx {r['approx']['median_ms']} ms "
+              f"({speedup:.1f}x), {extra}")
+    return rv
+
+
+# run in a fresh interpreter: time the console import (what runs before the
+# menu is drawn), list the heavy modules it pulled in, then make sure
+# importing the models opens no connection
+STARTUP_CHECK = r"""
+import sys, time
+start = time.perf_counter()
+import console_app
+elapsed = time.perf_counter() - start
+heavy = [m for m in ('psycopg', 'tabulate', 'books', 'ratings', 'users') if m in sys.modules]
+
+import psycopg
+def refuse(*args, **kwargs):
+    raise RuntimeError("connection opened on import")
+psycopg.connect = refuse
+import books, ratings, users
+print(elapsed, ','.join(heavy))
+"""
+DEFAULT_STARTUP_BUDGET_MS = float(os.environ.get('BOOKS_STARTUP_BUDGET_MS', 50))
+
+
+def startup(repeat: int, budget_ms: float) -> dict:
+    """
+    time console startup in fresh interpreters
+    :return: import and process timings, the heavy modules loaded eagerly
+        and whether the budget was met
+    """
+    imports = []
+    processes = []
+    heavy = set()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', STARTUP_CHECK], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        processes.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            raise RuntimeError(f"startup check failed: {result.stderr.strip().splitlines()[-1]}")
+        elapsed, _, modules = result.stdout.strip().splitlines()[-1].partition(' ')
+        imports.append(float(elapsed))
+        heavy.update(m for m in modules.split(',') if m)
+
+    rv = {'import': summarize(imports), 'process': summarize(processes), 'eager_modules': sorted(heavy),
+          'budget_ms': budget_ms}
+    rv['within_budget'] = rv['import']['median_ms'] <= budget_ms and not heavy
+    return rv
+
+
+def metadata(conn, args) -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'scale': args.scale,
+        'seed': args.seed,
+        'warmup': args.warmup,
+        'repeat': args.repeat,
+        'python': platform.python_version(),
+        'server_version': conn.info.server_version,
+    }
+
+
+def compare(old: dict, new: dict) -> None:
+    """
+    print the change in median time of every operation between two result files
+    """
+    for section in ('load', 'queries'):
+        for name, value in new.get(section, {}).items():
+            before = old.get(section, {}).get(name)
+            if before is None:
+                continue
+            a = before['median_ms'] if isinstance(before, dict) else before
+            b = value['median_ms'] if isinstance(value, dict) else value
+            change = (b - a) / a * 100 if a else 0.0
+            print(f"{name:36} {a:>10.3f} -> {b:>10.3f} ({change:+.1f}%)")
+
+
+def main(argv: list[str] = None) -> None:
+    parser = argparse.ArgumentParser(description="benchmark the loaders and every Books/Ratings/Users method")
+    parser.add_argument('--data-dir', default='bench_data')
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--generate', action='store_true', help="generate the synthetic csv files first")
+    parser.add_argument('--no-load', action='store_true', help="reuse the data already in the database")
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--samples', type=int, default=20, help="isbns/authors/titles queried per pass")
+    parser.add_argument('-o', '--output', default='bench_results.json')
+    parser.add_argument('--compare', help="earlier result file to diff against")
+    parser.add_argument('--startup', action='store_true',
+                        help="only check console startup time against --budget-ms, exit 1 if over")
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_STARTUP_BUDGET_MS)
+    parser.add_argument('--approx', type=float, metavar='PERCENT',
+                        help="also compare the approximate methods, sampling PERCENT of the rows")
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        result = startup(args.repeat, args.budget_ms)
+        print(json.dumps(result, indent=2))
+        if not result['within_budget']:
+            print(f"Startup over budget: median {result['import']['median_ms']} ms "
+                  f"(budget {args.budget_ms} ms), eagerly imported {result['eager_modules'] or 'nothing'}")
+            sys.exit(1)
+        return
+
+    if args.generate:
+        counts = gen_data.generate(args.data_dir, args.scale, args.seed)
+        print(f"Generated {counts}")
+
+    # time the database, not the in-process cache
+    query_cache.cache.max_entries = 0
+    query_cache.cache.clear()
+
+    with cb.connection() as conn:
+        results = {'meta': metadata(conn, args)}
+        if not args.no_load:
+            results['load'] = load(conn, args.data_dir)
+        params = sample_params(conn, args.data_dir, args.samples, args.seed)
+        results['queries'] = run_queries(conn, params, args.warmup, args.repeat)
+        if args.approx:
+            results['approx'] = run_approx(conn, params, args.approx, args.warmup, args.repeat)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
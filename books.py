@@ -2,43 +2,72 @@ import sqlite3 as sq
 import csv
 import psycopg as pg
 import connect_books as cb
+import loader
+import migrations
+import paging
+import query_cache
+import summaries
 
 
 class Books:
     # class (static) data
-    dt = "DROP TABLE IF EXISTS books"
-    ct = """
-            CREATE TABLE IF NOT EXISTS books (
-            isbn varchar(10) PRIMARY KEY,
-            title text NOT NULL,
-            author    text,
-            year      numeric(4),
-            publisher text,
-            small     text,
-            medium    text,
-            large     text
-        );
-    """
     iit = "INSERT INTO books VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
 
-    def __init__(self, conn: cb.connect()):
-        self.conn = conn
+    # queries, shared by the sync methods below and async_queries
+    q_title_by_isbn = "SELECT title FROM books WHERE isbn = %s;"
+    q_books_by_author = """
+        SELECT 
+            title, year, publisher, isbn 
+        FROM 
+            books 
+        WHERE 
+            author_key = lower(%s);
+        """
+    q_top_n_authors = """
+        SELECT author, book_count
+        FROM author_book_stats
+        WHERE book_count > 0
+        ORDER BY book_count DESC 
+        LIMIT %s;
+        """
+
+    def __init__(self, conn: pg.Connection = None):
+        # borrow a connection from the pool unless one was handed in
+        self.pooled = conn is None
+        self.conn = cb.get_pool().getconn() if self.pooled else conn
+
+    def close(self):
+        if self.pooled:
+            cb.get_pool().putconn(self.conn)
+            self.pooled = False
 
     def create_table(self):
-        self.conn.execute(Books.ct)
-        self.conn.commit()
+        # every table, see migrations (a sqlite snapshot gets its own dialect)
+        migrations.migrate(self.conn)
 
-    def load_books(self):
-        # context manager --> automatically closes file
-        with open('books.csv') as f:
-            # f = open("parts.csv")
-            reader = csv.reader(f, delimiter=';')
-            self.conn.executemany(Books.iit, list(reader))
-            self.conn.commit()
+    def load_books(self, path: str = 'books.csv', resume: bool = True, workers: int = 1,
+                   rejects: str = None):
+        """
+        stream books.csv into the books table with COPY, committing in chunks
+        :param path: ';' delimited csv file
+        :param resume: continue a previously failed load from its last chunk
+        :param workers: load in parallel with this many processes, see
+            parallel_load (no resume)
+        :param rejects: validate the raw file with ingest first, writing the
+            rows that fail here (always one process)
+        :return: number of rows loaded
+        """
+        if rejects:
+            import ingest
+            return ingest.load(self.conn, 'books', path, rejects, resume)[0]
+        if workers > 1:
+            import parallel_load
+            return parallel_load.load(self.conn, 'books', path, workers)['rows']
+        return loader.copy_csv(self.conn, 'books', path, resume=resume)
 
     def drop_table(self):
-        self.conn.execute(Books.dt)
-        self.conn.commit()
+        migrations.drop(self.conn, 'books')
+        loader.reset_progress(self.conn, 'books')
 
     # functions/queries specific to the parts table
 
@@ -48,7 +77,8 @@ class Books:
         return ''.join(char for char in input_string if char not in string.punctuation)
 
     @staticmethod
-    def get_title_by_isbn(conn: cb.connect(),
+    @query_cache.cached('books', normalize=str.strip)
+    def get_title_by_isbn(conn: pg.Connection,
                           isbn: str) -> str | None:
         """
         Get the title of a book by its isbn
@@ -57,7 +87,7 @@ class Books:
         :return: title
         """
 
-        cmd = "SELECT title FROM books WHERE isbn = %s;"
+        cmd = Books.q_title_by_isbn
 
         # get a cursor to execute the query
         cur = conn.cursor()
@@ -77,14 +107,32 @@ class Books:
         cur.close()
         return rv
 
+    @staticmethod
+    def get_titles_by_isbns(conn: pg.Connection,
+                            isbns: list[str]) -> dict[str, str]:
+        """
+        Get the titles of many books in one query
+        :param conn:
+        :param isbns:
+        :return: dict of isbn to title, isbns that were not found are left out
+        """
+
+        cmd = "SELECT isbn, title FROM books WHERE isbn = ANY(%s);"
+
+        cur = conn.cursor()
+        cur.execute(cmd, ([isbn.strip() for isbn in isbns],))
+        rv = dict(cur.fetchall())
+        cur.close()
+        return rv
+
     # insert a new book
     @staticmethod
-    def insert_book(conn: cb.connect(),
+    def insert_book(conn: pg.Connection,
                     isbn: str,
                     title: str,
                     author: str,
                     year: int,
-                    publisher: str) -> None:
+                    publisher: str) -> bool:
         cmd = """
             INSERT INTO
                 books
@@ -95,17 +143,23 @@ class Books:
         # get a cursor to execute the query
         cur = conn.cursor()
 
+        rv = True
         try:
             cur.execute(cmd, (isbn, title, author, year, publisher))
+            summaries.add_book(cur, author)
         except pg.Error as e:
             print(f"Error: {e}")
+            rv = False
 
         conn.commit()
+        query_cache.invalidate('books')
 
         cur.close()
+        return rv
 
     @staticmethod
-    def get_books_by_author(conn: cb.connect(),
+    @query_cache.cached('books', normalize=query_cache.match_key)
+    def get_books_by_author(conn: pg.Connection,
                             author: str) -> list[[str, int, str, str]] | None:
         """
         Get books by author
@@ -116,15 +170,8 @@ class Books:
 
         author = Books.remove_punctuation(author)
 
-        # remove punctuation from name
-        cmd = """
-            SELECT 
-                title, year, publisher, isbn 
-            FROM 
-                books 
-            WHERE 
-                regexp_replace(author, '[^\w\s]', '', 'g') ILIKE %s;
-            """
+        # author_key is the author with punctuation removed, lowercased and indexed
+        cmd = Books.q_books_by_author
 
         # get a cursor to execute the query
         cur = conn.cursor()
@@ -142,7 +189,88 @@ class Books:
         return rv
 
     @staticmethod
-    def get_top_n_authors(conn: cb.connect(),
+    def get_books_by_authors(conn: pg.Connection,
+                             authors: list[str]) -> dict[str, list[[str, int, str, str]]]:
+        """
+        Get the books of many authors in one query
+        :param conn:
+        :param authors:
+        :return: dict of normalized author key (see query_cache.match_key) to
+            rows of title, year, publisher, isbn
+        """
+
+        keys = list({query_cache.match_key(author) for author in authors})
+
+        cmd = """
+            SELECT 
+                author_key, title, year, publisher, isbn 
+            FROM 
+                books 
+            WHERE 
+                author_key = ANY(%s)
+            ORDER BY
+                author_key, isbn;
+            """
+
+        rv = {}
+        cur = conn.cursor()
+        cur.execute(cmd, (keys,))
+        for key, *row in cur:
+            rv.setdefault(key, []).append(tuple(row))
+        cur.close()
+
+        return rv
+
+    @staticmethod
+    def get_books_by_author_page(conn: pg.Connection,
+                                 author: str,
+                                 after: tuple | None,
+                                 size: int) -> list[[str, int, str, str]]:
+        """
+        Get one page of books by author in isbn order, for a KeysetPager
+        :param conn:
+        :param author:
+        :param after: (isbn,) of the last row of the previous page, None for the first page
+        :param size: max rows
+        :return: rows of title, year, publisher, isbn
+        """
+
+        author = Books.remove_punctuation(author)
+
+        if after is None:
+            cmd = """
+                SELECT title, year, publisher, isbn
+                FROM books
+                WHERE author_key = lower(%s)
+                ORDER BY isbn;
+                """
+            params = (author,)
+        else:
+            cmd = """
+                SELECT title, year, publisher, isbn
+                FROM books
+                WHERE author_key = lower(%s) AND isbn > %s
+                ORDER BY isbn;
+                """
+            params = (author, after[0])
+
+        return paging.fetch_page(conn, cmd, params, size)
+
+    @staticmethod
+    def books_by_author_pager(read,
+                              author: str,
+                              page_size: int) -> paging.KeysetPager:
+        """
+        :param read: runs every page on a lent connection, see paging.borrowing
+        """
+        return paging.KeysetPager(paging.borrowing(read, lambda conn, after, size:
+                                                   Books.get_books_by_author_page(conn, author, after, size)),
+                                  lambda row: (row[3],),
+                                  page_size)
+
+    @staticmethod
+    @query_cache.cached('books')
+    def get_top_n_authors(conn: pg.Connection,
                           n: int) -> list[str, int] | None:
         """
         Get the top n authors by number of books
@@ -151,15 +279,8 @@ class Books:
         :return: table of n authors with author, count
         """
 
-        cmd = """
-        WITH count_books AS (SELECT author, count(*) as count
-                            FROM books
-                            GROUP BY author)
-        SELECT author, count
-        FROM count_books
-        ORDER BY count DESC 
-        LIMIT %s;
-        """
+        # author_book_stats is kept up to date by insert_book
+        cmd = Books.q_top_n_authors
 
         cur = conn.cursor()
         try:
@@ -177,3 +298,47 @@ class Books:
         cur.close()
 
         return rv
+
+    @staticmethod
+    @query_cache.cached('books')
+    def get_top_authors_page(conn: pg.Connection,
+                             after: tuple | None,
+                             size: int) -> list[str, int]:
+        """
+        Get one page of authors by number of books, for a KeysetPager
+        :param conn:
+        :param after: (count, author) of the last row of the previous page, None for the first page
+        :param size: max rows
+        :return: rows of author, count
+        """
+
+        # walks the (book_count DESC, author DESC) index, no sort or OFFSET
+        if after is None:
+            cmd = """
+            SELECT author, book_count
+            FROM author_book_stats
+            WHERE book_count > 0
+            ORDER BY book_count DESC, author DESC;
+            """
+            params = ()
+        else:
+            cmd = """
+            SELECT author, book_count
+            FROM author_book_stats
+            WHERE book_count > 0 AND (book_count, author) < (%s, %s)
+            ORDER BY book_count DESC, author DESC;
+            """
+            params = after
+
+        return paging.fetch_page(conn, cmd, params, size)
+
+    @staticmethod
+    def top_n_authors_pager(read,
+                            n: int,
+                            page_size: int) -> paging.KeysetPager:
+        """
+        :param read: runs every page on a lent connection, see paging.borrowing
+        """
+        return paging.KeysetPager(paging.borrowing(read, Books.get_top_authors_page),
+                                  lambda row: (row[1], row[0]),
+                                  page_size, limit=n)
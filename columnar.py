@@ -0,0 +1,258 @@
+import argparse
+import json
+import os
+import time
+from bisect import bisect_left, bisect_right
+from decimal import Decimal, ROUND_HALF_UP
+
+import numpy as np
+
+import paging
+import query_cache
+
+# on-disk layout of a snapshot directory, every array is a .npy file that is
+# memory-mapped on open:
+#   book_author.npy   int32  book id -> author id (-1 when the author is NULL)
+#   book_work.npy     int32  book id -> work id, a work is a distinct (title, author)
+#   rating_book.npy   int32  rating -> book id
+#   rating_user.npy   int32  rating -> dense user id
+#   rating_value.npy  int8   rating -> book_rating (-1 when NULL)
+#   user_ids.npy      int64  dense user id -> user_id
+# and dictionary-encoded strings, each an offsets .npy plus a utf-8 .bin blob:
+#   isbns, authors, author_keys_sorted (+ author_keys_order.npy), work_titles, work_authors
+SNAPSHOT_VERSION = 2
+# book_rating is 0-10, so NULL fits the int8 column as -1
+NULL_RATING = -1
+
+
+class StringColumn:
+    """
+    read only sequence of strings stored as utf-8 bytes plus offsets, only
+    the strings that are indexed are ever decoded
+    """
+
+    def __init__(self, directory: str, name: str):
+        self.offsets = np.load(os.path.join(directory, f"{name}.offsets.npy"), mmap_mode='r')
+        self.data = np.memmap(os.path.join(directory, f"{name}.bin"), dtype=np.uint8, mode='r') \
+            if os.path.getsize(os.path.join(directory, f"{name}.bin")) else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+
+def write_strings(directory: str, name: str, values) -> None:
+    offsets = [0]
+    with open(os.path.join(directory, f"{name}.bin"), 'wb') as f:
+        for value in values:
+            encoded = (value or '').encode('utf-8')
+            f.write(encoded)
+            offsets.append(offsets[-1] + len(encoded))
+    np.save(os.path.join(directory, f"{name}.offsets.npy"), np.asarray(offsets, dtype=np.int64))
+
+
+def export(conn, directory: str, batch_size: int = 50_000) -> dict:
+    """
+    write books and ratings as a columnar snapshot, reading both tables once
+    through server-side cursors
+    :param conn: postgres or sqlite snapshot connection
+    :param directory: created if missing, existing files are replaced
+    :return: row counts
+    """
+    os.makedirs(directory, exist_ok=True)
+    start = time.perf_counter()
+
+    # books: ids are assigned in isbn order, authors and works as first seen
+    isbn_ids = {}
+    author_ids = {}
+    author_keys = []
+    work_ids = {}
+    book_author = []
+    book_work = []
+    for isbn, title, author, author_key in paging.stream(
+            conn, "SELECT isbn, title, author, author_key FROM books ORDER BY isbn", (), batch_size):
+        isbn_ids[isbn] = len(isbn_ids)
+        if author is None:
+            author_id = -1
+        else:
+            author_id = author_ids.setdefault(author, len(author_ids))
+            if author_id == len(author_keys):
+                # the stored key, so matching is exactly the SQL author_key = lower(%s)
+                author_keys.append(author_key or '')
+        book_author.append(author_id)
+        book_work.append(work_ids.setdefault((title, author or ''), len(work_ids)))
+
+    np.save(os.path.join(directory, 'book_author.npy'), np.asarray(book_author, dtype=np.int32))
+    np.save(os.path.join(directory, 'book_work.npy'), np.asarray(book_work, dtype=np.int32))
+    write_strings(directory, 'isbns', isbn_ids)
+    write_strings(directory, 'authors', author_ids)
+    write_strings(directory, 'work_titles', (title for title, _ in work_ids))
+    write_strings(directory, 'work_authors', (author for _, author in work_ids))
+
+    # author keys sorted for binary search, with the author id of each
+    order = sorted(range(len(author_keys)), key=author_keys.__getitem__)
+    write_strings(directory, 'author_keys_sorted', (author_keys[i] for i in order))
+    np.save(os.path.join(directory, 'author_keys_order.npy'), np.asarray(order, dtype=np.int32))
+    del book_author, book_work, author_ids, work_ids, author_keys
+
+    # ratings: filled in place so memory stays flat whatever the table size
+    count = conn.execute("SELECT count(*) FROM ratings").fetchone()[0]
+    arrays = {name: np.lib.format.open_memmap(os.path.join(directory, f"{name}.npy"), mode='w+',
+                                               dtype=dtype, shape=(count,))
+              for name, dtype in [('rating_book', np.int32), ('rating_user', np.int32), ('rating_value', np.int8)]}
+    user_ids = {}
+    n = 0
+    for user_id, isbn, rating in paging.stream(conn, "SELECT user_id, isbn, book_rating FROM ratings",
+                                               (), batch_size):
+        book = isbn_ids.get(isbn)
+        # the queries join ratings to books, ratings of unknown isbns never count
+        if book is None or n >= count:
+            continue
+        arrays['rating_book'][n] = book
+        arrays['rating_user'][n] = user_ids.setdefault(user_id, len(user_ids))
+        arrays['rating_value'][n] = NULL_RATING if rating is None else rating
+        n += 1
+    for array in arrays.values():
+        array.flush()
+    np.save(os.path.join(directory, 'user_ids.npy'), np.fromiter(user_ids, dtype=np.int64, count=len(user_ids)))
+
+    meta = {'version': SNAPSHOT_VERSION, 'books': len(isbn_ids), 'ratings': n, 'users': len(user_ids),
+            'exported_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'seconds': round(time.perf_counter() - start, 1)}
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    conn.rollback()
+    return meta
+
+
+class ColumnarEngine:
+    """
+    the rating aggregates computed in process over a memory-mapped snapshot
+    with vectorized group-bys (bincount), results match the SQL methods
+    """
+
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != SNAPSHOT_VERSION:
+            raise ValueError(f"snapshot version {self.meta['version']} is not {SNAPSHOT_VERSION}")
+
+        def load(name):
+            return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r')
+
+        self.book_author = load('book_author')
+        self.book_work = load('book_work')
+        # only the first meta['ratings'] rows are filled
+        n = self.meta['ratings']
+        self.rating_book = load('rating_book')[:n]
+        self.rating_user = load('rating_user')[:n]
+        self.rating_value = load('rating_value')[:n]
+        self.user_ids = load('user_ids')
+        self.authors = StringColumn(directory, 'authors')
+        self.author_keys = StringColumn(directory, 'author_keys_sorted')
+        self.author_keys_order = load('author_keys_order')
+        self.work_titles = StringColumn(directory, 'work_titles')
+        self.work_authors = StringColumn(directory, 'work_authors')
+
+    def _author_ids(self, name: str) -> np.ndarray:
+        key = query_cache.match_key(name)
+        lo = bisect_left(self.author_keys, key)
+        hi = bisect_right(self.author_keys, key, lo)
+        return np.asarray(self.author_keys_order[lo:hi])
+
+    def get_avg_rating_by_author(self, name: str) -> list[[Decimal, int]] | None:
+        """
+        same result as Ratings.get_avg_rating_by_author
+        :return: [(avg rating, number of books)] or None
+        """
+        ids = self._author_ids(name)
+        if len(ids) == 0:
+            return None
+        books = np.isin(self.book_author, ids)
+        values = self.rating_value[books[self.rating_book]]
+        if len(values) == 0:
+            return None
+        # AVG() skips NULL ratings, and is NULL when there are only NULLs
+        rated = values[values != NULL_RATING]
+        if len(rated) == 0:
+            return [(None, int(books.sum()))]
+        return [(_round(int(rated.sum(dtype=np.int64)), len(rated)), int(books.sum()))]
+
+    def get_top_n_books(self, n: int) -> list[str, str, int] | None:
+        """
+        same result as Ratings.get_top_n_books
+        :return: rows of title, author, number of ratings
+        """
+        counts = np.bincount(self.book_work[self.rating_book], minlength=len(self.work_titles))
+        top = _top(counts, n)
+        return [(self.work_titles[w], self.work_authors[w], int(counts[w])) for w in top] or None
+
+    def get_top_n_authors(self, n: int) -> list[str, int] | None:
+        """
+        same result as Books.get_top_n_authors
+        :return: rows of author, number of books
+        """
+        authors = self.book_author[self.book_author >= 0]
+        counts = np.bincount(authors, minlength=len(self.authors))
+        return [(self.authors[a], int(counts[a])) for a in _top(counts, n)] or None
+
+    def get_avg_rating_from_most_reviews(self) -> Decimal | None:
+        """
+        same result as Ratings.get_avg_rating_from_most_reviews
+        """
+        if len(self.rating_user) == 0:
+            return None
+        counts = np.bincount(self.rating_user)
+        # NULL ratings count as reviews but add nothing, like the summary's
+        # count(*) and coalesce(sum(book_rating), 0)
+        sums = np.bincount(self.rating_user, weights=np.maximum(self.rating_value, 0))
+        # ties go to the lowest user_id, like ORDER BY review_count DESC, user_id
+        tied = np.flatnonzero(counts == counts.max())
+        user = int(tied[np.argmin(self.user_ids[tied])])
+        return _round(int(sums[user]), int(counts[user]))
+
+
+def _round(total: int, count: int) -> Decimal:
+    """
+    total / count to one decimal place, rounding halves away from zero like
+    postgres round(numeric), not to even like python's round(float)
+    """
+    return (Decimal(total) / Decimal(count)).quantize(Decimal('0.1'), ROUND_HALF_UP)
+
+
+def _top(counts: np.ndarray, n: int) -> list[int]:
+    """
+    indexes of the n largest non zero counts, largest first
+    """
+    n = min(n, int(np.count_nonzero(counts)))
+    if n <= 0:
+        return []
+    top = np.argpartition(-counts, n - 1)[:n]
+    return top[np.argsort(-counts[top], kind='stable')].tolist()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="columnar snapshot of books and ratings")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('export').add_argument('directory')
+    report = sub.add_parser('report')
+    report.add_argument('directory')
+    report.add_argument('--top', type=int, default=10)
+    report.add_argument('--author', action='append', default=[])
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        import connect_books as cb
+        with cb.connection() as conn:
+            print(export(conn, args.directory))
+    else:
+        start = time.perf_counter()
+        engine = ColumnarEngine(args.directory)
+        print("Top books:", engine.get_top_n_books(args.top))
+        print("Top authors:", engine.get_top_n_authors(args.top))
+        print("Avg rating of user with most reviews:", engine.get_avg_rating_from_most_reviews())
+        for author in args.author:
+            print(f"{author}:", engine.get_avg_rating_by_author(author))
+        print(f"{time.perf_counter() - start:.3f}s")
@@ -1,15 +1,81 @@
+import contextvars
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
 import psycopg as pg
+from psycopg.conninfo import conninfo_to_dict, make_conninfo
+
+import instrument
+
+# defaults match the original hardcoded connection, override with environment
+# variables (or a full libpq DSN in BOOKS_DSN)
+DEFAULT_DBNAME = 'james_norah_booksdataset'
+DEFAULT_HOST = 'ada.hpc.stlawu.edu'
+DEFAULT_USER = 'nlkudu21'
+DEFAULT_PWD_FILE = '/Users/norahkuduk/.pwd'
+
+
+def settings() -> dict:
+    """
+    read the connection and pool settings from the environment
+    :return: dict of settings
+    """
+    return {
+        'backend': os.environ.get('BOOKS_BACKEND', 'postgres'),
+        'sqlite_path': os.environ.get('BOOKS_SQLITE_PATH', 'books.sqlite'),
+        'dsn': os.environ.get('BOOKS_DSN'),
+        'dbname': os.environ.get('BOOKS_DBNAME', DEFAULT_DBNAME),
+        'host': os.environ.get('BOOKS_HOST', DEFAULT_HOST),
+        'user': os.environ.get('BOOKS_USER', DEFAULT_USER),
+        'pwd_file': os.path.expanduser(os.environ.get('BOOKS_PWD_FILE', DEFAULT_PWD_FILE)),
+        'min_size': int(os.environ.get('BOOKS_POOL_MIN', 1)),
+        'max_size': int(os.environ.get('BOOKS_POOL_MAX', 4)),
+        'max_idle': float(os.environ.get('BOOKS_POOL_MAX_IDLE', 300)),
+        'max_lifetime': float(os.environ.get('BOOKS_POOL_MAX_LIFETIME', 3600)),
+        'timeout': float(os.environ.get('BOOKS_POOL_TIMEOUT', 30)),
+        # read only replicas of BOOKS_DSN (the primary), ';' separated DSNs
+        'replica_dsns': [dsn.strip() for dsn in os.environ.get('BOOKS_REPLICA_DSNS', '').split(';') if dsn.strip()],
+        'replica_policy': os.environ.get('BOOKS_REPLICA_POLICY', 'round-robin'),
+        'replica_retry': float(os.environ.get('BOOKS_REPLICA_RETRY', 30)),
+        'sticky_seconds': float(os.environ.get('BOOKS_STICKY_SECONDS', 5)),
+    }
+
+
+def conninfo(conf: dict = None) -> str:
+    """
+    build a libpq connection string from the settings, reading the password
+    file only when no DSN was given
+    :param conf: settings, defaults to settings()
+    :return: connection string
+    """
+    conf = conf or settings()
+    if conf['dsn']:
+        return conf['dsn']
+
+    # context manager --> automatically closes file, good security practice
+    with open(conf['pwd_file'], 'r') as pwd_file:
+        password = pwd_file.readline().strip()
+
+    return make_conninfo(dbname=conf['dbname'],
+                         host=conf['host'],
+                         user=conf['user'],
+                         password=password)
+
 
 def connect() -> pg.Connection:
     """
-    return a connection object to the books database or
+    return a new (unpooled) connection object to the books database or
     exit if failure
     :return: connection object
     """
 
     # what can go wrong
     try:
-        pwd_file = open("/Users/norahkuduk/.pwd", 'r')
+        info = conninfo()
     except OSError as e:
         print(f"Error: file not readable, {e}")
         exit()
@@ -17,17 +83,531 @@ def connect() -> pg.Connection:
     # what can go wrong
     try:
         # connect to an existing database
-        conn = pg.connect(
-            dbname='james_norah_booksdataset',
-            host="ada.hpc.stlawu.edu",
-            user="nlkudu21",
-            password=pwd_file.readline().strip()
-        )
-
+        conn = instrument.install(pg.connect(info))
     except pg.Error as e:
         print(f"Error: could not connect to database, {e}")
         exit()
-    finally:
-        pwd_file.close()  # good security practice
 
     return conn
+
+
+class PoolTimeout(Exception):
+    """raised when no connection could be checked out in time"""
+
+
+class ConnectionPool:
+    """
+    a small thread safe pool of long-lived connections
+
+    connections are checked for health before being handed out, and closed
+    when they have been idle for longer than max_idle seconds or open for
+    longer than max_lifetime seconds
+    """
+
+    def __init__(self, info: str,
+                 min_size: int = 1,
+                 max_size: int = 4,
+                 max_idle: float = 300,
+                 max_lifetime: float = 3600,
+                 timeout: float = 30,
+                 factory=None):
+        self.info = info
+        # opens a new connection, defaults to psycopg with info
+        self.factory = factory
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size, 1)
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+
+        # idle connections as (conn, created_at, returned_at), most recent last
+        self._idle = deque()
+        self._created = {}
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        self.stats = {
+            'connections_opened': 0,
+            'connections_closed': 0,
+            'connect_time': 0.0,
+            'checkouts': 0,
+            'checkout_wait': 0.0,
+            'checkout_wait_max': 0.0,
+            'health_check_failures': 0,
+            'recycled': 0,
+        }
+
+        for _ in range(min_size):
+            self._idle.append(self._open_idle())
+
+    def _open(self) -> pg.Connection:
+        start = time.perf_counter()
+        conn = instrument.install(self.factory() if self.factory else pg.connect(self.info))
+        elapsed = time.perf_counter() - start
+        with self._cond:
+            self.stats['connections_opened'] += 1
+            self.stats['connect_time'] += elapsed
+            self._created[id(conn)] = time.monotonic()
+        return conn
+
+    def _open_idle(self):
+        conn = self._open()
+        self._size += 1
+        now = time.monotonic()
+        return conn, now, now
+
+    def _discard(self, conn: pg.Connection) -> None:
+        # caller holds the lock and has already decremented _size
+        self._created.pop(id(conn), None)
+        self.stats['connections_closed'] += 1
+        try:
+            conn.close()
+        except pg.Error:
+            pass
+
+    def _healthy(self, conn: pg.Connection) -> bool:
+        if conn.closed or conn.broken:
+            return False
+        try:
+            conn.execute("SELECT 1")
+            conn.rollback()
+        except pg.Error:
+            return False
+        return True
+
+    def _expired(self, created: float, returned: float, now: float) -> bool:
+        return now - returned > self.max_idle or now - created > self.max_lifetime
+
+    def getconn(self, timeout: float = None) -> pg.Connection:
+        """
+        check a connection out of the pool, waiting up to timeout seconds
+        for one to be returned when the pool is at max_size
+        :param timeout: seconds to wait, defaults to the pool timeout
+        :return: connection object
+        """
+        timeout = self.timeout if timeout is None else timeout
+        start = time.perf_counter()
+        deadline = time.monotonic() + timeout
+
+        while True:
+            conn = None
+            with self._cond:
+                if self._closed:
+                    raise PoolTimeout("pool is closed")
+
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout(f"no connection available after {timeout}s")
+                    self._cond.wait(remaining)
+
+                if self._idle:
+                    conn, created, returned = self._idle.pop()
+                    if self._expired(created, returned, time.monotonic()):
+                        self._size -= 1
+                        self.stats['recycled'] += 1
+                        self._discard(conn)
+                        continue
+                else:
+                    # reserve a slot and open outside of the lock
+                    self._size += 1
+
+            if conn is None:
+                try:
+                    conn = self._open()
+                except BaseException:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._healthy(conn):
+                with self._cond:
+                    self._size -= 1
+                    self.stats['health_check_failures'] += 1
+                    self._discard(conn)
+                    self._cond.notify()
+                continue
+
+            waited = time.perf_counter() - start
+            with self._cond:
+                self.stats['checkouts'] += 1
+                self.stats['checkout_wait'] += waited
+                self.stats['checkout_wait_max'] = max(self.stats['checkout_wait_max'], waited)
+            return conn
+
+    def putconn(self, conn: pg.Connection) -> None:
+        """
+        return a connection to the pool, rolling back anything left open
+        :param conn: connection previously returned by getconn
+        """
+        keep = not (conn.closed or conn.broken)
+        if keep and conn.info.transaction_status != pg.pq.TransactionStatus.IDLE:
+            try:
+                conn.rollback()
+            except pg.Error:
+                keep = False
+
+        with self._cond:
+            created = self._created.get(id(conn), time.monotonic())
+            if keep and not self._closed:
+                self._idle.append((conn, created, time.monotonic()))
+            else:
+                self._size -= 1
+                self._discard(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout: float = None):
+        """
+        borrow a connection for the duration of a with block
+        :param timeout: seconds to wait for a connection
+        """
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def shrink(self) -> None:
+        """
+        close idle connections that are past max_idle/max_lifetime, keeping
+        at least min_size connections open
+        """
+        now = time.monotonic()
+        with self._cond:
+            keep = deque()
+            while self._idle:
+                conn, created, returned = self._idle.popleft()
+                if self._size > self.min_size and self._expired(created, returned, now):
+                    self._size -= 1
+                    self.stats['recycled'] += 1
+                    self._discard(conn)
+                else:
+                    keep.append((conn, created, returned))
+            self._idle = keep
+
+    def close(self) -> None:
+        """
+        close every idle connection, connections still checked out are
+        closed when they are returned
+        """
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _, _ = self._idle.pop()
+                self._size -= 1
+                self._discard(conn)
+            self._cond.notify_all()
+
+    def get_stats(self) -> dict:
+        """
+        :return: copy of the pool counters plus current sizes and averages
+        """
+        with self._cond:
+            rv = dict(self.stats)
+            rv['size'] = self._size
+            rv['idle'] = len(self._idle)
+        rv['avg_connect_time'] = rv['connect_time'] / rv['connections_opened'] if rv['connections_opened'] else 0.0
+        rv['avg_checkout_wait'] = rv['checkout_wait'] / rv['checkouts'] if rv['checkouts'] else 0.0
+        # every checkout that reused a connection saved one connect
+        rv['connect_time_saved'] = rv['avg_connect_time'] * max(rv['checkouts'] - rv['connections_opened'], 0)
+        return rv
+
+
+class ReplicaSet:
+    """
+    pools of read only replicas of the primary
+
+    reads go to a replica that is up, in turn (round-robin) or to the one
+    with the lowest checkout latency (latency, which still sends one read in
+    ten round-robin so the others stay measured). A replica that cannot be
+    reached is skipped for retry seconds, its reads go to the next replica
+    or, when none is left, to the primary.
+    """
+
+    def __init__(self, infos: list[str], policy: str = 'round-robin', retry: float = 30, **pool_args):
+        if policy not in ('round-robin', 'latency'):
+            raise ValueError(f"unknown replica policy {policy!r}")
+        self.infos = infos
+        self.policy = policy
+        self.retry = retry
+        # min_size 0, a replica that is down must not stop the program starting
+        self.pools = [ConnectionPool(info, **dict(pool_args, min_size=0)) for info in infos]
+        # moving average of the checkout time (health check or connect), seconds
+        self.latency = [0.0] * len(infos)
+        self.down_until = [0.0] * len(infos)
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+        self.stats = {
+            'replica_reads': [0] * len(infos),
+            'primary_reads': 0,
+            'sticky_reads': 0,
+            'failovers': 0,
+            'retried_reads': 0,
+        }
+
+    def _candidates(self) -> list[int]:
+        now = time.monotonic()
+        with self._lock:
+            up = [i for i in range(len(self.pools)) if self.down_until[i] <= now]
+            turn = next(self._turn)
+        if not up:
+            return []
+        if self.policy == 'latency' and turn % 10:
+            return sorted(up, key=self.latency.__getitem__)
+        first = turn % len(up)
+        return up[first:] + up[:first]
+
+    def _down(self, i: int) -> None:
+        with self._lock:
+            self.down_until[i] = time.monotonic() + self.retry
+            self.stats['failovers'] += 1
+
+    def getconn(self) -> tuple[int, pg.Connection] | None:
+        """
+        check a connection out of the best replica that is up
+        :return: (replica, connection) or None if no replica is available
+        """
+        for i in self._candidates():
+            start = time.perf_counter()
+            try:
+                conn = self.pools[i].getconn()
+            except pg.Error:
+                self._down(i)
+                continue
+            except PoolTimeout:
+                # busy, not down
+                continue
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.latency[i] = 0.8 * self.latency[i] + 0.2 * elapsed if self.latency[i] else elapsed
+                self.stats['replica_reads'][i] += 1
+            return i, conn
+        return None
+
+    def count(self, key: str) -> None:
+        with self._lock:
+            self.stats[key] += 1
+
+    def putconn(self, i: int, conn: pg.Connection) -> None:
+        if conn.broken:
+            # the replica went away during the read
+            self._down(i)
+        self.pools[i].putconn(conn)
+
+    def close(self) -> None:
+        for pool in self.pools:
+            pool.close()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            rv = dict(self.stats, replica_reads=list(self.stats['replica_reads']))
+            rv['latency'] = list(self.latency)
+            now = time.monotonic()
+            rv['down'] = [until > now for until in self.down_until]
+        return rv
+
+
+_pool = None
+_replicas = None
+_pool_lock = threading.Lock()
+
+
+class Session:
+    """
+    the scope of read-your-writes: after a write, reads of the same session
+    stay on the primary, see mark_written
+    """
+
+    def __init__(self):
+        # monotonic time of the last write
+        self.last_write = float('-inf')
+
+
+# the whole process is one session unless code runs inside session()
+_process_session = Session()
+_session = contextvars.ContextVar('books_session', default=None)
+
+
+def get_pool() -> ConnectionPool:
+    """
+    return the process wide pool, creating it from settings() on first use
+    or exit if failure
+    :return: pool
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            conf = settings()
+            if conf['backend'] == 'sqlite':
+                # local snapshot file, see sqlite_backend.py
+                import sqlite_backend
+                path = conf['sqlite_path']
+                _pool = ConnectionPool(path,
+                                       min_size=conf['min_size'],
+                                       max_size=conf['max_size'],
+                                       max_idle=conf['max_idle'],
+                                       max_lifetime=conf['max_lifetime'],
+                                       timeout=conf['timeout'],
+                                       factory=lambda: sqlite_backend.connect(path))
+                return _pool
+
+            try:
+                info = conninfo(conf)
+            except OSError as e:
+                print(f"Error: file not readable, {e}")
+                exit()
+
+            try:
+                _pool = ConnectionPool(info,
+                                       min_size=conf['min_size'],
+                                       max_size=conf['max_size'],
+                                       max_idle=conf['max_idle'],
+                                       max_lifetime=conf['max_lifetime'],
+                                       timeout=conf['timeout'])
+            except pg.Error as e:
+                print(f"Error: could not connect to database, {e}")
+                exit()
+    return _pool
+
+
+def get_replicas() -> ReplicaSet | None:
+    """
+    return the process wide replica set, creating it from settings() on
+    first use
+    :return: replica set, None if no replicas are configured
+    """
+    global _replicas
+    with _pool_lock:
+        if _replicas is None:
+            conf = settings()
+            if conf['backend'] == 'sqlite' or not conf['replica_dsns']:
+                return None
+            _replicas = ReplicaSet(conf['replica_dsns'],
+                                   policy=conf['replica_policy'],
+                                   retry=conf['replica_retry'],
+                                   max_size=conf['max_size'],
+                                   max_idle=conf['max_idle'],
+                                   max_lifetime=conf['max_lifetime'],
+                                   timeout=conf['timeout'])
+    return _replicas
+
+
+@contextmanager
+def session():
+    """
+    run the block as its own session, a write in it only keeps the reads of
+    this session on the primary (e.g. one service client). The session
+    follows the context, pass it to worker threads with
+    contextvars.copy_context().run
+    """
+    token = _session.set(Session())
+    try:
+        yield
+    finally:
+        _session.reset(token)
+
+
+def mark_written() -> None:
+    """
+    note that the current session just wrote to the primary, its reads stay
+    on the primary for sticky_seconds so they see the write (replicas lag
+    behind)
+    """
+    (_session.get() or _process_session).last_write = time.monotonic()
+
+
+@contextmanager
+def _borrow(readonly: bool):
+    """
+    :return: context of (replica index or None for the primary, connection)
+    """
+    replicas = get_replicas() if readonly else None
+    picked = None
+    if replicas is not None:
+        last_write = (_session.get() or _process_session).last_write
+        if time.monotonic() - last_write < settings()['sticky_seconds']:
+            replicas.count('sticky_reads')
+        else:
+            picked = replicas.getconn()
+        if picked is None:
+            replicas.count('primary_reads')
+
+    if picked is None:
+        with get_pool().connection() as conn:
+            yield None, conn
+        return
+
+    i, conn = picked
+    try:
+        yield i, conn
+    finally:
+        replicas.putconn(i, conn)
+
+
+@contextmanager
+def connection(readonly: bool = False):
+    """
+    borrow a connection from the process wide pool
+    :param readonly: the block only reads, it may be given a replica
+        connection, see ReplicaSet and mark_written
+    """
+    with _borrow(readonly) as (_, conn):
+        yield conn
+
+
+def read(func, *args):
+    """
+    func(conn, *args) on a read only connection (see connection). If it was
+    given a replica that went away during the call, the replica is marked
+    down and the call is made once more on the next replica or the primary
+    :return: what func returns
+    """
+    for retry in (False, True):
+        with _borrow(readonly=True) as (replica, conn):
+            try:
+                rv = func(conn, *args)
+            except pg.OperationalError:
+                if retry or replica is None or not conn.broken:
+                    raise
+            else:
+                # the models print errors and carry on, check the connection too
+                if retry or replica is None or not conn.broken:
+                    return rv
+        get_replicas().count('retried_reads')
+
+
+def close_pool() -> None:
+    global _pool, _replicas
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+        if _replicas is not None:
+            _replicas.close()
+            _replicas = None
+
+
+def print_stats() -> None:
+    """
+    print the pool counters, useful to see how much connect latency the
+    pool saves over a session
+    """
+    if _pool is None:
+        return
+    s = _pool.get_stats()
+    print(f"Connections opened: {s['connections_opened']}, "
+          f"avg connect time: {s['avg_connect_time'] * 1000:.1f} ms")
+    print(f"Checkouts: {s['checkouts']}, avg wait: {s['avg_checkout_wait'] * 1000:.2f} ms, "
+          f"max wait: {s['checkout_wait_max'] * 1000:.2f} ms")
+    print(f"Recycled: {s['recycled']}, failed health checks: {s['health_check_failures']}, "
+          f"connect time saved: {s['connect_time_saved']:.2f} s")
+    if _replicas is not None:
+        r = _replicas.get_stats()
+        for info, reads, latency, down in zip(_replicas.infos, r['replica_reads'], r['latency'], r['down']):
+            host = conninfo_to_dict(info).get('host', info)
+            print(f"Replica {host}: {reads} reads, latency {latency * 1000:.1f} ms{', down' if down else ''}")
+        print(f"Reads on the primary: {r['primary_reads']} ({r['sticky_reads']} after a write), "
+              f"failovers: {r['failovers']}, retried: {r['retried_reads']}")
@@ -1,17 +1,73 @@
-import connect_books as cb
-import psycopg as pg
-import tabulate
+import importlib
 import os
 import shutil
-from books import Books
-from ratings import Ratings
-from users import Users
+import sys
+import threading
+
+
+class Lazy:
+    """
+    stand-in for a module (or a name in one) that is imported on first use,
+    so the menu is drawn before psycopg and the models are loaded
+    """
+
+    def __init__(self, module: str, name: str = None):
+        self._module = module
+        self._name = name
+
+    def __getattr__(self, attr):
+        target = importlib.import_module(self._module)
+        if self._name:
+            target = getattr(target, self._name)
+        return getattr(target, attr)
+
+
+cb = Lazy('connect_books')
+instrument = Lazy('instrument')
+query_cache = Lazy('query_cache')
+search = Lazy('search')
+render = Lazy('render')
+Books = Lazy('books', 'Books')
+Ratings = Lazy('ratings', 'Ratings')
+Users = Lazy('users', 'Users')
+
+# BOOKS_SERVICE_URL=http://host:8080 sends every query to a running
+# service.py instead of connecting to the database from here
+REMOTE = bool(os.environ.get('BOOKS_SERVICE_URL'))
+if REMOTE:
+    cb = Lazy('service', 'client')
+    query_cache = Lazy('service', 'RemoteCache')
+    search = Lazy('service', 'RemoteSearch')
+    Books = Lazy('service', 'RemoteBooks')
+    Ratings = Lazy('service', 'RemoteRatings')
+    Users = Lazy('service', 'RemoteUsers')
+
+
+def warm_up() -> threading.Thread:
+    """
+    import the database modules and open the first pooled connection (or
+    reach the service) in the background while the menu is drawn and the
+    user is choosing
+    """
+    def run():
+        try:
+            for module in ('connect_books', 'instrument', 'query_cache', 'render', 'books', 'ratings',
+                           'users', 'search', 'service' if REMOTE else 'paging'):
+                importlib.import_module(module)
+            cb.get_pool()
+        except BaseException:
+            # the option that needs the connection reports the error
+            pass
+
+    thread = threading.Thread(target=run, name='warm-up', daemon=True)
+    thread.start()
+    return thread
 
 
 def menu() -> str:
     """
     Present a menu of options to the user and return a valid option
-    :return: 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, Q, q
+    :return: 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, Q, q
     """
     while True:
         print("1) Look up a book by ISBN")
@@ -24,9 +80,10 @@ def menu() -> str:
         print("8) Insert a new review")
         print("9) Find the top n authors that have the most published books")
         print("10) Find the top n most popular books by rating")
+        print("11) Find books similar to a book (by ISBN)")
         print("Q) Quit")
         opt = input("> ")
-        if opt in ['1', '2', '3', '4', '5', '6', '7', '8', '9', '10', 'Q', 'q']:
+        if opt in ['1', '2', '3', '4', '5', '6', '7', '8', '9', '10', '11', 'Q', 'q']:
             return opt
 
 
@@ -43,18 +100,105 @@ def display_with_paging(content, t_size):
             input("Press Enter to continue...")
 
 
+# Page through a KeysetPager one screen at a time, rows are fetched per page
+def page_through(pager, headers) -> bool:
+    """
+    :return: False if the result was empty
+    """
+    while True:
+        rows = pager.rows()
+        if not rows and pager.page_number == 1:
+            return False
+
+        for line in render.table(rows, headers):
+            print(line)
+
+        if not pager.has_next() and not pager.has_prev():
+            return True
+
+        prompt = []
+        if pager.has_next():
+            prompt.append("Enter=next")
+        if pager.has_prev():
+            prompt.append("b=back")
+        prompt.append("q=quit")
+        choice = input(f"Page {pager.page_number} ({', '.join(prompt)}) ").strip().lower()
+
+        if choice == 'q':
+            return True
+        elif choice == 'b':
+            pager.prev()
+        elif not pager.next():
+            return True
+
+
+def pick(suggestions, label) -> int | None:
+    """
+    show a numbered "did you mean" list
+    :return: index of the chosen suggestion, None to keep what was typed
+    """
+    print("Did you mean:")
+    for i, suggestion in enumerate(suggestions, 1):
+        print(f"{i}) {label(suggestion)}")
+    choice = input("Enter a number, or press Enter to keep what you typed > ").strip()
+    if choice.isdigit() and 1 <= int(choice) <= len(suggestions):
+        return int(choice) - 1
+    return None
+
+
+def choose_author(author) -> str:
+    """
+    check the author against the search index before running a query
+    :return: the author to query
+    """
+    with instrument.timed('search'):
+        suggestions = cb.read(search.suggest_authors, author)
+    if not suggestions or any(search.is_exact(author, name) for name, _ in suggestions):
+        return author
+    i = pick(suggestions, lambda s: f"{s[0]} ({s[1]} ratings)")
+    return author if i is None else suggestions[i][0]
+
+
+def choose_book(title) -> tuple[str, str | None]:
+    """
+    check the title against the search index before running a query
+    :return: the title to query and its author, None if the author is not
+        known yet and still has to be entered
+    """
+    with instrument.timed('search'):
+        suggestions = cb.read(search.suggest_titles, title)
+    if not suggestions:
+        return title, None
+    if len(suggestions) == 1 and search.is_exact(title, suggestions[0][0]):
+        return title, suggestions[0][1] or None
+    i = pick(suggestions, lambda s: f"{s[0]} by {s[1] or 'unknown'} ({s[2]} ratings)")
+    return (title, None) if i is None else (suggestions[i][0], suggestions[i][1])
+
+
+def rows_per_page(t_size) -> int:
+    # grid tables use two lines per row plus the header and the prompt
+    return max((t_size[1] - 4) // 2, 1)
+
+
 # Get terminal size
 terminal_size = shutil.get_terminal_size()
 
 
 if __name__ == "__main__":
+    # python console_app.py batch isbn isbns.txt -o titles.csv
+    if sys.argv[1:2] == ['batch']:
+        import batch
+        batch.main(sys.argv[2:])
+        sys.exit()
+
+    warm_up()
     while True:
         opt = menu()
         if opt == '1':
             print("Enter an ISBN: ")
             isbn = input("> ")
-            conn = cb.connect()
-            title = Books.get_title_by_isbn(conn, isbn)
+            with instrument.timed(opt):
+                title = cb.read(Books.get_title_by_isbn, isbn)
             if title is None:
                 print(f"ISBN {isbn} not found")
             else:
@@ -62,51 +206,46 @@ if __name__ == "__main__":
 
         elif opt == '2':
             print("Enter an author: ")
-            author = input("> ")
-            conn = cb.connect()
-            books = Books.get_books_by_author(conn, author)
-            if books is None:
+            author = choose_author(input("> "))
+            # every page is a read of its own, see cb.read
+            pager = Books.books_by_author_pager(cb.read, author, rows_per_page(terminal_size))
+            # time to first screen, not the time spent reading pages
+            with instrument.timed(opt):
+                pager.rows()
+            if not page_through(pager, ["Title", "Year", "Publisher", "ISBN"]):
                 print(f"Author {author} not found")
-            else:
-                # shorten length of title column
-                output = tabulate.tabulate(books, headers=["Title", "Year", "Publisher", "ISBN"], tablefmt="grid")
-                formatted_output = output.split('\n')
-                display_with_paging(formatted_output, terminal_size)
 
         elif opt == '3':
             print("Enter an author: ")
-            author = input("> ")
-            conn = cb.connect()
-            avg_rating = Ratings.get_avg_rating_by_author(conn, author)
+            author = choose_author(input("> "))
+            with instrument.timed(opt):
+                avg_rating = cb.read(Ratings.get_avg_rating_by_author, author)
 
             if avg_rating is None:
                 print(f"Author {author} not found")
             else:
-                output = tabulate.tabulate(avg_rating, headers=["Avg Rating", "# of Books"], tablefmt="grid")
-                formatted_output = output.split('\n')
-                display_with_paging(formatted_output, terminal_size)
+                display_with_paging(render.table(avg_rating, ["Avg Rating", "# of Books"]), terminal_size)
 
         elif opt == '4':
             print("Enter a title: ")
-            title = input("> ")
+            title, author = choose_book(input("> "))
 
-            print("Enter an author: ")
-            author = input("> ")
+            if author is None:
+                print("Enter an author: ")
+                author = choose_author(input("> "))
 
-            conn = cb.connect()
-            avg_rating = Ratings.get_books_avg_rating(conn, title, author)
+            with instrument.timed(opt):
+                avg_rating = cb.read(Ratings.get_books_avg_rating, title, author)
 
             if avg_rating is None:
                 print(f"Book {title} by {author} not found")
             else:
-                output = tabulate.tabulate(avg_rating, headers=["Rating", "Title", "Author"], tablefmt="grid")
-                formatted_output = output.split('\n')
-                display_with_paging(formatted_output, terminal_size)
+                display_with_paging(render.table(avg_rating, ["Rating", "Title", "Author"]), terminal_size)
                 # print(f"Average rating of {title} by {author} is {avg_rating}")
 
         elif opt == '5':
-            conn = cb.connect()
-            avg_rating = Ratings.get_avg_rating_from_most_reviews(conn)
+            with instrument.timed(opt):
+                avg_rating = cb.read(Ratings.get_avg_rating_from_most_reviews)
             if avg_rating is None:
                 print("No users found")
             else:
@@ -126,9 +265,8 @@ if __name__ == "__main__":
             print("Enter an age: ")
             age = input("> ")
 
-            conn = cb.connect()
-
-            Users.insert_user(conn, user_id, location, age)
+            with instrument.timed(opt), cb.connection() as conn:
+                Users.insert_user(conn, user_id, location, age)
 
         elif opt == '7':
             print("Enter an ISBN: ")
@@ -150,8 +288,8 @@ if __name__ == "__main__":
             print("Enter a publisher: ")
             publisher = input("> ")
 
-            conn = cb.connect()
-            Books.insert_book(conn, isbn, title, author, year, publisher)
+            with instrument.timed(opt), cb.connection() as conn:
+                Books.insert_book(conn, isbn, title, author, year, publisher)
 
         elif opt == '8':
             print("Enter a user ID: ")
@@ -173,8 +311,8 @@ if __name__ == "__main__":
                 print("Error: rating must be an integer")
                 continue
 
-            conn = cb.connect()
-            Ratings.insert_review(conn, user_id, isbn, rating)
+            with instrument.timed(opt), cb.connection() as conn:
+                Ratings.insert_review(conn, user_id, isbn, rating)
 
         elif opt == '9':
             print("Enter a number of authors: ")
@@ -184,14 +322,12 @@ if __name__ == "__main__":
                 print("Error: number of authors must be an integer")
                 continue
 
-            conn = cb.connect()
-            authors = Books.get_top_n_authors(conn, n)
-            if authors is None:
+            pager = Books.top_n_authors_pager(cb.read, n, rows_per_page(terminal_size))
+            # time to first screen, not the time spent reading pages
+            with instrument.timed(opt):
+                pager.rows()
+            if not page_through(pager, ["Author", "# of Books"]):
                 print("No authors found")
-            else:
-                output = tabulate.tabulate(authors, headers=["Author", "# of Books"], tablefmt="grid")
-                formatted_output = output.split('\n')
-                display_with_paging(formatted_output, terminal_size)
 
         elif opt == '10':
             print("Enter a number of books: ")
@@ -201,14 +337,28 @@ if __name__ == "__main__":
                 print("Error: number of books must be an integer")
                 continue
 
-            conn = cb.connect()
-            books = Ratings.get_top_n_books(conn, n)
-            if books is None:
+            pager = Ratings.top_n_books_pager(cb.read, n, rows_per_page(terminal_size))
+            # time to first screen, not the time spent reading pages
+            with instrument.timed(opt):
+                pager.rows()
+            if not page_through(pager, ["Title", "Author", "# of Ratings"]):
                 print("No books found")
+
+        elif opt == '11':
+            print("Enter an ISBN: ")
+            isbn = input("> ")
+
+            with instrument.timed(opt):
+                similar = cb.read(Ratings.get_similar_books, isbn)
+
+            if similar is None:
+                print(f"No similar books found for ISBN {isbn}, run python similarity.py build to index them")
             else:
-                output = tabulate.tabulate(books, headers=["Title", "Author", "# of Ratings"], tablefmt="grid")
-                formatted_output = output.split('\n')
-                display_with_paging(formatted_output, terminal_size)
+                display_with_paging(render.table(similar, ["Title", "Author", "Similarity"]), terminal_size)
 
         elif opt in ['Q', 'q']:
+            instrument.print_summary()
+            cb.print_stats()
+            query_cache.print_stats()
+            cb.close_pool()
             break
@@ -0,0 +1,334 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+import zlib
+
+import psycopg as pg
+
+import loader
+import query_cache
+import summaries
+
+# incremental refresh from new csv files. Every row of the last applied file
+# is remembered as a 64 bit digest, grouped in buckets by a hash of its key,
+# and every bucket as the sum of its digests. A refresh reads the new file
+# once to sum its buckets, then reads the rows of the changed buckets only
+# and diffs them against their stored digests, so the work done in the
+# database scales with the size of the change.
+ct = """
+        CREATE TABLE IF NOT EXISTS load_fingerprints (
+        table_name text NOT NULL,
+        bucket     integer NOT NULL,
+        key        text NOT NULL,
+        digest     bigint NOT NULL,
+        PRIMARY KEY (table_name, bucket, key)
+    );
+        CREATE TABLE IF NOT EXISTS load_buckets (
+        table_name text NOT NULL,
+        bucket     integer NOT NULL,
+        row_count  bigint NOT NULL,
+        digest     bigint NOT NULL,
+        PRIMARY KEY (table_name, bucket)
+    );
+"""
+
+BUCKETS = 4096
+
+# table -> number of key columns (leading), number of columns
+TABLES = {
+    'books': (1, 8),
+    'users': (1, 3),
+    'ratings': (2, 3),
+}
+# applied in this order, deletes in reverse, so foreign keys always hold
+ORDER = ['books', 'users', 'ratings']
+
+_MASK = (1 << 64) - 1
+
+
+def _signed(value: int) -> int:
+    # bigint columns are signed
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _fingerprint(table: str, record: list) -> tuple[str, int, int, list]:
+    """
+    :return: key, bucket, digest and the row as loaded (empty fields are NULL)
+    """
+    keys, width = TABLES[table]
+    row = [field if field != '' else None for field in (record + [''] * width)[:width]]
+    key = ';'.join(record[:keys])
+    digest = int.from_bytes(hashlib.blake2b('\x1f'.join(record[:width]).encode('utf-8'),
+                                            digest_size=8).digest(), 'little')
+    return key, zlib.crc32(key.encode('utf-8')) % BUCKETS, digest, row
+
+
+def _file_buckets(table: str, path: str) -> dict[int, tuple[int, int]]:
+    """
+    :return: bucket -> (rows, sum of digests) of a csv file
+    """
+    counts = [0] * BUCKETS
+    sums = [0] * BUCKETS
+    for record in loader.read_csv(path):
+        _, bucket, digest, _ = _fingerprint(table, record)
+        counts[bucket] += 1
+        sums[bucket] = (sums[bucket] + digest) & _MASK
+    return {b: (counts[b], _signed(sums[b])) for b in range(BUCKETS) if counts[b]}
+
+
+def _stored_buckets(conn: pg.Connection, table: str) -> dict[int, tuple[int, int]]:
+    rows = conn.execute("SELECT bucket, row_count, digest FROM load_buckets WHERE table_name = %s",
+                        (table,)).fetchall()
+    return {bucket: (count, digest) for bucket, count, digest in rows}
+
+
+class Delta:
+    """
+    the difference between the rows of one table and a new csv file
+    """
+
+    def __init__(self, table: str, path: str):
+        self.table = table
+        self.path = path
+        self.buckets = {}
+        self.changed = []
+        # key -> row, key -> row, keys
+        self.inserts = {}
+        self.updates = {}
+        self.deletes = []
+        # key -> (bucket, digest) for the changed buckets of the new file
+        self.digests = {}
+
+    def report(self) -> dict:
+        return {
+            'inserted': len(self.inserts),
+            'updated': len(self.updates),
+            'deleted': len(self.deletes),
+            'changed_buckets': len(self.changed),
+            'buckets': BUCKETS,
+        }
+
+
+def diff(conn: pg.Connection, table: str, path: str) -> Delta:
+    """
+    compare a csv file with what was last applied to table
+    :return: the rows to insert, update and delete
+    """
+    delta = Delta(table, path)
+    stored = _stored_buckets(conn, table)
+    if not stored:
+        raise ValueError(f"no fingerprints for {table}, run 'python delta.py baseline' after a full load")
+
+    delta.buckets = _file_buckets(table, path)
+    delta.changed = sorted(b for b in set(stored) | set(delta.buckets) if stored.get(b) != delta.buckets.get(b))
+    if not delta.changed:
+        return delta
+
+    # rows of the changed buckets, new file side
+    changed = set(delta.changed)
+    rows = {}
+    for record in loader.read_csv(path):
+        key, bucket, digest, row = _fingerprint(table, record)
+        if bucket in changed:
+            rows[key] = row
+            delta.digests[key] = (bucket, _signed(digest))
+
+    # and database side
+    old = {}
+    cur = conn.cursor()
+    cur.execute("SELECT key, digest FROM load_fingerprints WHERE table_name = %s AND bucket = ANY(%s)",
+                (table, delta.changed))
+    for key, digest in cur:
+        old[key] = digest
+    cur.close()
+    conn.commit()
+
+    for key, row in rows.items():
+        if key not in old:
+            delta.inserts[key] = row
+        elif old[key] != delta.digests[key][1]:
+            delta.updates[key] = row
+    delta.deletes = [key for key in old if key not in rows]
+    return delta
+
+
+def _delete(cur: pg.Cursor, table: str, keys: list[str]) -> int:
+    """
+    delete rows by key, keeping the summaries in step
+    """
+    deleted = 0
+    if table == 'ratings':
+        for key in keys:
+            user_id, isbn = key.split(';', 1)
+            cur.execute("DELETE FROM ratings WHERE user_id = %s AND isbn = %s RETURNING book_rating",
+                        (int(user_id), isbn))
+            for (rating,) in cur.fetchall():
+                summaries.add_review(cur, int(user_id), isbn, rating, sign=-1)
+                deleted += 1
+    elif table == 'books':
+        summaries.move_ratings(cur, keys, sign=-1)
+        cur.execute("DELETE FROM books WHERE isbn = ANY(%s) RETURNING author", (keys,))
+        for (author,) in cur.fetchall():
+            summaries.add_book(cur, author, sign=-1)
+            deleted += 1
+    else:
+        cur.execute("DELETE FROM users WHERE user_id = ANY(%s)", ([int(key) for key in keys],))
+        deleted = cur.rowcount
+    return deleted
+
+
+def _upsert(cur: pg.Cursor, table: str, rows: list[list]) -> None:
+    """
+    insert rows, replacing the existing row with the same key
+    """
+    if table == 'ratings':
+        for user_id, isbn, rating in rows:
+            cur.execute("SELECT book_rating FROM ratings WHERE user_id = %s AND isbn = %s", (int(user_id), isbn))
+            old = cur.fetchone()
+            cur.execute("""
+                INSERT INTO ratings VALUES (%s, %s, %s)
+                ON CONFLICT (user_id, isbn) DO UPDATE
+                SET book_rating = excluded.book_rating;
+                """, (user_id, isbn, rating))
+            rating = None if rating is None else int(rating)
+            if old is None:
+                summaries.add_review(cur, int(user_id), isbn, rating)
+            else:
+                summaries.change_review(cur, int(user_id), isbn, old[0], rating)
+    elif table == 'books':
+        isbns = [row[0] for row in rows]
+        cur.execute("SELECT isbn, author FROM books WHERE isbn = ANY(%s)", (isbns,))
+        for _, author in cur.fetchall():
+            summaries.add_book(cur, author, sign=-1)
+        # a new title or author takes the book's ratings with it
+        summaries.move_ratings(cur, isbns, sign=-1)
+        cur.executemany("""
+            INSERT INTO books VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (isbn) DO UPDATE
+            SET title = excluded.title, author = excluded.author, year = excluded.year,
+                publisher = excluded.publisher, small = excluded.small, medium = excluded.medium,
+                large = excluded.large;
+            """, rows)
+        for row in rows:
+            summaries.add_book(cur, row[2])
+        summaries.move_ratings(cur, isbns)
+    else:
+        cur.executemany("""
+            INSERT INTO users VALUES (%s, %s, %s)
+            ON CONFLICT (user_id) DO UPDATE
+            SET location = excluded.location, age = excluded.age;
+            """, rows)
+
+
+def _save_fingerprints(cur: pg.Cursor, delta: Delta) -> None:
+    table = delta.table
+    cur.execute("DELETE FROM load_fingerprints WHERE table_name = %s AND bucket = ANY(%s)",
+                (table, delta.changed))
+    cur.execute("DELETE FROM load_buckets WHERE table_name = %s AND bucket = ANY(%s)",
+                (table, delta.changed))
+    cur.executemany("INSERT INTO load_fingerprints VALUES (%s, %s, %s, %s)",
+                    [(table, bucket, key, digest) for key, (bucket, digest) in delta.digests.items()])
+    cur.executemany("INSERT INTO load_buckets VALUES (%s, %s, %s, %s)",
+                    [(table, b, *delta.buckets[b]) for b in delta.changed if b in delta.buckets])
+
+
+def apply(conn: pg.Connection, deltas: list[Delta]) -> dict:
+    """
+    apply the deltas of several tables in one transaction: inserts and
+    updates parents first, deletes children first
+    :return: change report, table -> counts
+    """
+    deltas = sorted(deltas, key=lambda d: ORDER.index(d.table))
+    report = {}
+    cur = conn.cursor()
+    try:
+        for delta in reversed(deltas):
+            if delta.deletes:
+                _delete(cur, delta.table, delta.deletes)
+        for delta in deltas:
+            rows = list(delta.inserts.values()) + list(delta.updates.values())
+            if rows:
+                _upsert(cur, delta.table, rows)
+            if delta.changed:
+                _save_fingerprints(cur, delta)
+            report[delta.table] = delta.report()
+        conn.commit()
+    except pg.Error as e:
+        conn.rollback()
+        print(f"Error: nothing was applied, {e}")
+        raise
+    finally:
+        cur.close()
+
+    changed = [d.table for d in deltas if d.inserts or d.updates or d.deletes]
+    if changed:
+        query_cache.invalidate(*changed)
+    return report
+
+
+def baseline(conn: pg.Connection, table: str, path: str) -> int:
+    """
+    record the fingerprints of the file table was just fully loaded from
+    :return: number of rows fingerprinted
+    """
+    conn.execute(ct)
+    conn.execute("DELETE FROM load_fingerprints WHERE table_name = %s", (table,))
+    conn.execute("DELETE FROM load_buckets WHERE table_name = %s", (table,))
+    conn.commit()
+
+    counts = [0] * BUCKETS
+    sums = [0] * BUCKETS
+
+    def rows():
+        for record in loader.read_csv(path):
+            key, bucket, digest, _ = _fingerprint(table, record)
+            counts[bucket] += 1
+            sums[bucket] = (sums[bucket] + digest) & _MASK
+            yield table, bucket, key, _signed(digest)
+
+    loaded = loader.copy_rows(conn, 'load_fingerprints', rows(), progress=False)
+    conn.cursor().executemany("INSERT INTO load_buckets VALUES (%s, %s, %s, %s)",
+                              [(table, b, counts[b], _signed(sums[b])) for b in range(BUCKETS) if counts[b]])
+    conn.commit()
+    return loaded
+
+
+def refresh(conn: pg.Connection, data_dir: str, tables: list[str] = None) -> dict:
+    """
+    bring the tables in line with the csv files of data_dir (books.csv,
+    users.csv, ratings.csv), applying only the rows that changed
+    :return: change report
+    """
+    start = time.perf_counter()
+    conn.execute(ct)
+    conn.commit()
+    deltas = [diff(conn, table, os.path.join(data_dir, f"{table}.csv")) for table in tables or ORDER]
+    report = apply(conn, deltas)
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    return report
+
+
+if __name__ == "__main__":
+    # python delta.py baseline .       after a full load
+    # python delta.py refresh new_data/ --report changes.json
+    parser = argparse.ArgumentParser(description="incremental refresh of books, users and ratings from csv files")
+    parser.add_argument('command', choices=['baseline', 'refresh'])
+    parser.add_argument('data_dir', help="directory with books.csv, users.csv and ratings.csv")
+    parser.add_argument('--table', action='append', choices=ORDER, help="only these tables (repeatable)")
+    parser.add_argument('--report', help="write the change report as json")
+    args = parser.parse_args()
+
+    import connect_books as cb
+    with cb.connection() as conn:
+        if args.command == 'baseline':
+            result = {table: baseline(conn, table, os.path.join(args.data_dir, f"{table}.csv"))
+                      for table in args.table or ORDER}
+        else:
+            result = refresh(conn, args.data_dir, args.table)
+
+    print(json.dumps(result, indent=2))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(result, f, indent=2)
@@ -0,0 +1,240 @@
+import argparse
+import csv
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg as pg
+from psycopg import sql
+
+import connect_books as cb
+import sqlite_backend
+
+# full-dataset reports, what get_avg_rating_by_author and
+# get_books_avg_rating answer one at a time, for every author or book in one
+# set based pass over books and the rating summaries. Each report is cut in
+# key ranges (percentiles of its key) and every range is written by its own
+# connection with COPY (...) TO STDOUT straight into a part file, all reading
+# the same exported snapshot so the parts are consistent with each other.
+#
+#   python export.py authors out/ -j 8
+#   python export.py books out/ --format parquet
+#
+# the averages come from book_rating_stats, rebuild it after a bulk load
+# (python summaries.py rebuild)
+REPORTS = {
+    # same grouping as get_avg_rating_by_author: author_key, the number of
+    # books counts unrated ones too
+    'authors': ('author_key', """
+        SELECT b.author_key, min(b.author) AS author, count(*) AS books,
+               coalesce(sum(s.rating_count), 0) AS ratings,
+               round(sum(s.rating_sum)::numeric / nullif(sum(s.rating_count), 0), 1) AS avg_rating
+        FROM books b LEFT JOIN book_rating_stats s USING (isbn)
+        WHERE b.author_key IS NOT NULL {range}
+        GROUP BY b.author_key
+        ORDER BY b.author_key
+        """),
+    # same grouping as get_books_avg_rating: title, author
+    'books': ('title_key', """
+        SELECT min(b.title_key) AS title_key, b.title, b.author, count(*) AS editions,
+               coalesce(sum(s.rating_count), 0) AS ratings,
+               round(sum(s.rating_sum)::numeric / nullif(sum(s.rating_count), 0), 1) AS avg_rating
+        FROM books b LEFT JOIN book_rating_stats s USING (isbn)
+        WHERE b.title_key IS NOT NULL {range}
+        GROUP BY b.title, b.author
+        ORDER BY 1, b.title, b.author
+        """),
+}
+
+# parquet column types, the csv parts are converted with these
+TYPES = {
+    'author_key': 'string', 'author': 'string', 'title_key': 'string', 'title': 'string',
+    'books': 'int64', 'editions': 'int64', 'ratings': 'int64', 'avg_rating': 'float64',
+}
+
+BUFFER_BYTES = 1 << 20
+
+
+def key_ranges(conn: pg.Connection, key: str, parts: int) -> list[tuple[str | None, str | None]]:
+    """
+    cut the values of books.key in about parts ranges of equal size
+    :return: [lo, hi) bounds in byte order, None for open ends
+    """
+    if parts <= 1:
+        return [(None, None)]
+    fractions = [i / parts for i in range(1, parts)]
+    cmd = sql.SQL("SELECT percentile_disc(%s::float8[]) WITHIN GROUP (ORDER BY {}) FROM books").format(
+        sql.Identifier(key))
+    bounds = conn.execute(cmd, (fractions,)).fetchone()[0] or []
+    conn.rollback()
+    # ranges compare bytewise (~>=~, ~<~), sort the same way, python
+    # compares code points which is utf-8 byte order
+    bounds = sorted(set(b for b in bounds if b))
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def _range_query(report: str, lo: str | None, hi: str | None) -> tuple[str, list]:
+    key, cmd = REPORTS[report]
+    where = []
+    params = []
+    if lo is not None:
+        where.append(f"AND b.{key} ~>=~ %s")
+        params.append(lo)
+    if hi is not None:
+        where.append(f"AND b.{key} ~<~ %s")
+        params.append(hi)
+    return cmd.format(range=' '.join(where)), params
+
+
+def _pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.csv as pacsv
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("parquet export needs pyarrow (pip install pyarrow)") from None
+    return pa, pacsv, pq
+
+
+def _to_parquet(csv_path: str, path: str) -> None:
+    pa, pacsv, pq = _pyarrow()
+    with open(csv_path, 'rb') as f:
+        columns = f.readline().decode('utf-8').strip().split(',')
+    # NULL is an empty field in COPY csv, an empty string is ""
+    convert = pacsv.ConvertOptions(column_types={c: pa.type_for_alias(TYPES[c]) for c in columns},
+                                   strings_can_be_null=True, quoted_strings_can_be_null=False)
+    reader = pacsv.open_csv(csv_path, convert_options=convert)
+    with pq.ParquetWriter(path, reader.schema) as writer:
+        # batch by batch, memory stays flat whatever the part size
+        for batch in reader:
+            writer.write_batch(batch)
+    os.remove(csv_path)
+
+
+def _export_range(info: str, snapshot: str | None, report: str, lo: str | None, hi: str | None,
+                  path: str, fmt: str) -> tuple[int, int, float]:
+    """
+    write one key range of a report to path, on its own connection
+    :return: rows, csv bytes, seconds
+    """
+    start = time.perf_counter()
+    cmd, params = _range_query(report, lo, hi)
+    csv_path = path if fmt == 'csv' else path + '.csv'
+    # autocommit, so the transaction is opened (and given the snapshot) here
+    conn = pg.connect(info, autocommit=True)
+    try:
+        conn.execute("BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY")
+        if snapshot:
+            conn.execute(sql.SQL("SET TRANSACTION SNAPSHOT {}").format(sql.Literal(snapshot)))
+        nbytes = 0
+        cur = conn.cursor()
+        with open(csv_path, 'wb', buffering=BUFFER_BYTES) as f, \
+                cur.copy(f"COPY ({cmd}) TO STDOUT (FORMAT csv, HEADER)", params) as copy:
+            for data in copy:
+                f.write(data)
+                nbytes += len(data)
+        rows = cur.rowcount
+        conn.execute("ROLLBACK")
+    finally:
+        conn.close()
+    if fmt == 'parquet':
+        _to_parquet(csv_path, path)
+    return rows, nbytes, time.perf_counter() - start
+
+
+def _export_sqlite(conn, report: str, path: str, fmt: str) -> tuple[int, int, float]:
+    # a local snapshot: no COPY and one writer, stream the rows through csv
+    start = time.perf_counter()
+    cmd, _ = _range_query(report, None, None)
+    cmd = cmd.replace('::numeric', ' * 1.0')
+    csv_path = path if fmt == 'csv' else path + '.csv'
+    rows = 0
+    cur = conn.execute(cmd)
+    header = [d[0] for d in cur.description]
+    with open(csv_path, 'w', newline='', encoding='utf-8', buffering=BUFFER_BYTES) as f:
+        out = csv.writer(f)
+        out.writerow(header)
+        for row in cur:
+            out.writerow(row)
+            rows += 1
+    nbytes = os.path.getsize(csv_path)
+    if fmt == 'parquet':
+        _to_parquet(csv_path, path)
+    return rows, nbytes, time.perf_counter() - start
+
+
+def export(conn: pg.Connection, report: str, directory: str, fmt: str = 'csv', workers: int = None) -> dict:
+    """
+    write a report as part files, <report>-000.csv (or .parquet), ... in key
+    order, each with its header
+    :param conn: used for the key ranges and the snapshot
+    :param report: authors or books, see REPORTS
+    :param workers: connections writing in parallel, defaults to the number
+        of cores
+    :return: report of rows, bytes and timings per part
+    """
+    if report not in REPORTS:
+        raise ValueError(f"unknown report {report!r}, one of {', '.join(REPORTS)}")
+    if fmt not in ('csv', 'parquet'):
+        raise ValueError(f"unknown format {fmt!r}")
+    if fmt == 'parquet':
+        # before any work is done
+        _pyarrow()
+    os.makedirs(directory, exist_ok=True)
+    start = time.perf_counter()
+
+    if sqlite_backend.is_sqlite(conn):
+        parts = [_export_sqlite(conn, report, os.path.join(directory, f"{report}-000.{fmt}"), fmt)]
+    else:
+        workers = workers or os.cpu_count() or 1
+        ranges = key_ranges(conn, REPORTS[report][0], workers)
+        # every worker reads the snapshot of this transaction, kept open
+        # until they are done
+        conn.autocommit = True
+        try:
+            conn.execute("BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY")
+            snapshot = conn.execute("SELECT pg_export_snapshot()").fetchone()[0]
+            info = cb.conninfo()
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(_export_range, info, snapshot, report, lo, hi,
+                                       os.path.join(directory, f"{report}-{i:03}.{fmt}"), fmt)
+                           for i, (lo, hi) in enumerate(ranges)]
+                parts = [future.result() for future in futures]
+        finally:
+            conn.execute("ROLLBACK")
+            conn.autocommit = False
+
+    elapsed = time.perf_counter() - start
+    rows = sum(p[0] for p in parts)
+    nbytes = sum(p[1] for p in parts)
+    rv = {
+        'report': report,
+        'format': fmt,
+        'parts': len(parts),
+        'rows': rows,
+        'bytes': nbytes,
+        'seconds': round(elapsed, 2),
+        'rows_per_sec': round(rows / elapsed) if elapsed else 0,
+        'mb_per_sec': round(nbytes / elapsed / 1e6, 1) if elapsed else 0,
+        'part_seconds': [round(p[2], 2) for p in parts],
+    }
+    print(f"Exported {rows} {report} rows ({nbytes / 1e6:.1f} MB csv) into {len(parts)} {fmt} parts in "
+          f"{directory} in {elapsed:.1f}s ({rv['mb_per_sec']} MB/s)")
+    return rv
+
+
+if __name__ == "__main__":
+    # python export.py authors out/ -j 8
+    # python export.py books out/ --format parquet
+    parser = argparse.ArgumentParser(description="export per author or per book rating reports")
+    parser.add_argument('report', choices=list(REPORTS))
+    parser.add_argument('directory')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    with cb.connection() as conn:
+        try:
+            export(conn, args.report, args.directory, args.format, args.workers)
+        except ImportError as e:
+            print(f"Error: {e}")
@@ -0,0 +1,135 @@
+import argparse
+import csv
+import os
+import random
+from bisect import bisect_left
+from itertools import accumulate
+
+# size of the real Book-Crossing dataset, scale 1
+BOOKS = 271_379
+USERS = 278_858
+RATINGS = 1_149_780
+AUTHORS = 102_000
+PUBLISHERS = 16_800
+
+# share of ratings that are the implicit 0 ("interacted, not rated")
+IMPLICIT_SHARE = 0.62
+# explicit ratings 1..10 lean high like the real data
+EXPLICIT_WEIGHTS = [1, 1, 2, 3, 9, 7, 13, 18, 14, 15]
+
+WORDS = ("the of and a in to love night house secret life last world time dark war girl man heart "
+         "little shadow city river garden king queen death summer winter stone fire moon blood "
+         "story book wild lost home road sea star song dream memory child mother father island "
+         "truth silent murder angel empire light ghost game hunter").split()
+FIRST = ("john mary james patricia robert jennifer michael linda william elizabeth david barbara "
+         "richard susan joseph jessica thomas sarah charles karen stephen nora anne terry dean").split()
+LAST = ("smith johnson williams brown jones garcia miller davis rodriguez martinez hernandez "
+        "lopez wilson anderson thomas taylor moore jackson martin lee king grisham christie "
+        "pratchett rowling steel roberts koontz clancy").split()
+PLACES = [("new york", "new york", "usa"), ("toronto", "ontario", "canada"), ("london", "england", "united kingdom"),
+          ("berlin", "berlin", "germany"), ("madrid", "madrid", "spain"), ("sydney", "nsw", "australia"),
+          ("seattle", "washington", "usa"), ("porto", "porto", "portugal"), ("lyon", "rhone", "france")]
+
+
+def isbn10(n: int) -> str:
+    """
+    a valid ISBN-10 (with check digit) for a sequence number
+    """
+    body = f"{n % 10 ** 9:09d}"
+    check = sum((10 - i) * int(d) for i, d in enumerate(body)) % 11
+    check = (11 - check) % 11
+    return body + ('X' if check == 10 else str(check))
+
+
+def zipf_cum_weights(n: int, s: float) -> list[float]:
+    """
+    cumulative weights of a zipf(s) distribution over n ranks, for
+    random.choices(..., cum_weights=)
+    """
+    return list(accumulate(1 / (rank ** s) for rank in range(1, n + 1)))
+
+
+def generate(out_dir: str, scale: float = 1.0, seed: int = 42) -> dict:
+    """
+    write synthetic books.csv, users.csv and ratings.csv shaped like the
+    Book-Crossing dataset, the same seed and scale always give the same files
+    :param out_dir: directory the csv files are written to
+    :param scale: multiple of the real dataset size, 1 to 10
+    :param seed: random seed
+    :return: row counts written
+    """
+    rng = random.Random(seed)
+    n_books = int(BOOKS * scale)
+    n_users = int(USERS * scale)
+    n_ratings = int(RATINGS * scale)
+    n_authors = int(AUTHORS * scale)
+    n_publishers = int(PUBLISHERS * scale ** 0.5)
+    os.makedirs(out_dir, exist_ok=True)
+
+    authors = [f"{rng.choice(FIRST).title()} {rng.choice(LAST).title()} {i}" for i in range(n_authors)]
+    publishers = [f"{rng.choice(LAST).title()} {rng.choice(['Press', 'Books', 'Publishing', 'House'])} {i}"
+                  for i in range(n_publishers)]
+    # a few authors and publishers own most of the books
+    author_weights = zipf_cum_weights(n_authors, 0.9)
+    publisher_weights = zipf_cum_weights(n_publishers, 1.0)
+
+    # context manager --> automatically closes file
+    with open(os.path.join(out_dir, 'books.csv'), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, delimiter=';')
+        for i in range(n_books):
+            isbn = isbn10(i * 7919 + 100_000_000)
+            title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 6))).capitalize()
+            url = f"http://images.example.com/images/P/{isbn}"
+            writer.writerow([isbn, title,
+                             rng.choices(authors, cum_weights=author_weights)[0],
+                             rng.randint(1950, 2004),
+                             rng.choices(publishers, cum_weights=publisher_weights)[0],
+                             url + ".01.THUMBZZZ.jpg", url + ".01.MZZZZZZZ.jpg", url + ".01.LZZZZZZZ.jpg"])
+
+    with open(os.path.join(out_dir, 'users.csv'), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, delimiter=';')
+        for user_id in range(1, n_users + 1):
+            age = rng.randint(10, 90) if rng.random() < 0.6 else ''
+            writer.writerow([user_id, ', '.join(rng.choice(PLACES)), age])
+
+    # ratings per book and per user are both heavy tailed: a book is drawn
+    # from a zipf over books, a user from a zipf over a shuffled user order
+    book_weights = zipf_cum_weights(n_books, 0.6)
+    user_order = list(range(1, n_users + 1))
+    rng.shuffle(user_order)
+    user_weights = zipf_cum_weights(n_users, 0.8)
+    total_books = book_weights[-1]
+    total_users = user_weights[-1]
+
+    seen = set()
+    written = 0
+    with open(os.path.join(out_dir, 'ratings.csv'), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, delimiter=';')
+        while written < n_ratings:
+            user = user_order[bisect_left(user_weights, rng.random() * total_users)]
+            book = bisect_left(book_weights, rng.random() * total_books)
+            # one rating per (user, book) like the real data
+            key = user * n_books + book
+            if key in seen:
+                continue
+            seen.add(key)
+
+            if rng.random() < IMPLICIT_SHARE:
+                rating = 0
+            else:
+                rating = rng.choices(range(1, 11), weights=EXPLICIT_WEIGHTS)[0]
+            writer.writerow([user, isbn10(book * 7919 + 100_000_000), rating])
+            written += 1
+
+    return {'books': n_books, 'users': n_users, 'ratings': n_ratings}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="generate a synthetic Book-Crossing style dataset")
+    parser.add_argument('out_dir', nargs='?', default='bench_data')
+    parser.add_argument('--scale', type=float, default=1.0, help="1 is the size of the real dataset, up to 10")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    counts = generate(args.out_dir, args.scale, args.seed)
+    print(f"Wrote {counts['books']} books, {counts['users']} users and {counts['ratings']} ratings to {args.out_dir}")
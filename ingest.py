@@ -0,0 +1,333 @@
+import argparse
+import csv
+import hashlib
+import re
+import time
+from collections import Counter
+
+import loader
+
+# validating front end for the loaders, one streaming pass over a raw
+# Book-Crossing csv file:
+#   decode     bytes -> text, utf-8 with a cp1252 fallback per line
+#   parse      text -> records (';' delimited, \" escaped quotes)
+#   normalize  isbns, whitespace, empty fields
+#   coerce     numbers and their ranges
+#   dedupe     first row of every key wins
+#   exists     the book and user of a rating are loaded (the foreign keys)
+# a row that fails a stage goes to the reject file with the stage and the
+# reason, the rest are yielded to the loader. Memory is bounded by the dedupe
+# set, one 64 bit hash per distinct key, and the keys of books and users when
+# ratings are checked, not by the file.
+STAGES = ['decode', 'parse', 'normalize', 'coerce', 'dedupe', 'exists']
+
+# table -> (columns, key columns)
+TABLES = {
+    'books': (['isbn', 'title', 'author', 'year', 'publisher', 'small', 'medium', 'large'], [0]),
+    'users': (['user_id', 'location', 'age'], [0]),
+    'ratings': (['user_id', 'isbn', 'book_rating'], [0, 1]),
+}
+
+# table -> the columns that reference another table, and that table
+REFERENCES = {
+    'ratings': [('user_id', 'users'), ('isbn', 'books')],
+}
+
+_isbn_junk = re.compile(r'[\s\-.]')
+_isbn10 = re.compile(r'^\d{9}[\dX]$')
+_isbn13 = re.compile(r'^\d{13}$')
+
+MAX_YEAR = int(time.strftime('%Y')) + 1
+
+
+class Reject(Exception):
+    """
+    a row is dropped, reason is what the counters group by
+    """
+
+    def __init__(self, reason: str, value: str = None):
+        super().__init__(reason if value is None else f"{reason} {value!r}")
+        self.reason = reason
+
+
+def normalize_isbn(value: str) -> str:
+    """
+    ' 0-19-852663-6 ' -> '0198526636', raises Reject if it is not an isbn-10
+    or isbn-13 once separators are removed (check digits are not verified,
+    the dataset has many books with wrong ones)
+    """
+    isbn = _isbn_junk.sub('', value).upper()
+    if not (_isbn10.match(isbn) or _isbn13.match(isbn)):
+        raise Reject("bad isbn", value)
+    return isbn
+
+
+def _int(value: str, name: str) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        raise Reject(f"{name} is not a number", value) from None
+
+
+def _decode(lines, stats):
+    """
+    bytes lines -> text lines
+    """
+    for line in lines:
+        try:
+            yield line.decode('utf-8')
+        except UnicodeDecodeError:
+            # the original dump mixes in latin-1/cp1252 text
+            stats.fixed['decode: cp1252 line'] += 1
+            yield line.decode('cp1252', errors='replace')
+
+
+class Stats:
+    """
+    rows in/out, rejects and time spent per stage
+    """
+
+    def __init__(self):
+        self.rows_in = Counter()
+        self.rows_out = Counter()
+        self.seconds = Counter()
+        self.reasons = Counter()
+        self.fixed = Counter()
+
+    def report(self) -> dict:
+        rv = {}
+        for stage in STAGES:
+            seconds = self.seconds[stage]
+            rv[stage] = {'in': self.rows_in[stage], 'out': self.rows_out[stage],
+                         'seconds': round(seconds, 3),
+                         'rows_per_sec': round(self.rows_in[stage] / seconds) if seconds else None}
+        return {'stages': rv, 'rejects': dict(self.reasons.most_common()), 'fixed': dict(self.fixed)}
+
+    def print(self) -> None:
+        print(f"{'Stage':>10} {'In':>10} {'Out':>10} {'Seconds':>9} {'Rows/sec':>12}")
+        for stage, s in self.report()['stages'].items():
+            rate = f"{s['rows_per_sec']:,}" if s['rows_per_sec'] else '-'
+            print(f"{stage:>10} {s['in']:>10} {s['out']:>10} {s['seconds']:>9.2f} {rate:>12}")
+        for reason, count in self.reasons.most_common(10):
+            print(f"{count:>10}  rejected: {reason}")
+        for fix, count in self.fixed.most_common():
+            print(f"{count:>10}  fixed: {fix}")
+
+
+class Ingest:
+    """
+    validate a raw csv file for one table
+
+    for row in Ingest('ratings', 'ratings.csv', 'rejects.csv').rows(): ...
+    """
+
+    def __init__(self, table: str, path: str, rejects: str = None, skip_header: bool = None,
+                 known: dict[str, set] = None):
+        """
+        :param known: column -> the values it may take, see known_keys, the
+            exists stage passes every row when None
+        """
+        self.table = table
+        self.path = path
+        self.rejects = rejects
+        self.columns, self.keys = TABLES[table]
+        # None: skip the first record if it looks like a header
+        self.skip_header = skip_header
+        self.stats = Stats()
+        self.known = known
+        self._seen = set()
+
+    def _normalize(self, record: list) -> list:
+        width = len(self.columns)
+        if len(record) != width:
+            raise Reject(f"expected {width} fields", str(len(record)))
+        row = [' '.join(field.split()) or None for field in record]
+        if self.table in ('books', 'ratings'):
+            i = self.columns.index('isbn')
+            if row[i] is None:
+                raise Reject("missing isbn")
+            row[i] = normalize_isbn(row[i])
+        return row
+
+    def _coerce(self, row: list) -> list:
+        if self.table == 'books':
+            if row[1] is None:
+                raise Reject("missing title")
+            if row[3] is not None:
+                year = _int(row[3], 'year')
+                # 0 stands for unknown in the dataset
+                if year <= 0 or year > MAX_YEAR:
+                    self.stats.fixed['coerce: year out of range set to NULL'] += 1
+                    year = None
+                row[3] = year
+        elif self.table == 'users':
+            row[0] = _int(row[0] or '', 'user_id')
+            if row[2] is not None:
+                if row[2].upper() == 'NULL':
+                    row[2] = None
+                else:
+                    age = _int(row[2], 'age')
+                    if not 0 < age < 120:
+                        self.stats.fixed['coerce: age out of range set to NULL'] += 1
+                        age = None
+                    row[2] = None if age is None else str(age)
+        else:
+            row[0] = _int(row[0] or '', 'user_id')
+            rating = _int(row[2] or '', 'rating')
+            if not 0 <= rating <= 10:
+                raise Reject("rating not in 0..10", str(rating))
+            row[2] = rating
+        return row
+
+    def _dedupe(self, row: list) -> list:
+        key = '\x1f'.join(str(row[i]) for i in self.keys)
+        digest = int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+        if digest in self._seen:
+            raise Reject("duplicate key")
+        self._seen.add(digest)
+        return row
+
+    def _exists(self, row: list) -> list:
+        if self.known:
+            for column, parent in REFERENCES.get(self.table, []):
+                value = row[self.columns.index(column)]
+                if value not in self.known[column]:
+                    raise Reject(f"{column} not in {parent}", str(value))
+        return row
+
+    def _records(self):
+        """
+        decode and parse, timed as two stages
+        """
+        stats = self.stats
+        with open(self.path, 'rb') as f:
+            decoded = _decode(f, stats)
+
+            def timed_lines():
+                while True:
+                    start = time.perf_counter()
+                    line = next(decoded, None)
+                    stats.seconds['decode'] += time.perf_counter() - start
+                    if line is None:
+                        return
+                    stats.rows_in['decode'] += 1
+                    stats.rows_out['decode'] += 1
+                    yield line
+
+            reader = csv.reader(timed_lines(), delimiter=';', escapechar='\\')
+            while True:
+                start = time.perf_counter()
+                # the reader pulls lines through decode, that time is decode's
+                decoding = stats.seconds['decode']
+                try:
+                    record = next(reader)
+                except StopIteration:
+                    return
+                except csv.Error as e:
+                    stats.seconds['parse'] += time.perf_counter() - start - (stats.seconds['decode'] - decoding)
+                    stats.rows_in['parse'] += 1
+                    yield reader.line_num, 'parse', str(e), []
+                    continue
+                stats.seconds['parse'] += time.perf_counter() - start - (stats.seconds['decode'] - decoding)
+                if not record:
+                    continue
+                stats.rows_in['parse'] += 1
+                stats.rows_out['parse'] += 1
+                yield reader.line_num, None, None, record
+
+    def rows(self):
+        """
+        :return: generator of clean rows in table column order
+        """
+        stages = [('normalize', self._normalize), ('coerce', self._coerce), ('dedupe', self._dedupe),
+                  ('exists', self._exists)]
+        stats = self.stats
+        out = None
+        if self.rejects:
+            out = open(self.rejects, 'w', newline='', encoding='utf-8')
+            rejects = csv.writer(out, delimiter=';')
+            rejects.writerow(['line', 'stage', 'reason', 'record'])
+        try:
+            first = True
+            for line, failed, reason, record in self._records():
+                if failed:
+                    stats.reasons[f"{failed}: {reason}"] += 1
+                    if out:
+                        rejects.writerow([line, failed, reason, ''])
+                    continue
+                if first:
+                    first = False
+                    if self.skip_header or self.skip_header is None and self._is_header(record):
+                        continue
+
+                row = record
+                for stage, func in stages:
+                    start = time.perf_counter()
+                    stats.rows_in[stage] += 1
+                    try:
+                        row = func(row)
+                    except Reject as e:
+                        stats.seconds[stage] += time.perf_counter() - start
+                        stats.reasons[f"{stage}: {e.reason}"] += 1
+                        if out:
+                            rejects.writerow([line, stage, str(e), ';'.join(record)])
+                        break
+                    stats.seconds[stage] += time.perf_counter() - start
+                    stats.rows_out[stage] += 1
+                else:
+                    yield row
+        finally:
+            if out:
+                out.close()
+
+    def _is_header(self, record: list) -> bool:
+        key = record[self.keys[0]].strip().lower().replace('-', '_') if record else ''
+        return key in ('isbn', 'user_id', 'userid') or key == self.columns[self.keys[0]]
+
+
+def known_keys(conn, table: str) -> dict[str, set]:
+    """
+    the keys of the tables that rows of table reference, as loaded now
+    :return: column -> set of values, empty if table references nothing
+    """
+    known = {}
+    for column, parent in REFERENCES.get(table, []):
+        known[column] = {key for (key,) in conn.execute(f"SELECT {column} FROM {parent}")}
+    conn.commit()
+    return known
+
+
+def load(conn, table: str, path: str, rejects: str = None, resume: bool = True) -> tuple[int, Ingest]:
+    """
+    validate a raw csv file and load the clean rows with COPY, a rating of a
+    book or user that is not loaded is rejected instead of failing the COPY
+    :param rejects: file for the rejected rows and their reasons
+    :return: rows loaded and the Ingest, see its stats
+    """
+    ingest = Ingest(table, path, rejects, known=known_keys(conn, table))
+    loaded = loader.copy_rows(conn, table, ingest.rows(), columns=ingest.columns, source=path, resume=resume)
+    return loaded, ingest
+
+
+if __name__ == "__main__":
+    # python ingest.py ratings BX-Book-Ratings.csv --rejects rejects.csv
+    # python ingest.py ratings BX-Book-Ratings.csv --rejects rejects.csv --load
+    parser = argparse.ArgumentParser(description="validate (and load) a raw Book-Crossing csv file")
+    parser.add_argument('table', choices=list(TABLES))
+    parser.add_argument('path')
+    parser.add_argument('--rejects', help="csv file for rejected rows")
+    parser.add_argument('--load', action='store_true',
+                        help="load the clean rows, otherwise only check (not against books and users)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.load:
+        import connect_books as cb
+        with cb.connection() as conn:
+            count, result = load(conn, args.table, args.path, args.rejects)
+    else:
+        result = Ingest(args.table, args.path, args.rejects)
+        count = sum(1 for _ in result.rows())
+    elapsed = time.perf_counter() - start
+    print(f"{count} clean rows in {elapsed:.1f}s")
+    result.stats.print()
@@ -0,0 +1,252 @@
+import logging
+import os
+import statistics
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg as pg
+
+# BOOKS_INSTRUMENT=0 turns the cursor wrappers off, BOOKS_SLOW_MS sets the slow
+# query threshold and BOOKS_EXPLAIN=1 adds EXPLAIN (ANALYZE, BUFFERS) plans of
+# slow queries to the slow query log
+ENABLED = os.environ.get('BOOKS_INSTRUMENT', '1') != '0'
+SLOW_MS = float(os.environ.get('BOOKS_SLOW_MS', 200))
+EXPLAIN = os.environ.get('BOOKS_EXPLAIN', '0') == '1'
+SLOW_LOG = os.environ.get('BOOKS_SLOW_LOG', 'slow_queries.log')
+
+# most recent queries as dicts of label, sql, seconds, rows, bytes
+records = deque(maxlen=10_000)
+# menu option (or other label) -> seconds of its most recent calls, and the
+# number of calls (a long running service would otherwise grow without bound)
+MAX_SAMPLES = 10_000
+_timings = {}
+_counts = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+_slow_log = None
+
+
+def slow_log() -> logging.Logger:
+    global _slow_log
+    if _slow_log is None:
+        log = logging.getLogger('books.slow_queries')
+        if not log.handlers:
+            handler = logging.FileHandler(SLOW_LOG)
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            log.addHandler(handler)
+            log.setLevel(logging.INFO)
+            log.propagate = False
+        _slow_log = log
+    return _slow_log
+
+
+def current_label() -> str | None:
+    return getattr(_local, 'label', None)
+
+
+def _query_text(query, cur) -> str:
+    if isinstance(query, str):
+        return query
+    try:
+        return query.as_string(cur)
+    except (AttributeError, pg.Error):
+        return str(query)
+
+
+def _result_bytes(pgresult) -> int:
+    """
+    estimated bytes of row data in a result: the size of its first row times
+    the number of rows, so the cost does not grow with the result
+    """
+    if pgresult is None or not pgresult.ntuples:
+        return 0
+    first = sum(len(pgresult.get_value(0, col) or b'') for col in range(pgresult.nfields))
+    return first * pgresult.ntuples
+
+
+def _explain(cur: pg.Cursor, query, params) -> str | None:
+    text = _query_text(query, cur).lstrip().upper()
+    if not (text.startswith('SELECT') or text.startswith('WITH')):
+        return None
+
+    conn = cur.connection
+    try:
+        # a savepoint, so a failing EXPLAIN can't abort the caller's transaction
+        with conn.transaction():
+            explain = pg.Cursor(conn)
+            explain.execute(f"EXPLAIN (ANALYZE, BUFFERS) {_query_text(query, cur)}", params)
+            plan = '\n'.join(row[0] for row in explain.fetchall())
+            explain.close()
+        return plan
+    except pg.Error as e:
+        return f"(EXPLAIN failed: {e})"
+
+
+def record(cur, query, params, seconds: float, rows: int, nbytes: int, check: bool = True) -> dict:
+    """
+    :param check: log the query now if it is slow, False when more time is
+        added to the record later (see check_slow)
+    """
+    rec = {'label': current_label(), 'sql': _query_text(query, cur), 'seconds': seconds,
+           'rows': rows, 'bytes': nbytes}
+    records.append(rec)
+    if check:
+        check_slow(cur, rec, query, params)
+    return rec
+
+
+def check_slow(cur, rec: dict, query, params) -> None:
+    """
+    write rec to the slow query log (with its plan) if it took SLOW_MS or more
+    """
+    seconds = rec['seconds']
+    if seconds * 1000 < SLOW_MS:
+        return
+    msg = (f"{seconds * 1000:.1f} ms, {rec['rows']} rows, {rec['bytes']} bytes, option {rec['label']}: "
+           f"{' '.join(rec['sql'].split())}")
+    if EXPLAIN and isinstance(cur, (InstrumentedCursor, InstrumentedServerCursor)):
+        plan = _explain(cur, query, params)
+        if plan:
+            msg += '\n' + plan
+    slow_log().info(msg)
+
+
+class InstrumentedCursor(pg.Cursor):
+    """
+    client side cursor that records wall time, rows and bytes of every execute
+    """
+
+    def execute(self, query, params=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, params, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            record(self, query, params, elapsed, max(self.rowcount, 0), _result_bytes(self.pgresult))
+
+
+class InstrumentedServerCursor(pg.ServerCursor):
+    """
+    named cursor, the time, rows and bytes of every fetch are added to the
+    record of the query that declared it, which is checked against the slow
+    query threshold once the cursor is exhausted or closed
+    """
+
+    def execute(self, query, params=None, **kwargs):
+        self._declared = (query, params)
+        start = time.perf_counter()
+        try:
+            return super().execute(query, params, **kwargs)
+        finally:
+            self._record = record(self, query, params, time.perf_counter() - start, 0, 0, check=False)
+
+    def _fetched(self, rows: list, start: float, done: bool) -> list:
+        rec = getattr(self, '_record', None)
+        if rec is not None:
+            rec['seconds'] += time.perf_counter() - start
+            rec['rows'] += len(rows)
+            rec['bytes'] += _result_bytes(self.pgresult)
+            if done:
+                self._finish()
+        return rows
+
+    def _finish(self) -> None:
+        rec = getattr(self, '_record', None)
+        if rec is None:
+            return
+        self._record = None
+        check_slow(self, rec, *self._declared)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched([row] if row is not None else [], start, row is None)
+        return row
+
+    def fetchmany(self, size: int = 0):
+        start = time.perf_counter()
+        rows = super().fetchmany(size)
+        return self._fetched(rows, start, len(rows) < (size or self.arraysize))
+
+    def fetchall(self):
+        start = time.perf_counter()
+        return self._fetched(super().fetchall(), start, True)
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            # a cursor closed before its last row still counts what it read
+            if not self.connection.closed:
+                self._finish()
+
+
+def install(conn: pg.Connection) -> pg.Connection:
+    """
+    make every cursor of conn an instrumented one
+    """
+    if ENABLED:
+        conn.cursor_factory = InstrumentedCursor
+        conn.server_cursor_factory = InstrumentedServerCursor
+    return conn
+
+
+@contextmanager
+def timed(label: str):
+    """
+    label the queries run in the with block and record its wall time, the
+    console wraps every menu option in one
+    """
+    previous = current_label()
+    _local.label = label
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _local.label = previous
+        observe(label, time.perf_counter() - start)
+
+
+def observe(label: str, seconds: float) -> None:
+    """
+    record the wall time of one call of label
+    """
+    with _lock:
+        _timings.setdefault(label, deque(maxlen=MAX_SAMPLES)).append(seconds)
+        _counts[label] = _counts.get(label, 0) + 1
+
+
+def latency_summary() -> dict:
+    """
+    :return: label -> count, p50, p95 and max (of the last MAX_SAMPLES
+        calls) in milliseconds
+    """
+    rv = {}
+    with _lock:
+        items = {label: sorted(times) for label, times in _timings.items()}
+        counts = dict(_counts)
+    for label, times in items.items():
+        rv[label] = {
+            'count': counts[label],
+            'p50_ms': statistics.median(times) * 1000,
+            'p95_ms': times[min(int(len(times) * 0.95), len(times) - 1)] * 1000,
+            'max_ms': times[-1] * 1000,
+        }
+    return rv
+
+
+def print_summary() -> None:
+    summary = latency_summary()
+    if not summary:
+        return
+    print(f"{'Option':>8} {'Calls':>6} {'p50 ms':>10} {'p95 ms':>10} {'max ms':>10}")
+    for label in sorted(summary, key=lambda l: (len(l), l)):
+        s = summary[label]
+        print(f"{label:>8} {s['count']:>6} {s['p50_ms']:>10.1f} {s['p95_ms']:>10.1f} {s['max_ms']:>10.1f}")
+
+    queries = [r for r in records if r['seconds'] * 1000 >= SLOW_MS]
+    if queries:
+        print(f"{len(queries)} queries over {SLOW_MS:.0f} ms, see {SLOW_LOG}")
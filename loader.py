@@ -0,0 +1,205 @@
+import csv
+import time
+from itertools import islice
+
+import psycopg as pg
+import query_cache
+import sqlite_backend
+
+# progress of every load is committed together with the rows it describes, so
+# a failed load can pick up after the last committed chunk
+ct_progress = """
+        CREATE TABLE IF NOT EXISTS load_progress (
+        table_name  text PRIMARY KEY,
+        source      text NOT NULL,
+        rows_loaded bigint NOT NULL DEFAULT 0,
+        finished    boolean NOT NULL DEFAULT false,
+        updated_at  timestamptz NOT NULL DEFAULT now()
+    );
+"""
+
+DEFAULT_CHUNK_ROWS = 50_000
+
+
+def read_csv(path: str, encoding: str = 'utf-8', delimiter: str = ';', skip_header: bool = False):
+    """
+    stream the records of a csv file one at a time
+    :param path: csv file
+    :param encoding: file encoding
+    :param delimiter: field delimiter, the dataset uses ';'
+    :param skip_header: drop the first record
+    :return: generator of lists of strings
+    """
+    # context manager --> automatically closes file
+    with open(path, newline='', encoding=encoding, errors='replace') as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        if skip_header:
+            next(reader, None)
+        yield from reader
+
+
+def get_progress(conn: pg.Connection, table: str, source: str) -> int:
+    """
+    :return: number of rows already committed by an unfinished load of source
+    into table, 0 if there is nothing to resume
+    """
+    conn.execute(ct_progress)
+    row = conn.execute("SELECT source, rows_loaded, finished FROM load_progress WHERE table_name = %s",
+                       (table,)).fetchone()
+    conn.commit()
+    if row is None or row[0] != source or row[2]:
+        return 0
+    return row[1]
+
+
+def reset_progress(conn: pg.Connection, table: str) -> None:
+    """
+    forget any partial load of table, call when the table is dropped
+    """
+    if sqlite_backend.is_sqlite(conn):
+        return
+    conn.execute(ct_progress)
+    conn.execute("DELETE FROM load_progress WHERE table_name = %s", (table,))
+    conn.commit()
+
+
+def _save_progress(cur: pg.Cursor, table: str, source: str, rows: int, finished: bool) -> None:
+    cur.execute("""
+        INSERT INTO load_progress (table_name, source, rows_loaded, finished, updated_at)
+        VALUES (%s, %s, %s, %s, now())
+        ON CONFLICT (table_name) DO UPDATE
+        SET source = excluded.source,
+            rows_loaded = excluded.rows_loaded,
+            finished = excluded.finished,
+            updated_at = now();
+        """, (table, source, rows, finished))
+
+
+def copy_rows(conn: pg.Connection,
+              table: str,
+              rows,
+              columns: list[str] = None,
+              source: str = None,
+              chunk_rows: int = DEFAULT_CHUNK_ROWS,
+              resume: bool = True,
+              progress: bool = True) -> int:
+    """
+    stream rows into table with COPY FROM STDIN, committing every chunk_rows
+    rows so memory use stays flat and a failed load can be resumed
+    :param conn: connection to the database
+    :param table: target table
+    :param rows: iterable of sequences, one per record
+    :param columns: target columns, all of them in table order if None
+    :param source: name recorded for resuming (usually the file name), no
+        progress is recorded when None
+    :param chunk_rows: rows per COPY/commit
+    :param resume: skip the rows committed by a previous failed load of source
+    :param progress: print progress and rows/sec after every chunk
+    :return: number of rows loaded by this call
+    """
+    if sqlite_backend.is_sqlite(conn):
+        return insert_rows(conn, table, rows, columns, chunk_rows, progress)
+
+    skip = get_progress(conn, table, source) if source and resume else 0
+    rows = iter(rows)
+    if skip:
+        if progress:
+            print(f"Resuming {table} after {skip} rows")
+        # consume without holding anything in memory
+        for _ in islice(rows, skip):
+            pass
+
+    cols = f" ({', '.join(columns)})" if columns else ""
+    cmd = f"COPY {table}{cols} FROM STDIN"
+
+    done = skip
+    loaded = 0
+    start = time.perf_counter()
+    cur = conn.cursor()
+    try:
+        while True:
+            chunk = 0
+            with cur.copy(cmd) as copy:
+                for row in islice(rows, chunk_rows):
+                    # empty fields load as NULL, '' is not a valid year or rating
+                    copy.write_row([None if field == '' else field for field in row])
+                    chunk += 1
+            if chunk == 0:
+                break
+
+            done += chunk
+            loaded += chunk
+            if source:
+                _save_progress(cur, table, source, done, False)
+            conn.commit()
+
+            if progress:
+                elapsed = time.perf_counter() - start
+                print(f"{table}: {done} rows ({loaded / elapsed:,.0f} rows/sec)")
+
+            if chunk < chunk_rows:
+                break
+
+        if source:
+            _save_progress(cur, table, source, done, True)
+            conn.commit()
+    except pg.Error as e:
+        conn.rollback()
+        print(f"Error: load of {table} stopped after {done} rows, {e}")
+        raise
+    finally:
+        cur.close()
+        query_cache.invalidate(table)
+
+    if progress:
+        elapsed = time.perf_counter() - start
+        rate = loaded / elapsed if elapsed else 0
+        print(f"Loaded {loaded} rows into {table} in {elapsed:.1f}s ({rate:,.0f} rows/sec)")
+    return loaded
+
+
+def insert_rows(conn,
+                table: str,
+                rows,
+                columns: list[str] = None,
+                chunk_rows: int = DEFAULT_CHUNK_ROWS,
+                progress: bool = True) -> int:
+    """
+    load rows into a local sqlite snapshot, which has no COPY, with one
+    executemany and commit per chunk
+    :return: number of rows loaded
+    """
+    rows = iter(rows)
+    cols = f" ({', '.join(columns)})" if columns else ""
+    loaded = 0
+    start = time.perf_counter()
+    try:
+        while True:
+            chunk = [[None if field == '' else field for field in row] for row in islice(rows, chunk_rows)]
+            if not chunk:
+                break
+            marks = ', '.join('?' * len(chunk[0]))
+            conn.executemany(f"INSERT INTO {table}{cols} VALUES ({marks})", chunk)
+            conn.commit()
+            loaded += len(chunk)
+            if progress:
+                print(f"{table}: {loaded} rows ({loaded / (time.perf_counter() - start):,.0f} rows/sec)")
+    finally:
+        query_cache.invalidate(table)
+    return loaded
+
+
+def copy_csv(conn: pg.Connection,
+             table: str,
+             path: str,
+             columns: list[str] = None,
+             chunk_rows: int = DEFAULT_CHUNK_ROWS,
+             resume: bool = True,
+             encoding: str = 'utf-8',
+             skip_header: bool = False) -> int:
+    """
+    stream a ';' delimited csv file into table, see copy_rows
+    :return: number of rows loaded
+    """
+    return copy_rows(conn, table, read_csv(path, encoding=encoding, skip_header=skip_header),
+                     columns=columns, source=path, chunk_rows=chunk_rows, resume=resume)
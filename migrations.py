@@ -0,0 +1,361 @@
+import argparse
+import os
+import time
+
+import psycopg as pg
+from psycopg import sql
+
+import query_cache
+import sqlite_backend
+import summaries
+
+# versioned schema of the postgres database. Every migration runs once, in
+# order, and is recorded in schema_migrations. Migrations are written to be
+# safe on a database that already has (part of) what they create, so a
+# database built by the old create_table methods is adopted as is.
+# Index builds on a live table use CREATE INDEX CONCURRENTLY (on a
+# partitioned table: ON ONLY the parent, concurrently per partition, then
+# ATTACH), so reads and writes carry on while they run.
+ct = """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+        version    integer PRIMARY KEY,
+        name       text NOT NULL,
+        applied_at timestamptz NOT NULL DEFAULT now(),
+        seconds    double precision NOT NULL
+    );
+"""
+
+RATINGS_PARTITIONS = int(os.environ.get('BOOKS_RATINGS_PARTITIONS', 8))
+
+# any number, the same for every process that migrates this database
+_LOCK_ID = 4_711_001
+
+base_tables = """
+        CREATE TABLE IF NOT EXISTS books (
+        isbn varchar(10) PRIMARY KEY,
+        title text NOT NULL,
+        author    text,
+        year      numeric(4),
+        publisher text,
+        small     text,
+        medium    text,
+        large     text
+    );
+
+        CREATE TABLE IF NOT EXISTS users(
+        user_id  integer NOT NULL
+            CONSTRAINT users_pk
+            PRIMARY KEY,
+        location text,
+        age      text
+    );
+
+        CREATE TABLE IF NOT EXISTS ratings    (
+        user_id     integer
+        CONSTRAINT fk_ratings_user_id
+            REFERENCES users,
+        isbn        text
+        CONSTRAINT fk_ratings_isbn
+            REFERENCES books,
+        book_rating integer
+    );
+"""
+
+# stored search keys using the same punctuation stripping rules the
+# queries used to apply to every row, plus the indexes that serve them:
+# btree (text_pattern_ops) for equality and prefix, trigram for partial
+search_columns = r"""
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        ALTER TABLE books
+            ADD COLUMN IF NOT EXISTS author_key text
+                GENERATED ALWAYS AS (lower(regexp_replace(author, '[^\w\s]', '', 'g'))) STORED,
+            ADD COLUMN IF NOT EXISTS title_key text
+                GENERATED ALWAYS AS (lower(regexp_replace(title, '[^\w\s]', '', 'g'))) STORED;
+        CREATE INDEX IF NOT EXISTS books_author_key_idx ON books (author_key text_pattern_ops);
+        CREATE INDEX IF NOT EXISTS books_title_key_idx ON books (title_key text_pattern_ops);
+        CREATE INDEX IF NOT EXISTS books_author_key_trgm_idx ON books USING gin (author_key gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS books_title_key_trgm_idx ON books USING gin (title_key gin_trgm_ops);
+        ANALYZE books;
+"""
+
+
+def _relkind(conn: pg.Connection, table: str) -> str | None:
+    """
+    'r' table, 'p' partitioned table, None if missing
+    """
+    row = conn.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,)).fetchone()
+    return row[0] if row else None
+
+
+def build_index(conn: pg.Connection, name: str, table: str, columns: str, unique: bool = False) -> None:
+    """
+    create an index without blocking writes, conn must be in autocommit.
+    An invalid leftover of a failed concurrent build is dropped first. On a
+    partitioned table the index is created ON ONLY the parent, built
+    concurrently on every partition and attached.
+    """
+    kind = 'UNIQUE INDEX' if unique else 'INDEX'
+    row = conn.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (name,)).fetchone()
+    if row and row[0]:
+        return
+    if row:
+        conn.execute(sql.SQL("DROP INDEX CONCURRENTLY {}").format(sql.Identifier(name)))
+
+    if _relkind(conn, table) != 'p':
+        conn.execute(sql.SQL(f"CREATE {kind} CONCURRENTLY {{}} ON {{}} ({columns})").format(
+            sql.Identifier(name), sql.Identifier(table)))
+        return
+
+    conn.execute(sql.SQL(f"CREATE {kind} IF NOT EXISTS {{}} ON ONLY {{}} ({columns})").format(
+        sql.Identifier(name), sql.Identifier(table)))
+    partitions = [row[0] for row in conn.execute(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(%s) ORDER BY c.relname", (table,))]
+    for partition in partitions:
+        child = f"{partition}_{name.removeprefix(table + '_')}"
+        build_index(conn, child, partition, columns, unique)
+        attached = conn.execute("SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(%s)", (child,)).fetchone()
+        if not attached:
+            conn.execute(sql.SQL("ALTER INDEX {} ATTACH PARTITION {}").format(
+                sql.Identifier(name), sql.Identifier(child)))
+
+
+def _ratings_key(conn: pg.Connection) -> None:
+    """
+    primary key (user_id, isbn): drop rows without a key and duplicates
+    (the first row wins), build the unique index concurrently, then make it
+    the primary key, the NOT NULLs are proved by a validated CHECK first so
+    no step holds a lock for a full scan
+    """
+    if conn.execute("SELECT 1 FROM pg_constraint WHERE conrelid = 'ratings'::regclass AND contype = 'p'").fetchone():
+        return
+    with conn.transaction():
+        removed = conn.execute("""
+            DELETE FROM ratings r
+            WHERE r.user_id IS NULL OR r.isbn IS NULL
+               OR EXISTS (SELECT 1 FROM ratings d
+                          WHERE d.user_id = r.user_id AND d.isbn = r.isbn AND d.ctid < r.ctid);
+            """).rowcount
+        if removed:
+            conn.execute(summaries.rebuild_cmd)
+            print(f"ratings: removed {removed} rows without a key or duplicated")
+
+    build_index(conn, 'ratings_pkey', 'ratings', 'user_id, isbn', unique=True)
+    conn.execute("ALTER TABLE ratings ADD CONSTRAINT ratings_key_not_null "
+                 "CHECK (user_id IS NOT NULL AND isbn IS NOT NULL) NOT VALID")
+    conn.execute("ALTER TABLE ratings VALIDATE CONSTRAINT ratings_key_not_null")
+    with conn.transaction():
+        conn.execute("ALTER TABLE ratings ALTER COLUMN user_id SET NOT NULL, ALTER COLUMN isbn SET NOT NULL")
+        conn.execute("ALTER TABLE ratings DROP CONSTRAINT ratings_key_not_null")
+        conn.execute("ALTER TABLE ratings ADD CONSTRAINT ratings_pkey PRIMARY KEY USING INDEX ratings_pkey")
+
+
+def _ratings_indexes(conn: pg.Connection) -> None:
+    # the rating is in the key so averages and sums are index only scans
+    build_index(conn, 'ratings_isbn_idx', 'ratings', 'isbn, book_rating')
+    build_index(conn, 'ratings_user_id_idx', 'ratings', 'user_id, book_rating')
+
+
+def _ratings_to_move(conn: pg.Connection) -> bool:
+    """
+    True when _partition_ratings would have rows to copy
+    """
+    return _relkind(conn, 'ratings') == 'r' and \
+        conn.execute("SELECT EXISTS (SELECT 1 FROM ratings)").fetchone()[0]
+
+
+def _partition_ratings(conn: pg.Connection) -> None:
+    """
+    move ratings into a table hash partitioned by isbn. The copy, keys and
+    indexes are built on a new table while the old one stays readable
+    (writes wait), then the two are swapped in the same transaction. Writes
+    wait for the whole copy, so with rows to move this only runs as a
+    maintenance step, see migrate().
+    """
+    if _relkind(conn, 'ratings') == 'p':
+        return
+    start = time.perf_counter()
+    with conn.transaction():
+        conn.execute("""
+            CREATE TABLE ratings_part (
+            user_id     integer NOT NULL,
+            isbn        text NOT NULL,
+            book_rating integer
+        ) PARTITION BY HASH (isbn);
+            """)
+        for i in range(RATINGS_PARTITIONS):
+            conn.execute(sql.SQL("CREATE TABLE {} PARTITION OF ratings_part FOR VALUES WITH (MODULUS {}, REMAINDER {})")
+                         .format(sql.Identifier(f"ratings_p{i}"), sql.Literal(RATINGS_PARTITIONS), sql.Literal(i)))
+
+        conn.execute("LOCK TABLE ratings IN EXCLUSIVE MODE")
+        rows = conn.execute("INSERT INTO ratings_part SELECT user_id, isbn, book_rating FROM ratings").rowcount
+        conn.execute("""
+            ALTER TABLE ratings_part ADD CONSTRAINT ratings_part_pkey PRIMARY KEY (user_id, isbn);
+            CREATE INDEX ratings_part_isbn_idx ON ratings_part (isbn, book_rating);
+            CREATE INDEX ratings_part_user_id_idx ON ratings_part (user_id, book_rating);
+            ALTER TABLE ratings_part ADD CONSTRAINT fk_ratings_part_user_id FOREIGN KEY (user_id) REFERENCES users;
+            ALTER TABLE ratings_part ADD CONSTRAINT fk_ratings_part_isbn FOREIGN KEY (isbn) REFERENCES books;
+
+            DROP TABLE ratings;
+            ALTER TABLE ratings_part RENAME TO ratings;
+            ALTER TABLE ratings RENAME CONSTRAINT ratings_part_pkey TO ratings_pkey;
+            ALTER TABLE ratings RENAME CONSTRAINT fk_ratings_part_user_id TO fk_ratings_user_id;
+            ALTER TABLE ratings RENAME CONSTRAINT fk_ratings_part_isbn TO fk_ratings_isbn;
+            ALTER INDEX ratings_part_isbn_idx RENAME TO ratings_isbn_idx;
+            ALTER INDEX ratings_part_user_id_idx RENAME TO ratings_user_id_idx;
+            """)
+    conn.execute("ANALYZE ratings")
+    print(f"ratings: {rows} rows moved into {RATINGS_PARTITIONS} hash partitions in {time.perf_counter() - start:.1f}s")
+
+
+# the average of the user with the most reviews skips NULL ratings, like AVG()
+_rated_count = """
+        ALTER TABLE user_rating_stats ADD COLUMN IF NOT EXISTS rated_count bigint NOT NULL DEFAULT 0;
+
+        UPDATE user_rating_stats s
+        SET rated_count = r.rated_count
+        FROM (SELECT user_id, count(book_rating) AS rated_count FROM ratings GROUP BY user_id) r
+        WHERE r.user_id = s.user_id;
+"""
+
+
+class Migration:
+    """
+    one schema change: SQL run in a transaction, or a function of an
+    autocommit connection that manages its own transactions. offline(conn)
+    is True when up would block writes for long on this database, it then
+    waits for a maintenance run
+    """
+
+    def __init__(self, version: int, name: str, tables: list[str], up, offline=None):
+        self.version = version
+        self.name = name
+        # the tables it changes, dropping one undoes it (and what came after)
+        self.tables = tables
+        self.up = up
+        self.offline = offline
+
+    def apply(self, conn: pg.Connection) -> None:
+        if isinstance(self.up, str):
+            with conn.transaction():
+                conn.execute(self.up)
+        else:
+            self.up(conn)
+
+
+MIGRATIONS = [
+    Migration(1, 'base tables', ['books', 'users', 'ratings'], base_tables),
+    Migration(2, 'books search columns', ['books'], search_columns),
+    Migration(3, 'summary tables', ['books', 'ratings'], summaries.ct + summaries.rebuild_cmd),
+    Migration(4, 'books isbn as text (isbn-13)', ['books'], "ALTER TABLE books ALTER COLUMN isbn TYPE text"),
+    Migration(5, 'ratings primary key (user_id, isbn)', ['ratings'], _ratings_key),
+    Migration(6, 'ratings covering indexes', ['ratings'], _ratings_indexes),
+    Migration(7, 'ratings hash partitioned by isbn', ['ratings'], _partition_ratings, offline=_ratings_to_move),
+    Migration(8, 'ratings per title and author summary', ['books', 'ratings'],
+              summaries.ct + summaries.work_rebuild_cmd),
+    Migration(9, 'non-NULL ratings per user', ['ratings'], _rated_count),
+]
+
+
+def applied(conn: pg.Connection) -> dict[int, tuple[str, object]]:
+    """
+    :return: version -> (name, applied_at)
+    """
+    conn.execute(ct)
+    rows = conn.execute("SELECT version, name, applied_at FROM schema_migrations").fetchall()
+    conn.commit()
+    return {version: (name, at) for version, name, at in rows}
+
+
+def migrate(conn: pg.Connection, target: int = None, verbose: bool = False,
+            maintenance: bool = False) -> list[int]:
+    """
+    apply the pending migrations up to target (all by default), one at a
+    time, under an advisory lock so two processes never migrate together.
+    Migrating stops before a migration that would block writes for long
+    unless maintenance is set (python migrations.py migrate --maintenance)
+    :return: versions applied
+    """
+    if sqlite_backend.is_sqlite(conn):
+        # a snapshot is created with its final schema
+        sqlite_backend.create_schema(conn)
+        return []
+
+    done = applied(conn)
+    pending = [m for m in MIGRATIONS if m.version not in done and (target is None or m.version <= target)]
+    if not pending:
+        return []
+
+    rv = []
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        conn.execute("SELECT pg_advisory_lock(%s)", (_LOCK_ID,))
+        try:
+            # someone else may have migrated while we waited
+            done = applied(conn)
+            for migration in pending:
+                if migration.version in done:
+                    continue
+                if not maintenance and migration.offline and migration.offline(conn):
+                    print(f"{migration.version}: {migration.name} blocks writes while it runs, "
+                          f"apply it in a maintenance window with python migrations.py migrate --maintenance")
+                    break
+                start = time.perf_counter()
+                if verbose:
+                    print(f"{migration.version}: {migration.name} ...")
+                migration.apply(conn)
+                conn.execute("INSERT INTO schema_migrations (version, name, seconds) VALUES (%s, %s, %s)",
+                             (migration.version, migration.name, time.perf_counter() - start))
+                rv.append(migration.version)
+                if verbose:
+                    print(f"{migration.version}: done in {time.perf_counter() - start:.1f}s")
+        finally:
+            conn.execute("SELECT pg_advisory_unlock(%s)", (_LOCK_ID,))
+    finally:
+        conn.autocommit = autocommit
+        query_cache.invalidate('books', 'users', 'ratings')
+    return rv
+
+
+def drop(conn: pg.Connection, table: str) -> None:
+    """
+    drop a table and set the schema back to the version before the first
+    migration that built it, the next migrate() creates it again and
+    reapplies every later migration in order (they all tolerate what is
+    already there)
+    """
+    conn.execute(f"DROP TABLE IF EXISTS {table}")
+    if not sqlite_backend.is_sqlite(conn):
+        conn.execute(ct)
+        first = min(m.version for m in MIGRATIONS if table in m.tables)
+        conn.execute("DELETE FROM schema_migrations WHERE version >= %s", (first,))
+    conn.commit()
+    query_cache.invalidate(table)
+
+
+if __name__ == "__main__":
+    # python migrations.py status
+    # python migrations.py migrate [--to 6]
+    parser = argparse.ArgumentParser(description="versioned schema migrations")
+    parser.add_argument('command', choices=['status', 'migrate'])
+    parser.add_argument('--to', type=int, help="stop after this version")
+    parser.add_argument('--maintenance', action='store_true',
+                        help="also apply migrations that block writes while they run")
+    args = parser.parse_args()
+
+    import connect_books as cb
+    with cb.connection() as conn:
+        if args.command == 'migrate':
+            versions = migrate(conn, args.to, verbose=True, maintenance=args.maintenance)
+            print(f"Applied {versions}" if versions else "Nothing to apply")
+        else:
+            done = applied(conn)
+            for m in MIGRATIONS:
+                if m.version in done:
+                    state = f"applied {done[m.version][1]:%Y-%m-%d %H:%M}"
+                elif m.offline and m.offline(conn):
+                    state = "pending, needs --maintenance"
+                else:
+                    state = "pending"
+                print(f"{m.version:>3} {m.name:40} {state}")
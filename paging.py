@@ -0,0 +1,113 @@
+import itertools
+
+import psycopg as pg
+
+DEFAULT_BATCH = 500
+
+# server-side cursor names only need to be unique per connection
+_cursor_ids = itertools.count()
+
+
+def stream(conn: pg.Connection, cmd: str, params: tuple = (), batch_size: int = DEFAULT_BATCH):
+    """
+    iterate over the rows of a query through a named server-side cursor, so
+    only batch_size rows are ever held on the client
+    :param conn: connection to the database, must not be in autocommit
+    :param cmd: query
+    :param params: query parameters
+    :param batch_size: rows per fetchmany round trip
+    :return: generator of rows
+    """
+    with conn.cursor(name=f"stream_{next(_cursor_ids)}") as cur:
+        cur.execute(cmd, params)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+
+
+def fetch_page(conn: pg.Connection, cmd: str, params: tuple, size: int) -> list:
+    """
+    fetch the first size rows of a query through a named server-side cursor,
+    postgres plans cursors for fast start so an index in ORDER BY order is
+    used instead of sorting the whole result
+    :return: list of at most size rows
+    """
+    return list(itertools.islice(stream(conn, cmd, params, size), size))
+
+
+def borrowing(read, fetch):
+    """
+    turn fetch(conn, after, size) into a KeysetPager fetch that borrows a
+    connection for the one page only, so none is held while the user reads
+    :param read: read(func, *args) runs func(conn, *args) on a lent
+        connection, e.g. connect_books.read, which retries a page whose
+        replica went away
+    """
+    def fetch_page(after, size):
+        return read(fetch, after, size)
+    return fetch_page
+
+
+class KeysetPager:
+    """
+    page through an ordered result without OFFSET
+
+    fetch(after, size) returns up to size rows that sort after the key
+    after (None for the first page), key(row) gives a row's sort key. Only
+    the start key of every page seen so far is kept, so going back a page
+    is a fresh (cheap) keyset query too.
+    """
+
+    def __init__(self, fetch, key, page_size: int, limit: int = None):
+        self.fetch = fetch
+        self.key = key
+        self.page_size = max(page_size, 1)
+        self.limit = limit
+        self._starts = [None]
+        self._rows = None
+        self._more = False
+
+    @property
+    def page_number(self) -> int:
+        return len(self._starts)
+
+    def _size(self) -> int:
+        if self.limit is None:
+            return self.page_size
+        return max(min(self.page_size, self.limit - (len(self._starts) - 1) * self.page_size), 0)
+
+    def rows(self) -> list:
+        """
+        :return: the rows of the current page
+        """
+        if self._rows is None:
+            size = self._size()
+            # one extra row tells whether there is a next page
+            rows = self.fetch(self._starts[-1], size + 1) if size else []
+            self._more = len(rows) > size and (self.limit is None or
+                                               len(self._starts) * self.page_size < self.limit)
+            self._rows = rows[:size]
+        return self._rows
+
+    def has_next(self) -> bool:
+        self.rows()
+        return self._more
+
+    def has_prev(self) -> bool:
+        return len(self._starts) > 1
+
+    def next(self) -> bool:
+        if not self.has_next():
+            return False
+        self._starts.append(self.key(self._rows[-1]))
+        self._rows = None
+        return True
+
+    def prev(self) -> bool:
+        if not self.has_prev():
+            return False
+        self._starts.pop()
+        self._rows = None
+        return True
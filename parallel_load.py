@@ -0,0 +1,245 @@
+import argparse
+import csv
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import psycopg as pg
+from psycopg import sql
+
+import connect_books as cb
+import loader
+import query_cache
+import sqlite_backend
+
+# parallel COPY of one csv file over several connections. The file is cut in
+# byte ranges that start on a line boundary (the dataset has one record per
+# line) and every range is loaded by its own process. Secondary indexes and
+# foreign keys of the table are dropped for the load and rebuilt afterwards,
+# their definitions are kept in load_deferred until then so a failed load can
+# be repaired with "python parallel_load.py restore <table>".
+ct_deferred = """
+        CREATE TABLE IF NOT EXISTS load_deferred (
+        table_name text NOT NULL,
+        kind       text NOT NULL,
+        name       text NOT NULL,
+        definition text NOT NULL,
+        PRIMARY KEY (table_name, name)
+    );
+"""
+
+
+def partitions(path: str, count: int) -> list[tuple[int, int]]:
+    """
+    split a file in about count byte ranges, each starting at the beginning
+    of a line
+    :return: (start, end) offsets, end exclusive
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, count):
+            pos = max(size * i // count, bounds[-1])
+            if pos == 0:
+                continue
+            # from the byte before, so a range already on a line start stays put
+            f.seek(pos - 1)
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def read_range(path: str, start: int, end: int, encoding: str = 'utf-8'):
+    """
+    the lines that start in [start, end)
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line.decode(encoding, errors='replace')
+
+
+def _load_partition(info: str, table: str, path: str, start: int, end: int, chunk_rows: int) -> int:
+    # runs in a worker process, with its own connection
+    conn = pg.connect(info)
+    try:
+        rows = csv.reader(read_range(path, start, end), delimiter=';')
+        return loader.copy_rows(conn, table, rows, chunk_rows=chunk_rows, progress=False)
+    finally:
+        conn.close()
+
+
+def defer(conn: pg.Connection, table: str) -> list[tuple[str, str, str]]:
+    """
+    drop the foreign keys and the indexes (other than the primary key and
+    unique constraints) of table, saving their definitions in load_deferred
+    :return: (kind, name, definition) of everything dropped
+    """
+    conn.execute(ct_deferred)
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT 'foreign key', conname, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE conrelid = %s::regclass AND contype = 'f'
+        UNION ALL
+        SELECT 'index', i.relname, pg_get_indexdef(x.indexrelid)
+        FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid
+        WHERE x.indrelid = %s::regclass AND NOT x.indisprimary
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid);
+        """, (table, table))
+    deferred = cur.fetchall()
+
+    for kind, name, definition in deferred:
+        cur.execute("INSERT INTO load_deferred VALUES (%s, %s, %s, %s) ON CONFLICT DO NOTHING",
+                    (table, kind, name, definition))
+        if kind == 'foreign key':
+            cur.execute(sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(sql.Identifier(table), sql.Identifier(name)))
+        else:
+            cur.execute(sql.SQL("DROP INDEX {}").format(sql.Identifier(name)))
+    conn.commit()
+    cur.close()
+    return deferred
+
+
+def restore(conn: pg.Connection, table: str) -> dict:
+    """
+    rebuild what defer dropped: indexes first, then the foreign keys, added
+    NOT VALID and validated in a second step so the check is one scan. A key
+    that fails validation is left NOT VALID and its orphan rows counted.
+    :return: name -> 'ok' or the validation error
+    """
+    conn.execute(ct_deferred)
+    cur = conn.cursor()
+    report = {}
+    # a partitioned table (see migrations) takes neither NOT VALID keys nor
+    # indexes ON ONLY the parent here, those would be left invalid
+    partitioned = cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = %s::regclass",
+                              (table,)).fetchone()[0]
+    for kind, name, definition in cur.execute(
+            "SELECT kind, name, definition FROM load_deferred WHERE table_name = %s ORDER BY kind DESC",
+            (table,)).fetchall():
+        if kind == 'index':
+            start = time.perf_counter()
+            cur.execute(definition.replace(' ON ONLY ', ' ON ', 1))
+            report[name] = f"rebuilt in {time.perf_counter() - start:.1f}s"
+        elif partitioned:
+            # checked as it is added, an orphan row fails it
+            try:
+                cur.execute(sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} " + definition.replace('{', '{{')
+                                    .replace('}', '}}')).format(sql.Identifier(table), sql.Identifier(name)))
+                report[name] = 'valid'
+            except pg.Error as e:
+                conn.rollback()
+                report[name] = f"NOT VALID (not added, still in load_deferred), {e}".strip()
+                continue
+        else:
+            cur.execute(sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} " + definition.replace('{', '{{').replace('}', '}}')
+                                + " NOT VALID").format(sql.Identifier(table), sql.Identifier(name)))
+        cur.execute("DELETE FROM load_deferred WHERE table_name = %s AND name = %s", (table, name))
+        conn.commit()
+
+        if kind == 'foreign key' and not partitioned:
+            try:
+                cur.execute(sql.SQL("ALTER TABLE {} VALIDATE CONSTRAINT {}").format(sql.Identifier(table),
+                                                                                     sql.Identifier(name)))
+                conn.commit()
+                report[name] = 'valid'
+            except pg.Error as e:
+                conn.rollback()
+                report[name] = f"NOT VALID, {e}".strip()
+    cur.close()
+    return report
+
+
+def count_records(path: str) -> int:
+    with open(path, 'rb') as f:
+        return sum(1 for _ in f)
+
+
+def load(conn: pg.Connection, table: str, path: str, workers: int = None,
+         chunk_rows: int = loader.DEFAULT_CHUNK_ROWS) -> dict:
+    """
+    load a ';' delimited csv file into table with workers processes, each
+    with its own connection, then rebuild the deferred indexes and keys and
+    check the result. A failed partition leaves the chunks it committed, there
+    is no resume, reload into an empty table.
+    :param conn: connection used for the schema changes and the checks
+    :param workers: processes, defaults to the number of cores
+    :return: report of rows, timings and checks
+    """
+    workers = workers or os.cpu_count() or 1
+    if sqlite_backend.is_sqlite(conn) or workers == 1:
+        # one writer only on sqlite, nothing to gain from processes
+        return {'rows': loader.copy_csv(conn, table, path)}
+
+    info = cb.conninfo()
+    start = time.perf_counter()
+    before = conn.execute(sql.SQL("SELECT count(*) FROM {}").format(sql.Identifier(table))).fetchone()[0]
+    conn.commit()
+    deferred = defer(conn, table)
+    ranges = partitions(path, workers)
+
+    loaded = 0
+    errors = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_load_partition, info, table, path, s, e, chunk_rows) for s, e in ranges]
+            for future in futures:
+                try:
+                    loaded += future.result()
+                except Exception as e:
+                    errors.append(str(e))
+        load_seconds = time.perf_counter() - start
+    finally:
+        rebuild_start = time.perf_counter()
+        constraints = restore(conn, table)
+        conn.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table)))
+        conn.commit()
+        query_cache.invalidate(table)
+
+    after = conn.execute(sql.SQL("SELECT count(*) FROM {}").format(sql.Identifier(table))).fetchone()[0]
+    conn.commit()
+    expected = count_records(path)
+    report = {
+        'rows': loaded,
+        'partitions': len(ranges),
+        'workers': workers,
+        'load_seconds': round(load_seconds, 1),
+        'rebuild_seconds': round(time.perf_counter() - rebuild_start, 1),
+        'rows_per_sec': round(loaded / load_seconds) if load_seconds else 0,
+        'deferred': [name for _, name, _ in deferred],
+        'constraints': constraints,
+        'errors': errors,
+        # every line of the file is in the table and nothing else was added
+        'consistent': not errors and loaded == expected and after - before == loaded
+                      and all(not str(v).startswith('NOT VALID') for v in constraints.values()),
+    }
+    print(f"Loaded {loaded} rows into {table} in {load_seconds:.1f}s ({report['rows_per_sec']:,} rows/sec) "
+          f"with {workers} workers, indexes and keys rebuilt in {report['rebuild_seconds']}s")
+    if not report['consistent']:
+        print(f"Error: {table} load is not consistent, file has {expected} records, table gained "
+              f"{after - before}, {errors or constraints}")
+    return report
+
+
+if __name__ == "__main__":
+    # python parallel_load.py ratings ratings.csv -j 8
+    # python parallel_load.py restore ratings
+    parser = argparse.ArgumentParser(description="parallel csv load into books, users or ratings")
+    parser.add_argument('table', help="books, users, ratings, or restore to rebuild after a failed load")
+    parser.add_argument('path', help="csv file, or the table to restore")
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-rows', type=int, default=loader.DEFAULT_CHUNK_ROWS)
+    args = parser.parse_args()
+
+    with cb.connection() as conn:
+        if args.table == 'restore':
+            print(restore(conn, args.path))
+        else:
+            print(load(conn, args.table, args.path, args.workers, args.chunk_rows))
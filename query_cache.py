@@ -0,0 +1,174 @@
+import functools
+import inspect
+import os
+import string
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import connect_books
+
+# sentinel so a cached None ("not found") can be told apart from a miss
+_MISSING = object()
+
+
+def _sizeof(obj) -> int:
+    """
+    rough deep size of a query result (lists/tuples of scalars)
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple)):
+        size += sum(_sizeof(item) for item in obj)
+    return size
+
+
+class QueryCache:
+    """
+    an LRU cache of query results bounded by entry count and approximate
+    memory, with a time to live, and invalidated per table on writes
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 32 * 1024 * 1024, ttl: float = 300):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        # key -> (value, size, expires_at, tables), least recently used first
+        self._entries = OrderedDict()
+        self._by_table = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    def _remove(self, key) -> None:
+        # caller holds the lock
+        value, size, expires, tables = self._entries.pop(key)
+        self._bytes -= size
+        for table in tables:
+            keys = self._by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return _MISSING
+            if entry[2] < time.monotonic():
+                self._remove(key)
+                self.stats['expirations'] += 1
+                self.stats['misses'] += 1
+                return _MISSING
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[0]
+
+    def put(self, key, value, tables: tuple[str, ...]) -> None:
+        if self.max_entries <= 0:
+            return
+        size = _sizeof(value)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic() + self.ttl, tables)
+            self._bytes += size
+            for table in tables:
+                self._by_table.setdefault(table, set()).add(key)
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.stats['evictions'] += 1
+
+    def invalidate(self, *tables: str) -> None:
+        """
+        drop every cached result that read from any of tables
+        """
+        with self._lock:
+            for table in tables:
+                for key in list(self._by_table.pop(table, ())):
+                    if key in self._entries:
+                        self._remove(key)
+                        self.stats['invalidations'] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._by_table.clear()
+            self._bytes = 0
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            rv = dict(self.stats)
+            rv['entries'] = len(self._entries)
+            rv['bytes'] = self._bytes
+        lookups = rv['hits'] + rv['misses']
+        rv['hit_rate'] = rv['hits'] / lookups if lookups else 0.0
+        return rv
+
+
+cache = QueryCache(max_entries=int(os.environ.get('BOOKS_CACHE_ENTRIES', 1024)),
+                   max_bytes=int(os.environ.get('BOOKS_CACHE_BYTES', 32 * 1024 * 1024)),
+                   ttl=float(os.environ.get('BOOKS_CACHE_TTL', 300)))
+
+
+def match_key(value: str) -> str:
+    """
+    normalize an author/title argument the way the queries match it:
+    punctuation removed and compared lowercase
+    """
+    return ''.join(char for char in value if char not in string.punctuation).lower()
+
+
+def cached(*tables: str, normalize=None):
+    """
+    decorator for the static query methods, caches the result keyed on the
+    method and its arguments (the connection, always first, is ignored)
+    :param tables: tables the query reads, a write to any of them drops it
+    :param normalize: applied to every string argument to build the key, it
+        must map two inputs to the same key only if the query treats them
+        the same
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(conn, *args, **kwargs):
+            # bound with the defaults filled in, f(c, q), f(c, q, 10) and
+            # f(c, q, limit=10) share an entry
+            bound = signature.bind(conn, *args, **kwargs)
+            bound.apply_defaults()
+            values = list(bound.arguments.values())[1:]
+            key = (func.__qualname__,) + tuple(
+                normalize(arg) if normalize and isinstance(arg, str) else arg for arg in values)
+            rv = cache.get(key)
+            if rv is _MISSING:
+                rv = func(conn, *args, **kwargs)
+                cache.put(key, rv, tables)
+            return rv
+
+        wrapper.uncached = func
+        return wrapper
+
+    return decorator
+
+
+def invalidate(*tables: str) -> None:
+    """
+    called after every write, also keeps this process reading from the
+    primary for a while (replicas may not have the write yet)
+    """
+    cache.invalidate(*tables)
+    connect_books.mark_written()
+
+
+def print_stats() -> None:
+    s = cache.get_stats()
+    print(f"Cache: {s['hits']} hits, {s['misses']} misses ({s['hit_rate']:.0%} hit rate), "
+          f"{s['evictions']} evictions, {s['expirations']} expired, {s['invalidations']} invalidated, "
+          f"{s['entries']} entries / {s['bytes'] / 1024:.0f} KiB")
@@ -1,42 +1,111 @@
 import csv
+import psycopg as pg
 import connect_books as cb
+import loader
+import migrations
+import paging
+import query_cache
+import summaries
 
 
 class Ratings:
 
     # class (static) data
-    dt = "DROP TABLE IF EXISTS ratings"
-    ct = """
-            CREATE TABLE ratings    (
-            user_id     integer
-            CONSTRAINT fk_ratings_user_id
-                REFERENCES users,
-            isbn        text
-            CONSTRAINT fk_ratings_isbn
-                REFERENCES books,
-            book_rating integer
-        );
-    """
     iit = "INSERT INTO ratings VALUES (?, ?, ?)"
 
-    def __init__(self, conn: cb.connect()):
-        self.conn = conn
+    # queries, shared by the sync methods below and async_queries
+    q_avg_rating_by_author = """
+        WITH num_books as (SELECT count(*) as num_books
+                            FROM books 
+                            WHERE author_key = lower(%s))
+        SELECT
+            round(AVG(book_rating), 1), num_books
+        FROM
+            books NATURAL JOIN ratings, num_books
+        WHERE
+            author_key = lower(%s)
+        GROUP BY
+            num_books
+        """
+    q_books_avg_rating = """
+        SELECT
+            round(AVG(book_rating), 1), title, author
+        FROM
+            books NATURAL JOIN ratings
+        WHERE
+            title_key = lower(%s) AND author_key = lower(%s)
+        GROUP BY
+            title, author
+        """
+    q_avg_rating_from_most_reviews = """
+        SELECT round(rating_sum::numeric / nullif(rated_count, 0), 1)
+        FROM user_rating_stats
+        WHERE review_count > 0
+        ORDER BY review_count DESC, user_id
+        LIMIT 1;
+        """
+    q_top_n_books = """
+        SELECT title, nullif(author, ''), rating_count
+        FROM work_rating_stats
+        WHERE rating_count > 0
+        ORDER BY rating_count DESC, title DESC, author DESC
+        LIMIT %s;
+        """
+    q_similar_books = """
+        SELECT b.title, b.author, round(n.score::numeric, 3)
+        FROM book_neighbors n JOIN books b ON b.isbn = n.neighbor_isbn
+        WHERE n.isbn = %s
+        ORDER BY n.score DESC
+        LIMIT %s;
+        """
+
+    def __init__(self, conn: pg.Connection = None):
+        # borrow a connection from the pool unless one was handed in
+        self.pooled = conn is None
+        self.conn = cb.get_pool().getconn() if self.pooled else conn
+
+    def close(self):
+        if self.pooled:
+            cb.get_pool().putconn(self.conn)
+            self.pooled = False
 
     def create_table(self):
-        self.conn.execute(Ratings.ct)
-        self.conn.commit()
+        # every table, see migrations (a sqlite snapshot gets its own dialect)
+        migrations.migrate(self.conn)
 
-    def load_ratings(self):
-        # context manager --> automatically closes file
-        with open('ratings.csv') as f:
-            # f = open("parts.csv")
-            reader = csv.reader(f, delimiter=';')
-            self.conn.executemany(Ratings.iit, list(reader))
-            self.conn.commit()
+    def load_ratings(self, path: str = 'ratings.csv', resume: bool = True, workers: int = 1,
+                     rejects: str = None):
+        """
+        stream ratings.csv into the ratings table with COPY, committing in chunks
+        :param path: ';' delimited csv file
+        :param resume: continue a previously failed load from its last chunk
+        :param workers: load in parallel with this many processes, see
+            parallel_load (no resume)
+        :param rejects: validate the raw file with ingest first, writing the
+            rows that fail here (always one process)
+        :return: number of rows loaded
+        """
+        if rejects:
+            import ingest
+            return ingest.load(self.conn, 'ratings', path, rejects, resume)[0]
+        if workers > 1:
+            import parallel_load
+            return parallel_load.load(self.conn, 'ratings', path, workers)['rows']
+        return loader.copy_csv(self.conn, 'ratings', path, resume=resume)
+
+    def import_reviews(self, path: str, max_rows: int = 1000):
+        """
+        add the reviews of a csv file to a loaded ratings table, group
+        committed max_rows at a time with the summaries kept in step
+        :param path: ';' delimited user_id;isbn;rating file
+        :return: the BatchWriter, its errors list the rejected rows
+        """
+        import writer
+        return writer.import_reviews(self.conn, path, max_rows)
 
     def drop_table(self):
-        self.conn.execute(Ratings.dt)
-        self.conn.commit()
+        migrations.drop(self.conn, 'ratings')
+        loader.reset_progress(self.conn, 'ratings')
 
     @staticmethod
     def remove_punctuation(input_string):
@@ -47,20 +116,24 @@ class Ratings:
 
     # insert a new review
     @staticmethod
-    def insert_review(conn: cb.connect(),
+    def insert_review(conn: pg.Connection,
                       user_id: int,
                       isbn: str,
-                      rating: int) -> None:
+                      rating: int) -> bool:
 
         # VULNERABLE TO INJECTION ATTACK
         cmd = "INSERT INTO ratings VALUES (\'" + str(user_id) + "\', \'" + isbn + "\', \'" + str(rating) + "\');"
         cur = conn.cursor()
 
         # get a cursor to execute the query
+        rv = True
         try:
             cur.execute(cmd)
+            # keep the rating summaries in step, same transaction
+            summaries.add_review(cur, user_id, isbn, rating)
         except pg.Error as e:
             print(f"Error: {e}")
+            rv = False
 
         # SAFE
         '''
@@ -83,11 +156,14 @@ class Ratings:
         '''
 
         conn.commit()
+        query_cache.invalidate('ratings')
 
         cur.close()
+        return rv
 
     @staticmethod
-    def get_avg_rating_by_author(conn: cb.connect(),
+    @query_cache.cached('books', 'ratings', normalize=query_cache.match_key)
+    def get_avg_rating_by_author(conn: pg.Connection,
                                  name: str) -> list[[float, int]] | None:
         """
         get the average rating of a book by author
@@ -97,19 +173,7 @@ class Ratings:
         """
         name = Ratings.remove_punctuation(name)
 
-        cmd = """
-            WITH num_books as (SELECT count(*) as num_books
-                                FROM books 
-                                WHERE regexp_replace(author, '[^\w\s]', '', 'g') ILIKE %s)               
-            SELECT
-                round(AVG(book_rating), 1), num_books
-            FROM
-                books NATURAL JOIN ratings, num_books
-            WHERE
-                regexp_replace(author, '[^\w\s]', '', 'g') ILIKE %s
-            GROUP BY
-                num_books
-            """
+        cmd = Ratings.q_avg_rating_by_author
 
         # get a cursor to execute the query
         cur = conn.cursor()
@@ -131,7 +195,45 @@ class Ratings:
         return rv
 
     @staticmethod
-    def get_books_avg_rating(conn: cb.connect(),
+    def get_avg_ratings_by_authors(conn: pg.Connection,
+                                   names: list[str]) -> dict[str, tuple[float, int]]:
+        """
+        get the average rating and number of books of many authors in one query
+        :param conn:
+        :param names: authors
+        :return: dict of normalized author key (see query_cache.match_key) to
+            (avg rating, number of books), authors without ratings are left out
+        """
+        keys = list({query_cache.match_key(name) for name in names})
+
+        cmd = """
+            WITH num_books as (SELECT author_key, count(*) as num_books
+                                FROM books
+                                WHERE author_key = ANY(%s)
+                                GROUP BY author_key)
+            SELECT
+                author_key, round(AVG(book_rating), 1), num_books
+            FROM
+                books NATURAL JOIN ratings JOIN num_books USING (author_key)
+            GROUP BY
+                author_key, num_books
+            """
+
+        rv = {}
+        cur = conn.cursor()
+        try:
+            cur.execute(cmd, (keys,))
+            for key, avg, num_books in cur:
+                rv[key] = (avg, num_books)
+        except pg.Error as e:
+            print(f"Error: {e}")
+        cur.close()
+
+        return rv
+
+    @staticmethod
+    @query_cache.cached('books', 'ratings', normalize=query_cache.match_key)
+    def get_books_avg_rating(conn: pg.Connection,
                              title: str,
                              author: str) -> list[[float, str]] | None:
         """
@@ -145,16 +247,7 @@ class Ratings:
         author = Ratings.remove_punctuation(author)
         title = Ratings.remove_punctuation(title)
 
-        cmd = """
-            SELECT
-                round(AVG(book_rating), 1), title, author
-            FROM
-                books NATURAL JOIN ratings
-            WHERE
-                regexp_replace(title, '[^\w\s]', '', 'g') ILIKE %s AND regexp_replace(author, '[^\w\s]', '', 'g') ILIKE %s
-            GROUP BY
-                title, author
-            """
+        cmd = Ratings.q_books_avg_rating
 
         # get a cursor to execute the query
         cur = conn.cursor()
@@ -177,21 +270,16 @@ class Ratings:
 
     # Find the average rating for the user that has the most book reviews.
     @staticmethod
-    def get_avg_rating_from_most_reviews(conn: cb.connect()) -> float | None:
+    @query_cache.cached('books', 'ratings')
+    def get_avg_rating_from_most_reviews(conn: pg.Connection) -> float | None:
         """
         get the average rating of the user with the most reviews
         :param conn:
         :return: average rating of user with most reviews
         """
 
-        cmd = """
-        WITH count_reviews AS (SELECT user_id, count(*) as count
-                          FROM ratings
-                          GROUP BY user_id)
-        SELECT round(avg(book_rating), 1)
-        FROM ratings
-        where user_id = (SELECT user_id from count_reviews where count = (SELECT MAX(count) from count_reviews));
-        """
+        # user_rating_stats is indexed on review_count, no need to group ratings
+        cmd = Ratings.q_avg_rating_from_most_reviews
 
         # get a cursor to execute the query
         cur = conn.cursor()
@@ -208,7 +296,8 @@ class Ratings:
 
 
     @staticmethod
-    def get_top_n_books(conn: cb.connect(),
+    @query_cache.cached('books', 'ratings')
+    def get_top_n_books(conn: pg.Connection,
                         n: int) -> list[str, int] | None:
         """
         get the top n books by number of reviews
@@ -217,16 +306,7 @@ class Ratings:
         :return: list of books, author and number of reviews
         """
 
-        cmd = """
-        WITH count_ratings AS (SELECT count(*) as count, title, author
-                            FROM
-                            books NATURAL JOIN ratings
-                            GROUP BY title, author)
-        SELECT title, author, count
-        FROM count_ratings
-        ORDER BY count DESC 
-        LIMIT %s;
-        """
+        cmd = Ratings.q_top_n_books
 
         cur = conn.cursor()
         try:
@@ -244,3 +324,105 @@ class Ratings:
         cur.close()
 
         return rv
+
+    @staticmethod
+    @query_cache.cached('books', 'ratings')
+    def get_top_books_page(conn: pg.Connection,
+                           after: tuple | None,
+                           size: int) -> list[str, str, int]:
+        """
+        get one page of books by number of reviews, for a KeysetPager
+        :param conn: connection to the database
+        :param after: (count, title, author) of the last row of the previous page, None for the first page
+        :param size: max rows
+        :return: rows of title, author and number of reviews
+        """
+
+        # work_rating_stats is kept up to date by insert_review, every page
+        # walks its (rating_count DESC, title DESC, author DESC) index from
+        # the last key on, no grouping or sort. A NULL author is stored as ''
+        # so the row comparison never meets a NULL, it is returned as NULL
+        # like get_top_n_books does, top_books_key turns it back into ''
+        if after is None:
+            cmd = """
+            SELECT title, nullif(author, ''), rating_count
+            FROM work_rating_stats
+            WHERE rating_count > 0
+            ORDER BY rating_count DESC, title DESC, author DESC;
+            """
+            params = ()
+        else:
+            cmd = """
+            SELECT title, nullif(author, ''), rating_count
+            FROM work_rating_stats
+            WHERE rating_count > 0 AND (rating_count, title, author) < (%s, %s, %s)
+            ORDER BY rating_count DESC, title DESC, author DESC;
+            """
+            params = after
+
+        return paging.fetch_page(conn, cmd, params, size)
+
+    @staticmethod
+    def top_books_key(row) -> tuple:
+        """
+        the keyset of a get_top_books_page row, as stored in work_rating_stats
+        """
+        return row[2], row[0], row[1] or ''
+
+    @staticmethod
+    def top_n_books_pager(read,
+                          n: int,
+                          page_size: int) -> paging.KeysetPager:
+        """
+        :param read: runs every page on a lent connection, see paging.borrowing
+        """
+        return paging.KeysetPager(paging.borrowing(read, Ratings.get_top_books_page),
+                                  Ratings.top_books_key,
+                                  page_size, limit=n)
+
+    @staticmethod
+    @query_cache.cached('books', 'book_neighbors')
+    def get_similar_books(conn: pg.Connection,
+                          isbn: str,
+                          k: int = 10) -> list[str, str, float] | None:
+        """
+        get the books most often read and rated alike with a book, from the
+        neighbor index built by similarity.py
+        :param conn: connection to the database
+        :param isbn: the book
+        :param k: max number of books
+        :return: rows of title, author and similarity score, best first
+        """
+
+        cmd = Ratings.q_similar_books
+
+        cur = conn.cursor()
+        try:
+            cur.execute(cmd, (isbn.strip(), k))
+        except pg.Error as e:
+            print(f"Error: {e}")
+            conn.rollback()
+            return None
+
+        if cur.rowcount == 0:
+            return None
+
+        rv = []
+        for row in cur:
+            rv.append(row)
+
+        cur.close()
+
+        return rv
+
+    @staticmethod
+    def get_avg_rating_by_author_approx(conn: pg.Connection,
+                                        name: str,
+                                        percent: float = None) -> list[[float, int, float]] | None:
+        """
+        get_avg_rating_by_author from a sample of the ratings, see approx
+        :return: estimated avg rating, number of books, +/- 95% bound
+        """
+        import approx
+        return approx.avg_rating_by_author(conn, name, percent or approx.DEFAULT_PERCENT)
+
@@ -0,0 +1,140 @@
+import itertools
+import shutil
+import textwrap
+import unicodedata
+from decimal import Decimal
+
+# grid tables like tabulate's "grid" format, rendered one line at a time.
+# Column widths come from the header and the first SAMPLE_ROWS rows and are
+# then fixed, so the first lines are printed before the rest of the result
+# is read and memory does not grow with the result. Cells wider than their
+# column are cut with an ellipsis (or wrapped onto more lines).
+SAMPLE_ROWS = 50
+MIN_WIDTH = 6
+ELLIPSIS = '…'
+
+
+def width(text: str) -> int:
+    """
+    columns text takes in a terminal, wide (east asian) characters take two
+    and combining marks none
+    """
+    if text.isascii():
+        return len(text)
+    return sum(0 if unicodedata.combining(c) else 2 if unicodedata.east_asian_width(c) in 'WF' else 1
+               for c in text)
+
+
+def truncate(text: str, size: int) -> str:
+    if width(text) <= size:
+        return text
+    out = []
+    used = 0
+    for c in text:
+        w = width(c)
+        if used + w > size - 1:
+            break
+        out.append(c)
+        used += w
+    return ''.join(out) + ELLIPSIS
+
+
+def _cell(value) -> str:
+    if value is None:
+        return ''
+    # one line per cell, a newline in a title would break the grid
+    return ' '.join(str(value).split()) if isinstance(value, str) else str(value)
+
+
+def _numeric(value) -> bool:
+    return isinstance(value, (int, float, Decimal)) and not isinstance(value, bool)
+
+
+def fit(natural: list[int], total: int) -> list[int]:
+    """
+    shrink column widths until the table, borders included, fits in total
+    columns, taking from the widest column first
+    :param natural: widest cell of each column
+    :return: widths
+    """
+    widths = list(natural)
+    # "| " before every column, " |" after the last, " | " between
+    budget = total - (3 * len(widths) + 1)
+    while sum(widths) > budget:
+        i = max(range(len(widths)), key=widths.__getitem__)
+        if widths[i] <= MIN_WIDTH:
+            break
+        widths[i] -= min(widths[i] - MIN_WIDTH, sum(widths) - budget)
+    return widths
+
+
+class Table:
+    """
+    render rows as a grid table, streaming
+
+    for line in Table(["Title", "Author"]).lines(rows): print(line)
+    """
+
+    def __init__(self, headers: list[str], max_width: int = None, wrap: bool = False,
+                 sample: int = SAMPLE_ROWS):
+        self.headers = [_cell(h) for h in headers]
+        self.max_width = max_width or shutil.get_terminal_size().columns
+        self.wrap = wrap
+        self.sample = sample
+        self.widths = None
+        self.numeric = None
+
+    def _measure(self, rows: list) -> None:
+        natural = [width(h) for h in self.headers]
+        numeric = [bool(rows)] * len(self.headers)
+        for row in rows:
+            for i, value in enumerate(row[:len(natural)]):
+                natural[i] = max(natural[i], width(_cell(value)))
+                numeric[i] = numeric[i] and (value is None or _numeric(value))
+        self.widths = fit(natural, self.max_width)
+        self.numeric = numeric
+
+    def rule(self, char: str = '-') -> str:
+        return '+' + '+'.join(char * (w + 2) for w in self.widths) + '+'
+
+    def _row_lines(self, cells: list[str], numeric: list[bool]) -> list[str]:
+        if self.wrap:
+            columns = [textwrap.wrap(c, w) or [''] if width(c) > w else [c] for c, w in zip(cells, self.widths)]
+        else:
+            columns = [[truncate(c, w)] for c, w in zip(cells, self.widths)]
+        height = max(len(c) for c in columns)
+        lines = []
+        for n in range(height):
+            parts = []
+            for column, w, right in zip(columns, self.widths, numeric):
+                text = truncate(column[n], w) if n < len(column) else ''
+                pad = ' ' * (w - width(text))
+                parts.append(pad + text if right else text + pad)
+            lines.append('| ' + ' | '.join(parts) + ' |')
+        return lines
+
+    def lines(self, rows):
+        """
+        :param rows: any iterable of sequences, read lazily
+        :return: generator of lines, row separators included
+        """
+        rows = iter(rows)
+        head = list(itertools.islice(rows, self.sample))
+        self._measure(head)
+
+        yield self.rule()
+        yield from self._row_lines(self.headers, [False] * len(self.headers))
+        yield self.rule('=')
+        for row in itertools.chain(head, rows):
+            cells = [_cell(value) for value in row[:len(self.widths)]]
+            cells += [''] * (len(self.widths) - len(cells))
+            yield from self._row_lines(cells, [r and _numeric(v) for r, v in zip(self.numeric, row)] +
+                                       [False] * (len(self.widths) - len(row)))
+            yield self.rule()
+
+
+def table(rows, headers: list[str], max_width: int = None, wrap: bool = False):
+    """
+    lines of a grid table of rows, see Table
+    """
+    return Table(headers, max_width, wrap).lines(rows)
@@ -0,0 +1,132 @@
+import psycopg as pg
+
+import query_cache
+import sqlite_backend
+
+# ranked author/title suggestions for the console prompts. Prefix matches
+# come first, read in index order from the text_pattern_ops btree on the key
+# column, then (on postgres) typo tolerant matches from the pg_trgm GIN index.
+# Candidates are capped before they are ranked, so a one letter prefix costs
+# no more than a full name.
+CANDIDATES = 200
+DEFAULT_LIMIT = 8
+
+# {key} is author_key or title_key
+q_prefix = """
+    SELECT isbn, {key}
+    FROM books
+    WHERE {key} LIKE %s
+    ORDER BY {key}
+    LIMIT %s
+    """
+# sqlite's LIKE is case insensitive and can't use a binary index, a range can
+q_prefix_sqlite = """
+    SELECT isbn, {key}
+    FROM books
+    WHERE {key} >= %s AND {key} < %s
+    ORDER BY {key}
+    LIMIT %s
+    """
+# word_similarity lets "kng" find "stephen king", the <% operator uses the index
+q_fuzzy = """
+    SELECT isbn, word_similarity(%s, {key})
+    FROM books
+    WHERE %s <%% {key}
+    ORDER BY word_similarity(%s, {key}) DESC, similarity(%s, {key}) DESC
+    LIMIT %s
+    """
+q_books = """
+    SELECT b.isbn, b.title, b.author, coalesce(s.rating_count, 0)
+    FROM books b LEFT JOIN book_rating_stats s USING (isbn)
+    WHERE b.isbn = ANY(%s)
+    """
+
+
+def _matches(conn: pg.Connection, key_col: str, text: str, limit: int) -> list[tuple[float, str, str, int]]:
+    """
+    :param key_col: author_key or title_key
+    :param limit: the fuzzy query only runs if prefixes gave fewer rows
+    :return: (score, title, author, number of ratings) per matching book
+    """
+    key = query_cache.match_key(text).strip()
+    if not key:
+        return []
+
+    sqlite = sqlite_backend.is_sqlite(conn)
+    scores = {}
+    cur = conn.cursor()
+    try:
+        if sqlite:
+            cur.execute(q_prefix_sqlite.format(key=key_col), (key, key + '\uffff', CANDIDATES))
+        else:
+            cur.execute(q_prefix.format(key=key_col), (key + '%', CANDIDATES))
+        # an exact match ranks above every prefix match, which rank above typos
+        for isbn, value in cur.fetchall():
+            scores[isbn] = 2.0 if value == key else 1.0
+        if len(scores) < limit and not sqlite:
+            cur.execute(q_fuzzy.format(key=key_col), (key, key, key, key, CANDIDATES))
+            for isbn, score in cur.fetchall():
+                scores.setdefault(isbn, score)
+
+        rv = []
+        if scores:
+            cur.execute(q_books, (list(scores),))
+            rv = [(float(scores[isbn]), title, author or '', count) for isbn, title, author, count in cur]
+    except pg.Error as e:
+        print(f"Error: {e}")
+        conn.rollback()
+        rv = []
+    cur.close()
+    return rv
+
+
+def _rank(groups: dict) -> list:
+    """
+    :param groups: value -> [best score, number of ratings]
+    :return: values, best match first, then most rated
+    """
+    return sorted(groups, key=lambda v: (-round(groups[v][0], 2), -groups[v][1], v))
+
+
+@query_cache.cached('books', 'ratings', normalize=query_cache.match_key)
+def suggest_authors(conn: pg.Connection, text: str, limit: int = DEFAULT_LIMIT) -> list[tuple[str, int]]:
+    """
+    authors whose name starts with, or is close to, text
+    :param conn: connection to the database
+    :param text: what the user typed
+    :param limit: max number of authors
+    :return: (author, number of ratings of their books), best match first,
+        then most rated
+    """
+    groups = {}
+    for score, _, author, count in _matches(conn, 'author_key', text, limit):
+        if not author:
+            continue
+        group = groups.setdefault(author, [0.0, 0])
+        group[0] = max(group[0], score)
+        group[1] += count
+    return [(author, groups[author][1]) for author in _rank(groups)[:limit]]
+
+
+@query_cache.cached('books', 'ratings', normalize=query_cache.match_key)
+def suggest_titles(conn: pg.Connection, text: str, limit: int = DEFAULT_LIMIT) -> list[tuple[str, str, int]]:
+    """
+    books whose title starts with, or is close to, text
+    :param conn: connection to the database
+    :param text: what the user typed
+    :param limit: max number of (title, author) pairs
+    :return: (title, author, number of ratings), best match first, then most rated
+    """
+    groups = {}
+    for score, title, author, count in _matches(conn, 'title_key', text, limit):
+        group = groups.setdefault((title, author), [0.0, 0])
+        group[0] = max(group[0], score)
+        group[1] += count
+    return [(title, author, groups[(title, author)][1]) for title, author in _rank(groups)[:limit]]
+
+
+def is_exact(text: str, value: str) -> bool:
+    """
+    True if text already matches value the way the rating queries compare them
+    """
+    return query_cache.match_key(text).strip() == query_cache.match_key(value or '').strip()
@@ -0,0 +1,735 @@
+import argparse
+import asyncio
+import contextvars
+import http.client
+import json
+import os
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from decimal import Decimal
+
+import connect_books as cb
+import ingest
+import instrument
+import paging
+import query_cache
+import search
+from books import Books
+from ratings import Ratings
+from users import Users
+
+# one process serving the menu operations as JSON over HTTP to many clients,
+# with one connection pool (and replica set) and one result cache between
+# them. The blocking model methods run in a thread pool of concurrency
+# workers, requests past that wait, and past max_pending waiting ones are
+# turned away with a 503. Large results are streamed as ndjson in chunks of
+# page_rows rows, one keyset page query (and one pooled connection) per
+# chunk, so a slow client never holds a connection.
+#
+#   python service.py --port 8080
+#   BOOKS_SERVICE_URL=http://localhost:8080 python console_app.py
+HOST = os.environ.get('BOOKS_SERVICE_HOST', '127.0.0.1')
+PORT = int(os.environ.get('BOOKS_SERVICE_PORT', 8080))
+CONCURRENCY = int(os.environ.get('BOOKS_SERVICE_CONCURRENCY', cb.settings()['max_size']))
+MAX_PENDING = int(os.environ.get('BOOKS_SERVICE_MAX_PENDING', 64))
+PAGE_ROWS = 500
+MAX_BODY = 64 * 1024
+IDLE_TIMEOUT = 30
+
+REASONS = {200: 'OK', 201: 'Created', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           409: 'Conflict', 413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+# names of the fields of every tabular result, in model column order
+COLUMNS = {
+    '/books/by-author': ['title', 'year', 'publisher', 'isbn'],
+    '/ratings/by-author': ['avg_rating', 'books'],
+    '/ratings/by-book': ['avg_rating', 'title', 'author'],
+    '/authors/top': ['author', 'books'],
+    '/books/top': ['title', 'author', 'ratings'],
+    '/books/similar': ['title', 'author', 'similarity'],
+    '/search/authors': ['author', 'ratings'],
+    '/search/titles': ['title', 'author', 'ratings'],
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _plain(value):
+    # numeric columns come back as Decimal
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return value
+
+
+def _objects(path: str, rows) -> list[dict] | None:
+    if rows is None:
+        return None
+    return [dict(zip(COLUMNS[path], map(_plain, row))) for row in rows]
+
+
+class Request:
+    def __init__(self, method: str, target: str, version: str, headers: dict, body: bytes):
+        url = urllib.parse.urlsplit(target)
+        self.method = method
+        self.version = version
+        self.path = url.path.rstrip('/') or '/'
+        self.query = dict(urllib.parse.parse_qsl(url.query))
+        self.headers = headers
+        self.body = body
+
+    def arg(self, name: str, kind=str, default=...):
+        """
+        query string parameter
+        :param kind: converts the value, a ValueError is a 400
+        :param default: value if missing, required if not given
+        """
+        value = self.query.get(name)
+        if value is None or value == '':
+            if default is ...:
+                raise HTTPError(400, f"missing parameter {name}")
+            return default
+        try:
+            return kind(value)
+        except ValueError:
+            raise HTTPError(400, f"bad parameter {name}: {value!r}") from None
+
+    def json(self) -> dict:
+        try:
+            body = json.loads(self.body or b'{}')
+        except ValueError as e:
+            raise HTTPError(400, f"body is not json, {e}") from None
+        if not isinstance(body, dict):
+            raise HTTPError(400, "body must be a json object")
+        return body
+
+    @property
+    def keep_alive(self) -> bool:
+        connection = self.headers.get('connection', '').lower()
+        return connection != 'close' if self.version == 'HTTP/1.1' else connection == 'keep-alive'
+
+
+class Stream:
+    """
+    ndjson response, pages is an async iterator of lists of rows
+    """
+
+    def __init__(self, path: str, pages):
+        self.path = path
+        self.pages = pages
+
+
+def _field(body: dict, name: str, kind, required: bool = True):
+    value = body.get(name)
+    if value is None or value == '':
+        if required:
+            raise HTTPError(400, f"missing field {name}")
+        return None
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        raise HTTPError(400, f"bad field {name}: {value!r}") from None
+
+
+def _isbn(value: str) -> str:
+    try:
+        return ingest.normalize_isbn(value)
+    except ingest.Reject as e:
+        raise ValueError(str(e)) from None
+
+
+class Service:
+    """
+    the HTTP endpoints, see routes
+    """
+
+    def __init__(self, concurrency: int = CONCURRENCY, max_pending: int = MAX_PENDING,
+                 page_rows: int = PAGE_ROWS):
+        self.concurrency = max(concurrency, 1)
+        self.max_pending = max_pending
+        self.page_rows = page_rows
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='books-query')
+        # created on the event loop, see open
+        self._slots = None
+        self.waiting = 0
+
+        self.stats = {'requests': 0, 'in_flight': 0, 'rejected': 0, 'errors': 0, 'connections': 0,
+                      'rows_streamed': 0}
+
+        # the menu options, in menu order, then search and the service's own
+        self.routes = {
+            ('GET', '/books/title'): self.title_by_isbn,
+            ('GET', '/books/by-author'): self.books_by_author,
+            ('GET', '/ratings/by-author'): self.avg_rating_by_author,
+            ('GET', '/ratings/by-book'): self.books_avg_rating,
+            ('GET', '/ratings/most-reviews'): self.avg_rating_from_most_reviews,
+            ('POST', '/users'): self.insert_user,
+            ('POST', '/books'): self.insert_book,
+            ('POST', '/ratings'): self.insert_review,
+            ('GET', '/authors/top'): self.top_n_authors,
+            ('GET', '/books/top'): self.top_n_books,
+            ('GET', '/books/similar'): self.similar_books,
+            ('GET', '/search/authors'): self.suggest_authors,
+            ('GET', '/search/titles'): self.suggest_titles,
+            ('GET', '/metrics'): self.metrics,
+            ('GET', '/health'): self.health,
+        }
+
+    async def open(self) -> None:
+        self._slots = asyncio.Semaphore(self.concurrency)
+        # open the pool now rather than on the first request
+        await asyncio.get_running_loop().run_in_executor(self._executor, cb.get_pool)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        cb.close_pool()
+
+    # running model methods
+
+    async def _query(self, request: Request, func, *args, readonly: bool = True):
+        """
+        func(conn, *args) on a pooled connection in a worker thread, at most
+        concurrency at once
+        """
+        if self.waiting >= self.max_pending:
+            self.stats['rejected'] += 1
+            raise HTTPError(503, "too many requests, try again later")
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            label = f"{request.method} {request.path} db"
+            # in the client's context, so a write keeps its own reads on the primary
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, contextvars.copy_context().run, self._call, label, readonly, func, args)
+        except cb.PoolTimeout as e:
+            raise HTTPError(503, str(e)) from None
+        finally:
+            self._slots.release()
+
+    @staticmethod
+    def _call(label: str, readonly: bool, func, args):
+        with instrument.timed(label):
+            if readonly:
+                # retried once elsewhere if a replica fails during it
+                return cb.read(func, *args)
+            with cb.connection() as conn:
+                return func(conn, *args)
+
+    def _pages(self, request: Request, fetch, key, limit: int = None):
+        """
+        walk a keyset paged query, one page per query
+        :param fetch: fetch(conn, after, size) -> rows
+        :param key: last row -> after for the next page
+        :return: async iterator of pages, from the 'after' parameter on
+        """
+        return self._walk(request, fetch, key, request.arg('after', lambda v: tuple(json.loads(v)), None), limit)
+
+    async def _walk(self, request: Request, fetch, key, after: tuple | None, limit: int | None):
+        sent = 0
+        while limit is None or sent < limit:
+            size = self.page_rows if limit is None else min(self.page_rows, limit - sent)
+            rows = await self._query(request, fetch, after, size)
+            if not rows:
+                return
+            yield rows
+            sent += len(rows)
+            if len(rows) < size:
+                return
+            after = key(rows[-1])
+
+    # endpoints
+
+    async def title_by_isbn(self, request: Request):
+        isbn = request.arg('isbn')
+        title = await self._query(request, Books.get_title_by_isbn, isbn)
+        if title is None:
+            raise HTTPError(404, f"ISBN {isbn} not found")
+        return {'isbn': isbn, 'title': title}
+
+    async def books_by_author(self, request: Request):
+        author = request.arg('author')
+        limit = request.arg('limit', int, None)
+        return Stream(request.path, self._pages(
+            request, lambda conn, after, size: Books.get_books_by_author_page(conn, author, after, size),
+            lambda row: (row[3],), limit))
+
+    async def avg_rating_by_author(self, request: Request):
+        author = request.arg('author')
+        rows = await self._query(request, Ratings.get_avg_rating_by_author, author)
+        if rows is None:
+            raise HTTPError(404, f"Author {author} not found")
+        return _objects(request.path, rows)
+
+    async def books_avg_rating(self, request: Request):
+        title, author = request.arg('title'), request.arg('author')
+        rows = await self._query(request, Ratings.get_books_avg_rating, title, author)
+        if rows is None:
+            raise HTTPError(404, f"Book {title} by {author} not found")
+        return _objects(request.path, rows)
+
+    async def avg_rating_from_most_reviews(self, request: Request):
+        avg = await self._query(request, Ratings.get_avg_rating_from_most_reviews)
+        if avg is None:
+            raise HTTPError(404, "No users found")
+        return {'avg_rating': _plain(avg)}
+
+    async def _insert(self, request: Request, func, *args):
+        if not await self._query(request, func, *args, readonly=False):
+            raise HTTPError(409, "not inserted, see the service log")
+        return {'inserted': True}
+
+    async def insert_user(self, request: Request):
+        body = request.json()
+        return await self._insert(request, Users.insert_user, _field(body, 'user_id', int),
+                                  _field(body, 'location', str, False), _field(body, 'age', str, False))
+
+    async def insert_book(self, request: Request):
+        body = request.json()
+        return await self._insert(request, Books.insert_book, _field(body, 'isbn', _isbn), _field(body, 'title', str),
+                                  _field(body, 'author', str, False), _field(body, 'year', int, False),
+                                  _field(body, 'publisher', str, False))
+
+    async def insert_review(self, request: Request):
+        body = request.json()
+        # insert_review builds its statement from the values, the isbn is
+        # normalized (digits and X only) and the numbers are ints
+        rating = _field(body, 'rating', int)
+        if not 0 <= rating <= 10:
+            raise HTTPError(400, f"rating not in 0..10: {rating}")
+        return await self._insert(request, Ratings.insert_review, _field(body, 'user_id', int),
+                                  _field(body, 'isbn', _isbn), rating)
+
+    async def top_n_authors(self, request: Request):
+        n = request.arg('n', int)
+        limit = min(n, request.arg('limit', int, n))
+        return Stream(request.path, self._pages(request, Books.get_top_authors_page,
+                                                lambda row: (row[1], row[0]), limit))
+
+    async def top_n_books(self, request: Request):
+        n = request.arg('n', int)
+        limit = min(n, request.arg('limit', int, n))
+        return Stream(request.path, self._pages(request, Ratings.get_top_books_page,
+                                                Ratings.top_books_key, limit))
+
+    async def similar_books(self, request: Request):
+        isbn = request.arg('isbn')
+        rows = await self._query(request, Ratings.get_similar_books, isbn, request.arg('k', int, 10))
+        if rows is None:
+            raise HTTPError(404, f"No similar books found for ISBN {isbn}")
+        return _objects(request.path, rows)
+
+    async def suggest_authors(self, request: Request):
+        rows = await self._query(request, search.suggest_authors, request.arg('q'),
+                                 request.arg('limit', int, search.DEFAULT_LIMIT))
+        return _objects(request.path, rows)
+
+    async def suggest_titles(self, request: Request):
+        rows = await self._query(request, search.suggest_titles, request.arg('q'),
+                                 request.arg('limit', int, search.DEFAULT_LIMIT))
+        return _objects(request.path, rows)
+
+    async def metrics(self, request: Request):
+        replicas = cb.get_replicas()
+        return {
+            'service': dict(self.stats, waiting=self.waiting, concurrency=self.concurrency),
+            'endpoints': instrument.latency_summary(),
+            'pool': cb.get_pool().get_stats(),
+            'replicas': replicas.get_stats() if replicas else None,
+            'cache': query_cache.cache.get_stats(),
+        }
+
+    async def health(self, request: Request):
+        await self._query(request, lambda conn: conn.execute("SELECT 1").fetchone())
+        return {'ok': True}
+
+    # HTTP
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Request | None:
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, version = line.decode('latin-1').split()
+        except ValueError:
+            raise HTTPError(400, "bad request line") from None
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+            if len(headers) > 100:
+                raise HTTPError(400, "too many headers")
+
+        length = int(headers.get('content-length') or 0)
+        if length > MAX_BODY:
+            raise HTTPError(413, f"body over {MAX_BODY} bytes")
+        body = await reader.readexactly(length) if length else b''
+        return Request(method.upper(), target, version.upper(), headers, body)
+
+    @staticmethod
+    async def _send(writer: asyncio.StreamWriter, status: int, payload, keep_alive: bool) -> None:
+        body = json.dumps(payload, default=_plain).encode('utf-8')
+        writer.write(f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                     f"Content-Type: application/json\r\n"
+                     f"Content-Length: {len(body)}\r\n"
+                     f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + body)
+        await writer.drain()
+
+    async def _send_stream(self, writer: asyncio.StreamWriter, stream: Stream, keep_alive: bool) -> bool:
+        """
+        :return: True to keep the connection open for the next request
+        """
+        # the first page is read before the headers go out, so a busy
+        # service or a bad parameter still gets its status code
+        first = await anext(stream.pages, None)
+        writer.write(f"HTTP/1.1 200 OK\r\n"
+                     f"Content-Type: application/x-ndjson\r\n"
+                     f"Transfer-Encoding: chunked\r\n"
+                     f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1'))
+        error = None
+        try:
+            rows = first
+            while rows is not None:
+                chunk = ''.join(json.dumps(row, default=_plain) + '\n'
+                                for row in _objects(stream.path, rows)).encode('utf-8')
+                writer.write(f"{len(chunk):x}\r\n".encode('latin-1') + chunk + b"\r\n")
+                self.stats['rows_streamed'] += len(rows)
+                # wait for the client to take it before reading the next page
+                await writer.drain()
+                rows = await anext(stream.pages, None)
+        except HTTPError as e:
+            error = str(e)
+        except (ConnectionError, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            # the 200 is already out, a second response would corrupt the body
+            self.stats['errors'] += 1
+            print(f"Error: streaming {stream.path}, {e!r}")
+            error = 'internal error'
+            keep_alive = False
+        finally:
+            await stream.pages.aclose()
+        if error is not None:
+            # too late for a status, the last line says what went wrong
+            chunk = (json.dumps({'error': error}) + '\n').encode('utf-8')
+            writer.write(f"{len(chunk):x}\r\n".encode('latin-1') + chunk + b"\r\n")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        return keep_alive
+
+    async def _respond(self, request: Request, writer: asyncio.StreamWriter) -> bool:
+        """
+        :return: True to keep the connection open for the next request
+        """
+        start = time.perf_counter()
+        keep_alive = request.keep_alive
+        handler = self.routes.get((request.method, request.path))
+        self.stats['requests'] += 1
+        self.stats['in_flight'] += 1
+        try:
+            if handler is None:
+                if any(path == request.path for _, path in self.routes):
+                    raise HTTPError(405, f"{request.method} not allowed on {request.path}")
+                raise HTTPError(404, f"no endpoint {request.path}")
+            result = await handler(request)
+            if isinstance(result, Stream):
+                keep_alive = await self._send_stream(writer, result, keep_alive)
+            else:
+                await self._send(writer, 201 if request.method == 'POST' else 200, result, keep_alive)
+        except HTTPError as e:
+            if e.status >= 500:
+                self.stats['errors'] += 1
+            await self._send(writer, e.status, {'error': str(e)}, keep_alive)
+        except (ConnectionError, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            self.stats['errors'] += 1
+            print(f"Error: {request.method} {request.path}, {e!r}")
+            await self._send(writer, 500, {'error': 'internal error'}, False)
+            keep_alive = False
+        finally:
+            self.stats['in_flight'] -= 1
+            instrument.observe(f"{request.method} {request.path}" if handler else 'unknown',
+                               time.perf_counter() - start)
+        return keep_alive
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        one client connection, requests are answered in turn (keep-alive),
+        it is one read-your-writes session
+        """
+        self.stats['connections'] += 1
+        try:
+            with cb.session():
+                await self._serve_client(reader, writer)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _serve_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        while True:
+            try:
+                request = await asyncio.wait_for(self._read_request(reader), IDLE_TIMEOUT)
+            except HTTPError as e:
+                await self._send(writer, e.status, {'error': str(e)}, False)
+                break
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+                break
+            if request is None or not await self._respond(request, writer):
+                break
+
+
+async def serve(host: str = HOST, port: int = PORT, service: Service = None) -> None:
+    service = service or Service()
+    await service.open()
+    server = await asyncio.start_server(service.handle, host, port)
+    print(f"Serving on http://{host}:{port} with {service.concurrency} workers")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+class Client:
+    """
+    blocking client of the service with the connect_books functions the
+    console uses, the console hands it to the Remote* classes below as its
+    connection (see BOOKS_SERVICE_URL in console_app)
+    """
+
+    def __init__(self, url: str = None, timeout: float = 30):
+        # resolved on first use, the console imports this module lazily
+        self.url = url
+        self.timeout = timeout
+        self.requests = 0
+        self.seconds = 0.0
+        # one keep-alive connection per thread
+        self._local = threading.local()
+
+    def _conn(self) -> http.client.HTTPConnection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            url = urllib.parse.urlsplit(self.url or os.environ.get('BOOKS_SERVICE_URL', f"http://{HOST}:{PORT}"))
+            conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=self.timeout)
+            self._local.conn = conn
+        return conn
+
+    def request(self, method: str, path: str, params: dict = None, body: dict = None):
+        """
+        :return: status, and the decoded json body, or a list of the objects
+            of an ndjson body
+        """
+        target = path + ('?' + urllib.parse.urlencode({k: v for k, v in params.items() if v is not None})
+                         if params else '')
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        headers = {'Content-Type': 'application/json'} if data else {}
+        start = time.perf_counter()
+        for attempt in (1, 2):
+            conn = self._conn()
+            try:
+                conn.request(method, target, data, headers)
+                response = conn.getresponse()
+                if response.getheader('Content-Type', '').startswith('application/x-ndjson'):
+                    payload = [json.loads(line) for line in response if line.strip()]
+                else:
+                    payload = json.loads(response.read() or b'null')
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # the service closed an idle keep-alive connection, once
+                conn.close()
+                self._local.conn = None
+                if attempt == 2:
+                    raise
+        self.requests += 1
+        self.seconds += time.perf_counter() - start
+        return response.status, payload
+
+    def get(self, path: str, **params):
+        """
+        :return: the body, None if not found or failed (the error is printed)
+        """
+        try:
+            status, payload = self.request('GET', path, params)
+        except (OSError, http.client.HTTPException) as e:
+            print(f"Error: service unreachable, {e}")
+            return None
+        if status == 404:
+            return None
+        if status != 200:
+            print(f"Error: {payload.get('error') if isinstance(payload, dict) else status}")
+            return None
+        return payload
+
+    def post(self, path: str, body: dict) -> bool:
+        try:
+            status, payload = self.request('POST', path, body=body)
+        except (OSError, http.client.HTTPException) as e:
+            print(f"Error: service unreachable, {e}")
+            return False
+        if status != 201:
+            print(f"Error: {payload.get('error') if isinstance(payload, dict) else status}")
+        return status == 201
+
+    def rows(self, path: str, **params) -> list[tuple] | None:
+        """
+        a tabular result as tuples in model column order, like the models
+        return it
+        """
+        payload = self.get(path, **params)
+        if not payload:
+            return None
+        if isinstance(payload[-1], dict) and 'error' in payload[-1]:
+            print(f"Error: {payload[-1]['error']}")
+            payload = payload[:-1]
+        return [tuple(obj.get(name) for name in COLUMNS[path]) for obj in payload] or None
+
+    def pager(self, path: str, key, page_size: int, limit: int = None, **params) -> paging.KeysetPager:
+        return paging.KeysetPager(
+            lambda after, size: self.rows(path, after=json.dumps(after) if after else None, limit=size,
+                                          **params) or [],
+            key, page_size, limit=limit)
+
+    # connect_books stand-ins
+
+    @contextmanager
+    def connection(self, readonly: bool = False):
+        yield self
+
+    def read(self, func, *args):
+        # the service retries reads on its side
+        return func(self, *args)
+
+    def get_pool(self):
+        self.get('/health')
+        return self
+
+    def print_stats(self) -> None:
+        avg = self.seconds / self.requests * 1000 if self.requests else 0.0
+        print(f"Service {self.url or os.environ.get('BOOKS_SERVICE_URL')}: {self.requests} requests, "
+              f"avg {avg:.1f} ms")
+
+    def close_pool(self) -> None:
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+client = Client()
+
+
+class RemoteBooks:
+    """
+    the Books methods the console uses, answered by the service
+    """
+
+    @staticmethod
+    def get_title_by_isbn(conn: Client, isbn: str) -> str | None:
+        rv = conn.get('/books/title', isbn=isbn)
+        return rv['title'] if rv else None
+
+    @staticmethod
+    def books_by_author_pager(read, author: str, page_size: int) -> paging.KeysetPager:
+        return read(lambda conn: conn.pager('/books/by-author', lambda row: (row[3],), page_size, author=author))
+
+    @staticmethod
+    def insert_book(conn: Client, isbn: str, title: str, author: str, year: int, publisher: str) -> bool:
+        return conn.post('/books', {'isbn': isbn, 'title': title, 'author': author, 'year': year,
+                                    'publisher': publisher})
+
+    @staticmethod
+    def top_n_authors_pager(read, n: int, page_size: int) -> paging.KeysetPager:
+        return read(lambda conn: conn.pager('/authors/top', lambda row: (row[1], row[0]), page_size, limit=n, n=n))
+
+
+class RemoteRatings:
+    """
+    the Ratings methods the console uses, answered by the service
+    """
+
+    @staticmethod
+    def get_avg_rating_by_author(conn: Client, name: str) -> list | None:
+        return conn.rows('/ratings/by-author', author=name)
+
+    @staticmethod
+    def get_books_avg_rating(conn: Client, title: str, author: str) -> list | None:
+        return conn.rows('/ratings/by-book', title=title, author=author)
+
+    @staticmethod
+    def get_avg_rating_from_most_reviews(conn: Client) -> float | None:
+        rv = conn.get('/ratings/most-reviews')
+        return rv['avg_rating'] if rv else None
+
+    @staticmethod
+    def insert_review(conn: Client, user_id: int, isbn: str, rating: int) -> bool:
+        return conn.post('/ratings', {'user_id': user_id, 'isbn': isbn, 'rating': rating})
+
+    @staticmethod
+    def top_n_books_pager(read, n: int, page_size: int) -> paging.KeysetPager:
+        return read(lambda conn: conn.pager('/books/top', Ratings.top_books_key, page_size, limit=n, n=n))
+
+    @staticmethod
+    def get_similar_books(conn: Client, isbn: str, k: int = 10) -> list | None:
+        return conn.rows('/books/similar', isbn=isbn, k=k)
+
+
+class RemoteUsers:
+    @staticmethod
+    def insert_user(conn: Client, user_id: int, location: str, age: str) -> bool:
+        return conn.post('/users', {'user_id': user_id, 'location': location, 'age': age})
+
+
+class RemoteSearch:
+    is_exact = staticmethod(search.is_exact)
+
+    @staticmethod
+    def suggest_authors(conn: Client, text: str, limit: int = search.DEFAULT_LIMIT) -> list:
+        return conn.rows('/search/authors', q=text, limit=limit) or []
+
+    @staticmethod
+    def suggest_titles(conn: Client, text: str, limit: int = search.DEFAULT_LIMIT) -> list:
+        return conn.rows('/search/titles', q=text, limit=limit) or []
+
+
+class RemoteCache:
+    @staticmethod
+    def print_stats() -> None:
+        metrics = client.get('/metrics')
+        if metrics:
+            s = metrics['cache']
+            print(f"Service cache: {s['hits']} hits, {s['misses']} misses ({s['hit_rate']:.0%} hit rate), "
+                  f"{s['entries']} entries")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="books queries as a JSON over HTTP service")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY,
+                        help="queries run at once, keep it at most the pool size")
+    parser.add_argument('--max-pending', type=int, default=MAX_PENDING,
+                        help="requests waiting for a worker before new ones get a 503")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.host, args.port, Service(args.concurrency, args.max_pending)))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,284 @@
+import argparse
+import heapq
+import math
+import time
+from array import array
+from itertools import islice
+
+import psycopg as pg
+
+import paging
+import query_cache
+import sqlite_backend
+
+# item-item neighbor index built offline from the sparse user x book ratings.
+# Book-Crossing mixes explicit ratings (1-10) with implicit 0s ("interacted,
+# not rated"), so every book has two sparse vectors over users, compared
+# separately and blended:
+#   score = cos(explicit) + IMPLICIT_WEIGHT * cos(implicit), shrunk by
+#   co_raters / (co_raters + SHRINK) so a single shared reader can't dominate
+DEFAULT_K = 20
+IMPLICIT_WEIGHT = 0.5
+SHRINK = 10
+# heavy users are subsampled to this many books, they add little signal and
+# would make the build quadratic in their history
+MAX_USER_ITEMS = 200
+
+ct = """
+        CREATE TABLE IF NOT EXISTS book_neighbors (
+        isbn          text NOT NULL,
+        neighbor_isbn text NOT NULL,
+        score         double precision NOT NULL,
+        co_raters     integer NOT NULL,
+        PRIMARY KEY (isbn, neighbor_isbn)
+    );
+        CREATE INDEX IF NOT EXISTS book_neighbors_rank_idx ON book_neighbors (isbn, score DESC);
+
+        CREATE TABLE IF NOT EXISTS book_vectors (
+        isbn          text PRIMARY KEY,
+        explicit_norm double precision NOT NULL,
+        implicit_norm double precision NOT NULL,
+        rating_count  bigint NOT NULL,
+        rating_sum    bigint NOT NULL
+    );
+"""
+
+
+def _sample(items: list) -> list:
+    """
+    deterministic subsample of a user's books (sorted by isbn), the build and
+    the refresh must see the same sparse matrix
+    """
+    if len(items) <= MAX_USER_ITEMS:
+        return items
+    step = math.ceil(len(items) / MAX_USER_ITEMS)
+    return items[::step]
+
+
+def _norms(values) -> tuple[float, float, int, int]:
+    """
+    :param values: ratings of one book
+    :return: explicit norm, implicit norm, count, sum
+    """
+    explicit = 0
+    implicit = 0
+    count = 0
+    total = 0
+    for v in values:
+        count += 1
+        total += v
+        if v > 0:
+            explicit += v * v
+        else:
+            implicit += 1
+    return math.sqrt(explicit), math.sqrt(implicit), count, total
+
+
+def _neighbors(item, raters, user_items, norms, k: int) -> list[tuple[float, object, int]]:
+    """
+    score item against every book that shares a reader with it
+    :param item: the book
+    :param raters: (user, rating) pairs of item
+    :param user_items: user -> sampled list of (book, rating)
+    :param norms: book -> (explicit norm, implicit norm, ...)
+    :return: top k (score, book, co_raters), best first
+    """
+    dot_e = {}
+    dot_i = {}
+    co = {}
+    for user, va in raters:
+        for other, vb in user_items.get(user, ()):
+            if other == item:
+                continue
+            co[other] = co.get(other, 0) + 1
+            if va > 0 and vb > 0:
+                dot_e[other] = dot_e.get(other, 0) + va * vb
+            elif va == 0 and vb == 0:
+                dot_i[other] = dot_i.get(other, 0) + 1
+
+    ne, ni = norms[item][0], norms[item][1]
+    scored = []
+    for other, n in co.items():
+        oe, oi = norms[other][0], norms[other][1]
+        score = 0.0
+        if other in dot_e and ne and oe:
+            score += dot_e[other] / (ne * oe)
+        if other in dot_i and ni and oi:
+            score += IMPLICIT_WEIGHT * dot_i[other] / (ni * oi)
+        if score > 0:
+            scored.append((score * n / (n + SHRINK), other, n))
+    return heapq.nlargest(k, scored)
+
+
+def _write(cur, table: str, rows) -> int:
+    """
+    append rows to table inside the caller's transaction, COPY on postgres
+    :return: number of rows written
+    """
+    count = 0
+    if sqlite_backend.is_sqlite(cur.connection):
+        for chunk in iter(lambda: list(islice(rows, 10_000)), []):
+            cur.executemany(f"INSERT INTO {table} VALUES ({', '.join(['%s'] * len(chunk[0]))})", chunk)
+            count += len(chunk)
+        return count
+    with cur.copy(f"COPY {table} FROM STDIN") as copy:
+        for row in rows:
+            copy.write_row(row)
+            count += 1
+    return count
+
+
+def build(conn: pg.Connection, k: int = DEFAULT_K) -> dict:
+    """
+    rebuild the whole neighbor index from the ratings table
+    :param conn: connection to the database
+    :param k: neighbors kept per book
+    :return: counters
+    """
+    start = time.perf_counter()
+    conn.execute(ct)
+    conn.commit()
+
+    # books get dense ids in isbn order, so id order is isbn order
+    isbns = [row[0] for row in paging.stream(conn, "SELECT DISTINCT isbn FROM ratings ORDER BY isbn")]
+    ids = {isbn: i for i, isbn in enumerate(isbns)}
+
+    # sparse matrix in both orientations, packed as id << 4 | rating
+    item_raters = [array('q') for _ in isbns]
+    user_items = {}
+    for user_id, isbn, rating in paging.stream(
+            conn, "SELECT user_id, isbn, book_rating FROM ratings ORDER BY user_id, isbn", (), 50_000):
+        item = ids[isbn]
+        rating = rating or 0
+        item_raters[item].append(user_id << 4 | rating)
+        user_items.setdefault(user_id, array('q')).append(item << 4 | rating)
+    conn.rollback()
+
+    unpacked_users = {user: _sample([(packed >> 4, packed & 15) for packed in items])
+                      for user, items in user_items.items()}
+    del user_items
+    norms = [_norms(packed & 15 for packed in raters) for raters in item_raters]
+
+    def rows():
+        for item, raters in enumerate(item_raters):
+            pairs = [(packed >> 4, packed & 15) for packed in raters]
+            for score, other, n in _neighbors(item, pairs, unpacked_users, norms, k):
+                yield isbns[item], isbns[other], score, n
+
+    # replaced in one transaction, readers see the old index until the commit
+    cur = conn.cursor()
+    try:
+        cur.execute("DELETE FROM book_neighbors")
+        cur.execute("DELETE FROM book_vectors")
+        pairs = _write(cur, 'book_neighbors', rows())
+        _write(cur, 'book_vectors', ((isbn, *norms[i]) for i, isbn in enumerate(isbns)))
+        conn.commit()
+    except pg.Error as e:
+        conn.rollback()
+        print(f"Error: {e}")
+        raise
+    finally:
+        cur.close()
+    conn.execute("ANALYZE book_neighbors, book_vectors")
+    conn.commit()
+    query_cache.invalidate('book_neighbors')
+    return {'books': len(isbns), 'pairs': pairs, 'seconds': round(time.perf_counter() - start, 1)}
+
+
+def refresh(conn: pg.Connection, k: int = DEFAULT_K, limit: int = 10_000) -> dict:
+    """
+    recompute the neighbors of books whose ratings changed since the index
+    was built, found by comparing book_vectors with the book_rating_stats
+    summary that insert_review keeps up to date, and of the books that list
+    them as neighbors
+    :param conn: connection to the database
+    :param k: neighbors kept per book
+    :param limit: most books refreshed in one call
+    :return: counters
+    """
+    start = time.perf_counter()
+    conn.execute(ct)
+    cur = conn.cursor()
+    # books rated since the build, and indexed books that lost all their ratings
+    cur.execute("""
+        SELECT s.isbn
+        FROM book_rating_stats s LEFT JOIN book_vectors v USING (isbn)
+        WHERE s.rating_count > 0
+          AND (v.isbn IS NULL OR v.rating_count <> s.rating_count OR v.rating_sum <> s.rating_sum)
+        UNION ALL
+        SELECT v.isbn
+        FROM book_vectors v LEFT JOIN book_rating_stats s USING (isbn)
+        WHERE s.isbn IS NULL OR s.rating_count = 0
+        LIMIT %s;
+        """, (limit,))
+    dirty = [row[0] for row in cur.fetchall()]
+    if not dirty:
+        conn.commit()
+        return {'books': 0, 'seconds': round(time.perf_counter() - start, 3)}
+
+    # a pair's score depends on both books, so the books that list a changed
+    # one are ranked on a stale score and get recomputed as well
+    cur.execute("SELECT DISTINCT isbn FROM book_neighbors WHERE neighbor_isbn = ANY(%s)", (dirty,))
+    books = sorted(set(dirty) | {row[0] for row in cur.fetchall()})
+
+    # everyone who rated one of those books, and everything they rated
+    cur.execute("SELECT isbn, user_id, book_rating FROM ratings WHERE isbn = ANY(%s) ORDER BY isbn",
+                (books,))
+    raters = {}
+    for isbn, user_id, rating in cur.fetchall():
+        raters.setdefault(isbn, []).append((user_id, rating or 0))
+    users = list({user for pairs in raters.values() for user, _ in pairs})
+
+    cur.execute("SELECT user_id, isbn, book_rating FROM ratings WHERE user_id = ANY(%s) ORDER BY user_id, isbn",
+                (users,))
+    user_items = {}
+    for user_id, isbn, rating in cur.fetchall():
+        user_items.setdefault(user_id, []).append((isbn, rating or 0))
+    user_items = {user: _sample(items) for user, items in user_items.items()}
+
+    # fresh norms for the recomputed books, stored ones for everything else
+    norms = {isbn: _norms(v for _, v in pairs) for isbn, pairs in raters.items()}
+    others = list({isbn for items in user_items.values() for isbn, _ in items} - set(norms))
+    cur.execute("SELECT isbn, explicit_norm, implicit_norm FROM book_vectors WHERE isbn = ANY(%s)", (others,))
+    for isbn, ne, ni in cur.fetchall():
+        norms[isbn] = (ne, ni)
+    for isbn in others:
+        norms.setdefault(isbn, (0.0, 0.0))
+
+    # books nobody rates any more leave the index, nothing can list them
+    # either since they are in no user's items
+    gone = [isbn for isbn in books if isbn not in raters]
+    cur.execute("DELETE FROM book_neighbors WHERE isbn = ANY(%s)", (books,))
+    cur.execute("DELETE FROM book_vectors WHERE isbn = ANY(%s)", (gone,))
+    for isbn, pairs in raters.items():
+        neighbors = _neighbors(isbn, pairs, user_items, norms, k)
+        cur.executemany("INSERT INTO book_neighbors VALUES (%s, %s, %s, %s)",
+                        [(isbn, other, score, n) for score, other, n in neighbors])
+        ne, ni, count, total = norms[isbn]
+        cur.execute("""
+            INSERT INTO book_vectors VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (isbn) DO UPDATE
+            SET explicit_norm = excluded.explicit_norm,
+                implicit_norm = excluded.implicit_norm,
+                rating_count = excluded.rating_count,
+                rating_sum = excluded.rating_sum;
+            """, (isbn, ne, ni, count, total))
+    conn.commit()
+    cur.close()
+    query_cache.invalidate('book_neighbors')
+    return {'books': len(dirty), 'rescored': len(books) - len(dirty), 'removed': len(gone),
+            'seconds': round(time.perf_counter() - start, 3)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="build or refresh the similar books index")
+    parser.add_argument('command', choices=['build', 'refresh'])
+    parser.add_argument('-k', type=int, default=DEFAULT_K, help="neighbors kept per book")
+    args = parser.parse_args()
+
+    import connect_books as cb
+    with cb.connection() as conn:
+        if args.command == 'build':
+            print(build(conn, args.k))
+        else:
+            print(refresh(conn, args.k))
@@ -0,0 +1,324 @@
+import re
+import sqlite3 as sq
+import sys
+import time
+from functools import lru_cache
+
+import psycopg as pg
+
+import instrument
+
+# tables, keys and indexes of a local snapshot, the search keys and summary
+# tables match the postgres schema so every query runs unchanged
+ct = r"""
+        CREATE TABLE IF NOT EXISTS books (
+        isbn      text PRIMARY KEY,
+        title     text NOT NULL,
+        author    text,
+        year      integer,
+        publisher text,
+        small     text,
+        medium    text,
+        large     text,
+        author_key text GENERATED ALWAYS AS (lower(regexp_replace(author, '[^\w\s]', '', 'g'))) STORED,
+        title_key  text GENERATED ALWAYS AS (lower(regexp_replace(title, '[^\w\s]', '', 'g'))) STORED
+    );
+        CREATE INDEX IF NOT EXISTS books_author_key_idx ON books (author_key);
+        CREATE INDEX IF NOT EXISTS books_title_key_idx ON books (title_key);
+
+        CREATE TABLE IF NOT EXISTS users (
+        user_id  integer PRIMARY KEY,
+        location text,
+        age      text
+    );
+
+        CREATE TABLE IF NOT EXISTS ratings (
+        user_id     integer REFERENCES users,
+        isbn        text REFERENCES books,
+        book_rating integer
+    );
+        CREATE UNIQUE INDEX IF NOT EXISTS ratings_pkey ON ratings (user_id, isbn);
+        CREATE INDEX IF NOT EXISTS ratings_isbn_idx ON ratings (isbn, book_rating);
+        CREATE INDEX IF NOT EXISTS ratings_user_id_idx ON ratings (user_id, book_rating);
+"""
+
+
+def regexp_replace(value, pattern, replacement, flags=''):
+    """
+    postgres regexp_replace for sqlite, 'g' replaces every match
+    """
+    if value is None:
+        return None
+    return re.sub(pattern, replacement, value, count=0 if 'g' in (flags or '') else 1)
+
+
+def lower(value):
+    # sqlite's lower() only folds ascii, postgres (and match_key) fold unicode
+    return None if value is None else value.lower()
+
+
+# postgres spellings -> sqlite, applied once per distinct statement
+_rewrites = [
+    (re.compile(r'\bILIKE\b', re.I), 'LIKE'),
+    (re.compile(r'(\w+(?:\.\w+)?)::numeric'), r'CAST(\1 AS REAL)'),
+    (re.compile(r'::\w+(\[\])?'), ''),
+    (re.compile(r'\bnow\(\)', re.I), "datetime('now')"),
+    (re.compile(r'\bANALYZE\b[^;]*', re.I), 'ANALYZE'),
+]
+_truncate = re.compile(r'\bTRUNCATE\s+([\w\s,]+?);', re.I)
+_placeholder = re.compile(r'=\s*ANY\s*\(\s*%s\s*\)|%s', re.I)
+
+
+@lru_cache(maxsize=256)
+def translate(cmd: str) -> str:
+    """
+    rewrite a postgres statement in the sqlite dialect, placeholders are
+    left as %s for bind()
+    """
+    cmd = _truncate.sub(lambda m: ' '.join(f"DELETE FROM {t.strip()};" for t in m.group(1).split(',')), cmd)
+    for pattern, repl in _rewrites:
+        cmd = pattern.sub(repl, cmd)
+    return cmd
+
+
+def bind(cmd: str, params) -> tuple[str, list]:
+    """
+    turn %s placeholders into ?, expanding "= ANY(%s)" with a list parameter
+    into "IN (?, ?, ...)"
+    """
+    params = list(params or ())
+    values = []
+    index = 0
+
+    def replace(m):
+        nonlocal index
+        value = params[index]
+        index += 1
+        if m.group(0) != '%s':
+            value = list(value)
+            values.extend(value)
+            return f"IN ({', '.join('?' * len(value))})"
+        values.append(value)
+        return '?'
+
+    return _placeholder.sub(replace, cmd), values
+
+
+class _Info:
+    """
+    the bit of psycopg's ConnectionInfo the pool looks at
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    @property
+    def transaction_status(self):
+        status = pg.pq.TransactionStatus
+        return status.INTRANS if self._conn.in_transaction else status.IDLE
+
+
+class SqliteCursor:
+    """
+    cursor over a sqlite connection with the psycopg behaviour the models
+    rely on: %s placeholders, rowcount after a SELECT, named cursors and
+    pg.Error on failure
+    """
+
+    def __init__(self, conn: 'SqliteConnection', name: str = None):
+        self.connection = conn
+        self.name = name
+        self._cur = conn.raw.cursor()
+        self._rows = None
+        self._pos = 0
+        self.rowcount = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def execute(self, query, params=None, **kwargs):
+        cmd = translate(query)
+        start = time.perf_counter()
+        try:
+            if not params and cmd.strip().rstrip(';').count(';'):
+                # several statements (DDL scripts), nothing to bind
+                self._cur.executescript(cmd)
+                self._rows, self.rowcount = [], -1
+            else:
+                sql, values = bind(cmd, params)
+                self._cur.execute(sql, values)
+                if self._cur.description is not None:
+                    # fetch now so rowcount means what it means in psycopg
+                    self._rows = self._cur.fetchall()
+                    self.rowcount = len(self._rows)
+                else:
+                    self._rows, self.rowcount = [], self._cur.rowcount
+            self._pos = 0
+        except sq.Error as e:
+            raise pg.DatabaseError(str(e)) from e
+        finally:
+            if instrument.ENABLED:
+                instrument.record(self, query, params, time.perf_counter() - start,
+                                  max(self.rowcount, 0), 0)
+        return self
+
+    def executemany(self, query, params_seq):
+        cmd = translate(query)
+        try:
+            self._cur.executemany(cmd.replace('%s', '?'), params_seq)
+        except sq.Error as e:
+            raise pg.DatabaseError(str(e)) from e
+        self.rowcount = self._cur.rowcount
+
+    @property
+    def description(self):
+        return self._cur.description
+
+    def fetchone(self):
+        if self._rows is None or self._pos >= len(self._rows):
+            return None
+        self._pos += 1
+        return self._rows[self._pos - 1]
+
+    def fetchmany(self, size: int = 0):
+        size = size or 1
+        rows = self._rows[self._pos:self._pos + size] if self._rows else []
+        self._pos += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._rows[self._pos:] if self._rows else []
+        self._pos += len(rows)
+        return rows
+
+    def __iter__(self):
+        while (row := self.fetchone()) is not None:
+            yield row
+
+    def close(self):
+        self._cur.close()
+
+
+class SqliteConnection:
+    """
+    a local snapshot file behind the subset of the psycopg connection api
+    used by Books/Ratings/Users, the pool and the loaders
+    """
+
+    dialect = 'sqlite'
+
+    def __init__(self, path: str):
+        self.path = path
+        self.raw = sq.connect(path, check_same_thread=False)
+        # postgres functions used by the queries and the generated key columns
+        self.raw.create_function('regexp_replace', 4, regexp_replace, deterministic=True)
+        self.raw.create_function('regexp_replace', 3, regexp_replace, deterministic=True)
+        self.raw.create_function('lower', 1, lower, deterministic=True)
+        self.raw.execute("PRAGMA foreign_keys = ON")
+        self.raw.execute("PRAGMA journal_mode = WAL")
+        self.info = _Info(self.raw)
+        self.broken = False
+        self._closed = False
+
+        # set by instrument.install, sqlite cursors record themselves
+        self.cursor_factory = None
+        self.server_cursor_factory = None
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def cursor(self, name: str = None) -> SqliteCursor:
+        return SqliteCursor(self, name)
+
+    def execute(self, query, params=None) -> SqliteCursor:
+        return self.cursor().execute(query, params)
+
+    def executemany(self, query, params_seq) -> None:
+        self.cursor().executemany(query, params_seq)
+
+    def commit(self) -> None:
+        self.raw.commit()
+
+    def rollback(self) -> None:
+        self.raw.rollback()
+
+    def close(self) -> None:
+        self._closed = True
+        self.raw.close()
+
+
+def connect(path: str) -> SqliteConnection:
+    return SqliteConnection(path)
+
+
+def is_sqlite(conn) -> bool:
+    return isinstance(conn, SqliteConnection)
+
+
+def create_schema(conn: SqliteConnection) -> None:
+    """
+    create the snapshot tables, indexes and summary tables
+    """
+    import summaries
+    conn.execute(ct)
+    conn.execute(summaries.ct)
+    conn.commit()
+
+
+def snapshot(pg_conn: pg.Connection, path: str, batch_size: int = 10_000) -> dict:
+    """
+    copy books, users and ratings from postgres into a local sqlite file and
+    rebuild its summary tables
+    :param pg_conn: source connection
+    :param path: sqlite file, created if missing, existing rows are replaced
+    :return: rows copied per table
+    """
+    import paging
+    import summaries
+
+    conn = connect(path)
+    create_schema(conn)
+    rv = {}
+    # (table, columns, postgres select list), numeric year comes back as Decimal
+    for table, cols, select in [('books', 'isbn, title, author, year, publisher, small, medium, large',
+                                 'isbn, title, author, year::integer, publisher, small, medium, large'),
+                                ('users', 'user_id, location, age', 'user_id, location, age'),
+                                ('ratings', 'user_id, isbn, book_rating', 'user_id, isbn, book_rating')]:
+        conn.execute(f"DELETE FROM {table}")
+        marks = ', '.join('?' * len(cols.split(',')))
+        insert = f"INSERT INTO {table} ({cols}) VALUES ({marks})"
+        rows = paging.stream(pg_conn, f"SELECT {select} FROM {table}", (), batch_size)
+        count = 0
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                conn.raw.executemany(insert, batch)
+                count += len(batch)
+                batch = []
+        conn.raw.executemany(insert, batch)
+        rv[table] = count + len(batch)
+        conn.commit()
+        print(f"{table}: {rv[table]} rows")
+
+    summaries.rebuild(conn)
+    conn.execute("ANALYZE")
+    conn.close()
+    return rv
+
+
+if __name__ == "__main__":
+    # python sqlite_backend.py snapshot books.sqlite
+    if len(sys.argv) != 3 or sys.argv[1] != 'snapshot':
+        print("usage: python sqlite_backend.py snapshot <file.sqlite>")
+        sys.exit(1)
+
+    import connect_books as cb
+    source = cb.connect()
+    snapshot(source, sys.argv[2])
+    source.close()
+    print(f"Snapshot written to {sys.argv[2]}, run the console with BOOKS_BACKEND=sqlite BOOKS_SQLITE_PATH={sys.argv[2]}")
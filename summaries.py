@@ -0,0 +1,194 @@
+import sys
+
+import psycopg as pg
+import connect_books as cb
+import query_cache
+
+# summary tables kept up to date by insert_review/insert_book so the top-n
+# and "most reviews" queries read an index instead of grouping every rating
+ct = """
+        CREATE TABLE IF NOT EXISTS book_rating_stats (
+        isbn         text PRIMARY KEY,
+        rating_count bigint NOT NULL DEFAULT 0,
+        rating_sum   bigint NOT NULL DEFAULT 0
+    );
+        CREATE INDEX IF NOT EXISTS book_rating_stats_count_idx
+            ON book_rating_stats (rating_count DESC);
+
+        CREATE TABLE IF NOT EXISTS user_rating_stats (
+        user_id      integer PRIMARY KEY,
+        review_count bigint NOT NULL DEFAULT 0,
+        rated_count  bigint NOT NULL DEFAULT 0,
+        rating_sum   bigint NOT NULL DEFAULT 0
+    );
+        CREATE INDEX IF NOT EXISTS user_rating_stats_count_idx
+            ON user_rating_stats (review_count DESC, user_id);
+
+        CREATE TABLE IF NOT EXISTS author_book_stats (
+        author     text PRIMARY KEY,
+        book_count bigint NOT NULL DEFAULT 0
+    );
+        CREATE INDEX IF NOT EXISTS author_book_stats_count_idx
+            ON author_book_stats (book_count DESC, author DESC);
+
+        CREATE TABLE IF NOT EXISTS work_rating_stats (
+        title        text NOT NULL,
+        author       text NOT NULL,
+        rating_count bigint NOT NULL DEFAULT 0,
+        PRIMARY KEY (title, author)
+    );
+        CREATE INDEX IF NOT EXISTS work_rating_stats_count_idx
+            ON work_rating_stats (rating_count DESC, title DESC, author DESC);
+"""
+dt = "DROP TABLE IF EXISTS book_rating_stats, user_rating_stats, author_book_stats, work_rating_stats"
+
+# ratings per work, a distinct (title, author) as get_top_n_books groups them,
+# a NULL author is stored as '' so it can be part of the key
+work_rebuild_cmd = """
+        DELETE FROM work_rating_stats;
+
+        INSERT INTO work_rating_stats (title, author, rating_count)
+        SELECT b.title, coalesce(b.author, ''), sum(s.rating_count)
+        FROM books b JOIN book_rating_stats s USING (isbn)
+        GROUP BY b.title, coalesce(b.author, '');
+
+        ANALYZE work_rating_stats;
+"""
+
+rebuild_cmd = """
+        TRUNCATE book_rating_stats, user_rating_stats, author_book_stats;
+
+        INSERT INTO book_rating_stats (isbn, rating_count, rating_sum)
+        SELECT isbn, count(*), coalesce(sum(book_rating), 0)
+        FROM ratings
+        WHERE isbn IS NOT NULL
+        GROUP BY isbn;
+
+        INSERT INTO user_rating_stats (user_id, review_count, rated_count, rating_sum)
+        SELECT user_id, count(*), count(book_rating), coalesce(sum(book_rating), 0)
+        FROM ratings
+        WHERE user_id IS NOT NULL
+        GROUP BY user_id;
+
+        INSERT INTO author_book_stats (author, book_count)
+        SELECT author, count(*)
+        FROM books
+        WHERE author IS NOT NULL
+        GROUP BY author;
+
+        ANALYZE book_rating_stats, user_rating_stats, author_book_stats;
+""" + work_rebuild_cmd
+
+
+def create_tables(conn: pg.Connection) -> None:
+    conn.execute(ct)
+    conn.commit()
+
+
+def rebuild(conn: pg.Connection) -> None:
+    """
+    recompute every summary table from scratch, run after a bulk load
+    :param conn: connection to the database
+    """
+    conn.execute(ct)
+    conn.execute(rebuild_cmd)
+    conn.commit()
+    query_cache.invalidate('books', 'ratings')
+
+
+def add_review(cur: pg.Cursor,
+               user_id: int,
+               isbn: str,
+               rating: int,
+               sign: int = 1) -> None:
+    """
+    apply one new (sign=1) or removed (sign=-1) rating to the summaries,
+    runs in the caller's transaction. A NULL rating is a review but is not
+    counted in rated_count, like AVG() skips it
+    """
+    cur.execute("""
+        INSERT INTO book_rating_stats AS s (isbn, rating_count, rating_sum)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (isbn) DO UPDATE
+        SET rating_count = s.rating_count + excluded.rating_count,
+            rating_sum = s.rating_sum + excluded.rating_sum;
+        """, (isbn, sign, sign * (rating or 0)))
+    cur.execute("""
+        INSERT INTO user_rating_stats AS s (user_id, review_count, rated_count, rating_sum)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (user_id) DO UPDATE
+        SET review_count = s.review_count + excluded.review_count,
+            rated_count = s.rated_count + excluded.rated_count,
+            rating_sum = s.rating_sum + excluded.rating_sum;
+        """, (user_id, sign, sign * (rating is not None), sign * (rating or 0)))
+    cur.execute("""
+        INSERT INTO work_rating_stats AS s (title, author, rating_count)
+        SELECT title, coalesce(author, ''), %s FROM books WHERE isbn = %s
+        ON CONFLICT (title, author) DO UPDATE
+        SET rating_count = s.rating_count + excluded.rating_count;
+        """, (sign, isbn))
+
+
+def change_review(cur: pg.Cursor,
+                  user_id: int,
+                  isbn: str,
+                  old: int | None,
+                  new: int | None) -> None:
+    """
+    apply a rating replaced in place to the summaries: the review counts
+    stay, the sums move by new - old, runs in the caller's transaction
+    """
+    cur.execute("UPDATE book_rating_stats SET rating_sum = rating_sum + %s WHERE isbn = %s",
+                ((new or 0) - (old or 0), isbn))
+    cur.execute("""
+        UPDATE user_rating_stats
+        SET rated_count = rated_count + %s, rating_sum = rating_sum + %s
+        WHERE user_id = %s;
+        """, ((new is not None) - (old is not None), (new or 0) - (old or 0), user_id))
+
+
+def move_ratings(cur: pg.Cursor,
+                 isbns: list[str],
+                 sign: int = 1) -> None:
+    """
+    add (sign=1) or take away (sign=-1) the ratings of books to the counts of
+    their current (title, author), around a change of title or author,
+    runs in the caller's transaction
+    """
+    cur.execute("""
+        INSERT INTO work_rating_stats AS s (title, author, rating_count)
+        SELECT b.title, coalesce(b.author, ''), %s * sum(r.rating_count)
+        FROM books b JOIN book_rating_stats r USING (isbn)
+        WHERE b.isbn = ANY(%s)
+        GROUP BY b.title, coalesce(b.author, '')
+        ON CONFLICT (title, author) DO UPDATE
+        SET rating_count = s.rating_count + excluded.rating_count;
+        """, (sign, isbns))
+
+
+def add_book(cur: pg.Cursor,
+             author: str,
+             sign: int = 1) -> None:
+    """
+    apply one new (sign=1) or removed (sign=-1) book to the author counts,
+    runs in the caller's transaction
+    """
+    if author is None:
+        return
+    cur.execute("""
+        INSERT INTO author_book_stats AS s (author, book_count)
+        VALUES (%s, %s)
+        ON CONFLICT (author) DO UPDATE
+        SET book_count = s.book_count + excluded.book_count;
+        """, (author, sign))
+
+
+if __name__ == "__main__":
+    # python summaries.py rebuild
+    if sys.argv[1:] != ['rebuild']:
+        print("usage: python summaries.py rebuild")
+        sys.exit(1)
+
+    with cb.connection() as conn:
+        rebuild(conn)
+    print("Summary tables rebuilt")
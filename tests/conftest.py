@@ -0,0 +1,136 @@
+import os
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+# the modules live at the top of the repository, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# set before instrument is imported, keep the slow query log out of the tree
+os.environ.setdefault('BOOKS_SLOW_LOG', os.path.join(tempfile.gettempdir(), 'books_test_slow_queries.log'))
+
+import connect_books as cb
+import instrument
+import loader
+import migrations
+import query_cache
+import sqlite_backend
+import summaries
+
+# a small dataset every test starts from, same layout as the csv files
+BOOKS = [
+    ('0000000011', 'The Shining', 'Stephen King', '1977', 'Doubleday', None, None, None),
+    ('0000000022', 'It', 'Stephen King', '1986', 'Viking', None, None, None),
+    ('0000000033', 'Carrie', 'Stephen King', '1974', 'Doubleday', None, None, None),
+    ('0000000044', 'Emma', 'Jane Austen', '1815', 'Murray', None, None, None),
+    ('0000000055', 'Persuasion', 'Jane Austen', '1817', 'Murray', None, None, None),
+    ('0000000066', 'Dune', 'Frank Herbert', '1965', 'Chilton', None, None, None),
+    ('0000000077', 'Unread', "O'Brien, Flann", '1967', 'MacGibbon', None, None, None),
+]
+USERS = [(str(i), f"city {i}", str(20 + i)) for i in range(1, 7)]
+RATINGS = [
+    ('1', '0000000011', '9'), ('1', '0000000022', '8'), ('1', '0000000044', '0'),
+    ('2', '0000000011', '10'), ('2', '0000000022', '7'), ('2', '0000000066', '0'),
+    ('3', '0000000011', '5'), ('3', '0000000033', '6'), ('3', '0000000055', '0'),
+    ('4', '0000000044', '8'), ('4', '0000000055', '9'),
+    ('5', '0000000066', '10'), ('5', '0000000011', '0'),
+    ('6', '0000000011', '7'),
+]
+
+
+def load_sample(conn) -> None:
+    migrations.migrate(conn)
+    for table, rows in (('books', BOOKS), ('users', USERS), ('ratings', RATINGS)):
+        loader.copy_rows(conn, table, rows, progress=False)
+    summaries.rebuild(conn)
+
+
+@pytest.fixture(autouse=True)
+def fresh_state():
+    # the cache and the read-your-writes clock are process wide
+    query_cache.cache.clear()
+    yield
+    query_cache.cache.clear()
+    cb.close_pool()
+
+
+@pytest.fixture
+def sqlite_path(tmp_path):
+    path = str(tmp_path / 'books.sqlite')
+    conn = instrument.install(sqlite_backend.connect(path))
+    load_sample(conn)
+    conn.close()
+    return path
+
+
+@pytest.fixture
+def sqlite_db(sqlite_path):
+    conn = instrument.install(sqlite_backend.connect(sqlite_path))
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def sqlite_pool(sqlite_path, monkeypatch):
+    """
+    the process wide pool (cb.connection) on the sample snapshot
+    """
+    monkeypatch.setenv('BOOKS_BACKEND', 'sqlite')
+    monkeypatch.setenv('BOOKS_SQLITE_PATH', sqlite_path)
+    cb.close_pool()
+    yield sqlite_path
+    cb.close_pool()
+
+
+@pytest.fixture(scope='session')
+def pg_dsn():
+    """
+    a scratch database on the server of BOOKS_TEST_DSN, tests that need
+    postgres are skipped without it
+    """
+    dsn = os.environ.get('BOOKS_TEST_DSN')
+    if not dsn:
+        pytest.skip("set BOOKS_TEST_DSN to run the postgres tests")
+    import psycopg as pg
+    from psycopg.conninfo import make_conninfo
+
+    name = f"books_test_{uuid.uuid4().hex[:8]}"
+    with pg.connect(dsn, autocommit=True) as admin:
+        admin.execute(f"CREATE DATABASE {name}")
+    try:
+        yield make_conninfo(dsn, dbname=name)
+    finally:
+        with pg.connect(dsn, autocommit=True) as admin:
+            admin.execute(f"DROP DATABASE IF EXISTS {name} WITH (FORCE)")
+
+
+@pytest.fixture
+def pg_db(pg_dsn, monkeypatch):
+    """
+    a connection to the scratch database loaded with the sample, the process
+    wide pool points at it too
+    """
+    import psycopg as pg
+
+    monkeypatch.setenv('BOOKS_DSN', pg_dsn)
+    monkeypatch.delenv('BOOKS_BACKEND', raising=False)
+    monkeypatch.delenv('BOOKS_REPLICA_DSNS', raising=False)
+    cb.close_pool()
+    conn = instrument.install(pg.connect(pg_dsn))
+    conn.autocommit = True
+    conn.execute("DROP SCHEMA public CASCADE")
+    conn.execute("CREATE SCHEMA public")
+    conn.autocommit = False
+    load_sample(conn)
+    yield conn
+    conn.close()
+    cb.close_pool()
+
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+def db(request):
+    """
+    the sample on both backends, for the queries that must agree
+    """
+    return request.getfixturevalue('sqlite_db' if request.param == 'sqlite' else 'pg_db')
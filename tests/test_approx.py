@@ -0,0 +1,17 @@
+import approx
+from ratings import Ratings
+
+
+def test_full_sample_gives_the_exact_average(db):
+    # percent=100 reads every rating
+    [(avg, books, bound)] = approx.avg_rating_by_author(db, 'Stephen King', 100)
+    assert (avg, books) == (6.5, 3)
+    assert bound > 0
+    assert Ratings.get_avg_rating_by_author_approx(db, 'stephen king', 100)[0][:2] == (6.5, 3)
+
+
+def test_author_missing_from_the_sample_gets_the_exact_answer(db):
+    # a 0 percent sample holds no ratings
+    assert approx.avg_rating_by_author(db, 'Jane Austen', 0) == [(
+        *Ratings.get_avg_rating_by_author(db, 'Jane Austen')[0], 0.0)]
+    assert approx.avg_rating_by_author(db, 'nobody', 0) is None
@@ -0,0 +1,31 @@
+import asyncio
+
+import async_queries
+from async_queries import AsyncQueryEngine
+
+
+def test_fan_out_matches_the_sync_queries(pg_db, pg_dsn):
+    async def main():
+        async with AsyncQueryEngine(pg_dsn, concurrency=2) as engine:
+            return await engine.fan_out(engine.get_title_by_isbn, ['0000000011', '0000000044', 'missing'])
+
+    assert async_queries.run(main()) == ['The Shining', 'Emma', None]
+
+
+def test_timeout_cancels_the_query_and_the_pool_recovers(pg_db, pg_dsn):
+    async def main():
+        async with AsyncQueryEngine(pg_dsn, concurrency=1, timeout=0.2) as engine:
+            try:
+                await engine._fetch("SELECT pg_sleep(5)")
+            except asyncio.TimeoutError:
+                pass
+            else:
+                raise AssertionError("no timeout")
+            # the only connection was replaced
+            return await engine.get_title_by_isbn('0000000066')
+
+    assert async_queries.run(main()) == 'Dune'
+    running = pg_db.execute("SELECT count(*) FROM pg_stat_activity "
+                            "WHERE query LIKE 'SELECT pg_sleep(5)%' AND state = 'active'").fetchone()[0]
+    pg_db.rollback()
+    assert running == 0
@@ -0,0 +1,31 @@
+import io
+import json
+
+import batch
+from books import Books
+
+
+def test_isbn_lookups_in_chunks(sqlite_pool):
+    out = io.StringIO()
+    stats = batch.run('isbn', batch.read_queries(io.StringIO("0000000011\n\nmissing\n 0000000066\n")),
+                      out, chunk_size=2)
+    assert (stats['queries'], stats['found'], stats['round_trips']) == (3, 2, 2)
+    assert out.getvalue().splitlines() == ['query,found,title', '0000000011,true,The Shining',
+                                           'missing,false,', ' 0000000066,true,Dune']
+
+
+def test_author_ratings_as_json_lines(sqlite_pool):
+    out = io.StringIO()
+    batch.run('author-rating', ['Stephen King', 'nobody'], out, fmt='json')
+    rows = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [(row['query'], row['found'], row.get('num_books')) for row in rows] == [
+        ('Stephen King', True, 3), ('nobody', False, None)]
+    assert float(rows[0]['avg_rating']) == 6.5
+
+
+def test_batch_lookups(db):
+    assert Books.get_titles_by_isbns(db, ['0000000011', '0000000066', 'missing']) == {
+        '0000000011': 'The Shining', '0000000066': 'Dune'}
+    books = Books.get_books_by_authors(db, ['Jane Austen', 'frank herbert'])
+    assert [row[0] for row in books['jane austen']] == ['Emma', 'Persuasion']
+    assert [row[0] for row in books['frank herbert']] == ['Dune']
@@ -0,0 +1,25 @@
+from books import Books
+
+
+def test_title_by_isbn(db):
+    assert Books.get_title_by_isbn(db, ' 0000000044 ') == 'Emma'
+    assert Books.get_title_by_isbn(db, '9999999999') is None
+
+
+def test_books_by_author_matches_the_key_column(db):
+    # punctuation and case do not matter, the stored author_key is compared
+    rows = Books.get_books_by_author(db, "o'brien, FLANN")
+    assert [row[0] for row in rows] == ['Unread']
+    assert Books.get_books_by_author(db, 'nobody') is None
+
+
+def test_top_authors_from_the_summary(db):
+    assert Books.get_top_n_authors(db, 2) == [('Stephen King', 3), ('Jane Austen', 2)]
+
+
+def test_insert_book_updates_author_counts(db):
+    assert Books.insert_book(db, '0000000088', 'Misery', 'Stephen King', 1987, 'Viking')
+    assert Books.get_top_n_authors(db, 1) == [('Stephen King', 4)]
+    # duplicate key
+    assert not Books.insert_book(db, '0000000088', 'Misery', 'Stephen King', 1987, 'Viking')
+    assert Books.get_top_n_authors(db, 1) == [('Stephen King', 4)]
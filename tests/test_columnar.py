@@ -0,0 +1,40 @@
+import pytest
+
+pytest.importorskip('numpy')
+
+import columnar
+import summaries
+from books import Books
+from ratings import Ratings
+
+
+@pytest.fixture
+def engine(db, tmp_path):
+    # a NULL rating is a review but not part of any average
+    db.execute("INSERT INTO ratings (user_id, isbn, book_rating) VALUES (%s, %s, %s)", (6, '0000000022', None))
+    db.commit()
+    summaries.rebuild(db)
+    columnar.export(db, str(tmp_path))
+    return columnar.ColumnarEngine(str(tmp_path))
+
+
+def as_float(rows):
+    # sqlite hands back floats, postgres and the engine Decimals
+    return rows and [(float(avg), n) for avg, n in rows]
+
+
+def test_averages_match_sql(db, engine):
+    for author in ['Stephen King', 'jane austen', 'nobody']:
+        assert as_float(engine.get_avg_rating_by_author(author)) == \
+            as_float(Ratings.get_avg_rating_by_author(db, author))
+    assert float(engine.get_avg_rating_from_most_reviews()) == float(Ratings.get_avg_rating_from_most_reviews(db))
+
+
+def test_halves_round_away_from_zero(engine):
+    # (0 + 8 + 0 + 9) / 4 is 4.25, round(4.25, 1) in python would give 4.2
+    assert str(engine.get_avg_rating_by_author('Jane Austen')[0][0]) == '4.3'
+
+
+def test_top_lists_match_sql(db, engine):
+    assert engine.get_top_n_books(1) == Ratings.get_top_n_books(db, 1)
+    assert engine.get_top_n_authors(2) == Books.get_top_n_authors(db, 2)
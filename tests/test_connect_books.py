@@ -0,0 +1,144 @@
+import pytest
+
+import connect_books as cb
+import paging
+import sqlite_backend
+from ratings import Ratings
+
+
+def make_pool(path, **kwargs):
+    return cb.ConnectionPool(path, factory=lambda: sqlite_backend.connect(path), **kwargs)
+
+
+def test_pool_reuses_connections(sqlite_path):
+    pool = make_pool(sqlite_path, min_size=1, max_size=2)
+    for _ in range(5):
+        with pool.connection() as conn:
+            assert conn.execute("SELECT count(*) FROM books").fetchone()[0] == 7
+    s = pool.get_stats()
+    assert s['connections_opened'] == 1
+    assert s['checkouts'] == 5
+    pool.close()
+
+
+def test_pool_times_out_at_max_size(sqlite_path):
+    pool = make_pool(sqlite_path, min_size=0, max_size=1)
+    conn = pool.getconn()
+    with pytest.raises(cb.PoolTimeout):
+        pool.getconn(timeout=0.05)
+    pool.putconn(conn)
+    assert pool.getconn(timeout=0.05) is conn
+    pool.close()
+
+
+def test_failed_open_gives_its_slot_back(sqlite_path):
+    fail = [True]
+
+    def factory():
+        if fail[0]:
+            raise OSError("no route to host")
+        return sqlite_backend.connect(sqlite_path)
+
+    pool = cb.ConnectionPool(sqlite_path, factory=factory, min_size=0, max_size=1)
+    for _ in range(3):
+        with pytest.raises(OSError):
+            pool.getconn(timeout=0.05)
+    fail[0] = False
+    pool.putconn(pool.getconn(timeout=0.05))
+    pool.close()
+
+
+def test_pool_replaces_broken_connection(sqlite_path):
+    pool = make_pool(sqlite_path, min_size=1, max_size=1)
+    conn = pool.getconn()
+    pool.putconn(conn)
+    # dies while idle in the pool
+    conn.close()
+    fresh = pool.getconn()
+    assert fresh is not conn
+    assert pool.get_stats()['health_check_failures'] == 1
+    pool.putconn(fresh)
+    pool.close()
+
+
+def test_pool_recycles_expired_connections(sqlite_path):
+    pool = make_pool(sqlite_path, min_size=0, max_size=1, max_lifetime=0)
+    first = pool.getconn()
+    pool.putconn(first)
+    second = pool.getconn()
+    assert second is not first
+    assert pool.get_stats()['recycled'] == 1
+    pool.putconn(second)
+    pool.close()
+
+
+def test_pool_rolls_back_returned_connection(sqlite_path):
+    pool = make_pool(sqlite_path, min_size=1, max_size=1)
+    with pool.connection() as conn:
+        conn.execute("DELETE FROM ratings")
+    with pool.connection() as conn:
+        assert conn.execute("SELECT count(*) FROM ratings").fetchone()[0] > 0
+    pool.close()
+
+
+def test_process_pool_from_settings(sqlite_pool):
+    with cb.connection() as first:
+        pass
+    with cb.connection(readonly=True) as second:
+        assert second is first
+    assert cb.get_pool().get_stats()['connections_opened'] == 1
+
+
+@pytest.fixture
+def replica(pg_db, pg_dsn, monkeypatch):
+    """
+    the scratch database again as a replica, told apart by application_name
+    """
+    monkeypatch.setenv('BOOKS_REPLICA_DSNS', pg_dsn + ' application_name=replica')
+    monkeypatch.setenv('BOOKS_STICKY_SECONDS', '60')
+    cb.close_pool()
+    # loading the sample wrote in the process session
+    with cb.session():
+        yield cb.get_replicas()
+    cb.close_pool()
+
+
+def served_by(conn):
+    rv = conn.execute("SELECT current_setting('application_name')").fetchone()[0]
+    conn.rollback()
+    return rv or 'primary'
+
+
+def test_writes_keep_reads_of_their_session_on_the_primary(replica):
+    assert cb.read(served_by) == 'replica'
+    with cb.session():
+        cb.mark_written()
+        assert cb.read(served_by) == 'primary'
+        with cb.session():
+            # another client
+            assert cb.read(served_by) == 'replica'
+        assert cb.read(served_by) == 'primary'
+    assert cb.read(served_by) == 'replica'
+
+
+def test_read_is_retried_when_the_replica_dies(replica):
+    def lookup(conn):
+        if served_by(conn) == 'replica':
+            conn.execute("SELECT pg_terminate_backend(pg_backend_pid())")
+        return served_by(conn)
+
+    assert cb.read(lookup) == 'primary'
+    s = replica.get_stats()
+    assert (s['retried_reads'], s['failovers'], s['down']) == (1, 1, [True])
+
+
+def test_pages_are_retried_when_the_replica_dies(replica):
+    def page(conn, after, size):
+        if served_by(conn) == 'replica':
+            conn.execute("SELECT pg_terminate_backend(pg_backend_pid())")
+        return Ratings.get_top_books_page.uncached(conn, after, size)
+
+    # the fetch the console's pagers use
+    pager = paging.KeysetPager(paging.borrowing(cb.read, page), Ratings.top_books_key, 2, limit=3)
+    assert [row[0] for row in pager.rows()] == ['The Shining', 'Persuasion']
+    assert replica.get_stats()['retried_reads'] == 1
@@ -0,0 +1,6 @@
+import benchmark
+
+
+def test_menu_starts_without_the_heavy_modules():
+    # timings vary by machine, the imports do not
+    assert benchmark.startup(1, float('inf'))['eager_modules'] == []
@@ -0,0 +1,47 @@
+import csv
+
+import delta
+import summaries
+from conftest import BOOKS, RATINGS, USERS
+
+
+def write(directory, books=BOOKS, users=USERS, ratings=RATINGS):
+    for table, rows in (('books', books), ('users', users), ('ratings', ratings)):
+        with open(directory / f"{table}.csv", 'w', newline='', encoding='utf-8') as f:
+            csv.writer(f, delimiter=';').writerows([['' if v is None else v for v in row] for row in rows])
+
+
+def stats(db):
+    # a refresh leaves a row with nothing counted where a rebuild has none
+    rows = {table: sorted(row for row in db.execute(f"SELECT * FROM {table}") if row[1])
+            for table in ('book_rating_stats', 'user_rating_stats', 'author_book_stats')}
+    db.rollback()
+    return rows
+
+
+def test_refresh_applies_only_the_changes(db, tmp_path):
+    write(tmp_path)
+    for table in delta.ORDER:
+        delta.baseline(db, table, str(tmp_path / f"{table}.csv"))
+    assert delta.refresh(db, str(tmp_path))['ratings']['changed_buckets'] == 0
+
+    # one rating changed, one gone, one new user with a rating of a retitled book
+    ratings = [r for r in RATINGS if r[:2] != ('6', '0000000011')]
+    ratings[0] = ('1', '0000000011', '3')
+    ratings.append(('7', '0000000066', '6'))
+    books = [b if b[0] != '0000000066' else (b[0], 'Dune Messiah') + b[2:] for b in BOOKS]
+    write(tmp_path, books, USERS + [('7', 'city 7', '27')], ratings)
+
+    report = delta.refresh(db, str(tmp_path))
+    assert [report[t][k] for t in delta.ORDER for k in ('inserted', 'updated', 'deleted')] == \
+        [0, 1, 0, 1, 0, 0, 1, 1, 1]
+    assert db.execute("SELECT book_rating FROM ratings WHERE user_id = 1 AND isbn = %s",
+                      ('0000000011',)).fetchone()[0] == 3
+    assert db.execute("SELECT count(*) FROM ratings").fetchone()[0] == len(ratings)
+    db.rollback()
+
+    # the summaries were kept in step, a full rebuild agrees
+    kept = stats(db)
+    summaries.rebuild(db)
+    assert stats(db) == kept
+    assert delta.refresh(db, str(tmp_path))['ratings']['changed_buckets'] == 0
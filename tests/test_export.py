@@ -0,0 +1,40 @@
+import csv
+import glob
+import os
+
+import pytest
+
+import export
+
+
+def read(directory, report):
+    rows = []
+    for path in sorted(glob.glob(os.path.join(directory, f"{report}-*.csv"))):
+        with open(path, newline='', encoding='utf-8') as f:
+            header, *part = list(csv.reader(f))
+        rows += [dict(zip(header, row)) for row in part]
+    return rows
+
+
+def test_authors_report_in_key_order(db, tmp_path):
+    rv = export.export(db, 'authors', str(tmp_path), workers=3)
+    rows = read(str(tmp_path), 'authors')
+    assert rv['rows'] == len(rows) == 4
+    assert [row['author_key'] for row in rows] == sorted(row['author_key'] for row in rows)
+    king = next(row for row in rows if row['author'] == 'Stephen King')
+    assert (king['books'], king['ratings'], float(king['avg_rating'])) == ('3', '8', 6.5)
+    # no ratings, still listed
+    assert next(row for row in rows if row['author'] == "O'Brien, Flann")['avg_rating'] == ''
+
+
+def test_books_report_groups_editions(db, tmp_path):
+    db.execute("INSERT INTO books (isbn, title, author) VALUES (%s, %s, %s)", ('0000000088', 'Dune', 'Frank Herbert'))
+    db.commit()
+    export.export(db, 'books', str(tmp_path), workers=2)
+    dune = [row for row in read(str(tmp_path), 'books') if row['title'] == 'Dune']
+    assert [(row['editions'], row['ratings']) for row in dune] == [('2', '2')]
+
+
+def test_unknown_report(db, tmp_path):
+    with pytest.raises(ValueError):
+        export.export(db, 'users', str(tmp_path))
@@ -0,0 +1,28 @@
+import hashlib
+
+import gen_data
+import ingest
+import loader
+
+
+def digests(directory):
+    return {name: hashlib.sha256((directory / f"{name}.csv").read_bytes()).hexdigest()
+            for name in ('books', 'users', 'ratings')}
+
+
+def test_same_seed_same_files(tmp_path):
+    counts = gen_data.generate(str(tmp_path / 'a'), scale=0.001)
+    gen_data.generate(str(tmp_path / 'b'), scale=0.001)
+    gen_data.generate(str(tmp_path / 'c'), scale=0.001, seed=7)
+    assert digests(tmp_path / 'a') == digests(tmp_path / 'b') != digests(tmp_path / 'c')
+
+    ratings = list(loader.read_csv(str(tmp_path / 'a' / 'ratings.csv')))
+    assert len(ratings) == counts['ratings']
+    # one rating per user and book, every isbn valid
+    assert len({(user, isbn) for user, isbn, _ in ratings}) == len(ratings)
+    assert all(ingest.normalize_isbn(isbn) == isbn for _, isbn, _ in ratings)
+
+
+def test_isbn10_check_digit():
+    assert gen_data.isbn10(19852663) == '0198526636'
+    assert gen_data.isbn10(80442957) == '080442957X'
@@ -0,0 +1,61 @@
+import csv
+
+import ingest
+
+
+def test_normalize_isbn():
+    assert ingest.normalize_isbn(' 0-19-852663-6 ') == '0198526636'
+    assert ingest.normalize_isbn('978-0-19-852663-6') == '9780198526636'
+
+
+def test_bad_rows_go_to_the_reject_file(tmp_path):
+    raw = tmp_path / 'ratings.csv'
+    raw.write_bytes(b'"User-ID";"ISBN";"Book-Rating"\n'
+                    b'1;"0-19-852663-6";"5"\n'
+                    b'2;"0198526636";"11"\n'
+                    b'x;"0198526636";"5"\n'
+                    b'3;"not an isbn";"5"\n'
+                    b'1;"0198526636";"7"\n'
+                    b'4;"019852663X";"0";"extra"\n'
+                    b'5;"019852663x";"8"\n')
+    rejects = tmp_path / 'rejects.csv'
+    job = ingest.Ingest('ratings', str(raw), str(rejects))
+    assert list(job.rows()) == [[1, '0198526636', 5], [5, '019852663X', 8]]
+
+    with open(rejects, newline='', encoding='utf-8') as f:
+        rows = list(csv.reader(f, delimiter=';'))[1:]
+    assert [(line, stage) for line, stage, _, _ in rows] == [
+        ('3', 'coerce'), ('4', 'coerce'), ('5', 'normalize'), ('6', 'dedupe'), ('7', 'normalize')]
+    report = job.stats.report()
+    assert report['stages']['dedupe'] == {**report['stages']['dedupe'], 'in': 3, 'out': 2}
+    assert report['rejects']['dedupe: duplicate key'] == 1
+
+
+def test_latin1_lines_are_decoded(tmp_path):
+    raw = tmp_path / 'users.csv'
+    raw.write_bytes('1;"m\xfcnchen, germany";"30"\n2;"nowhere";"NULL"\n'.encode('latin-1'))
+    job = ingest.Ingest('users', str(raw))
+    assert list(job.rows()) == [[1, 'münchen, germany', '30'], [2, 'nowhere', None]]
+    assert job.stats.fixed['decode: cp1252 line'] == 1
+
+
+def test_load_copies_the_clean_rows(db, tmp_path):
+    raw = tmp_path / 'users.csv'
+    raw.write_text('7;"a";"20"\n8;"b";"200"\nbad;"c";"1"\n', encoding='utf-8')
+    loaded, job = ingest.load(db, 'users', str(raw), str(tmp_path / 'rejects.csv'))
+    assert loaded == 2
+    assert db.execute("SELECT age FROM users WHERE user_id = 8").fetchone()[0] is None
+    db.rollback()
+
+
+def test_ratings_of_unknown_books_and_users_are_rejected(db, tmp_path):
+    raw = tmp_path / 'ratings.csv'
+    raw.write_text('6;"0000000022";"4"\n6;"0000000099";"5"\n99;"0000000033";"6"\n', encoding='utf-8')
+    rejects = tmp_path / 'rejects.csv'
+    loaded, job = ingest.load(db, 'ratings', str(raw), str(rejects))
+    assert loaded == 1
+    assert job.stats.reasons == {'exists: isbn not in books': 1, 'exists: user_id not in users': 1}
+    with open(rejects, newline='', encoding='utf-8') as f:
+        assert [row[:2] for row in list(csv.reader(f, delimiter=';'))[1:]] == [['2', 'exists'], ['3', 'exists']]
+    assert db.execute("SELECT count(*) FROM ratings").fetchone()[0] == 15
+    db.rollback()
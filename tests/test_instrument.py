@@ -0,0 +1,57 @@
+import pytest
+
+import instrument
+import paging
+
+
+@pytest.fixture
+def slow_log(monkeypatch):
+    logged = []
+
+    class Log:
+        def info(self, msg):
+            logged.append(msg)
+
+    monkeypatch.setattr(instrument, 'slow_log', Log)
+    return logged
+
+
+def test_timed_labels_queries_and_keeps_latencies(sqlite_db):
+    with instrument.timed('test-option'):
+        sqlite_db.execute("SELECT count(*) FROM books").fetchone()
+    assert instrument.records[-1]['label'] == 'test-option'
+    assert instrument.records[-1]['rows'] == 1
+    assert instrument.latency_summary()['test-option']['count'] >= 1
+
+
+def test_slow_queries_are_logged(sqlite_db, slow_log, monkeypatch):
+    monkeypatch.setattr(instrument, 'SLOW_MS', 0)
+    sqlite_db.execute("SELECT title FROM books").fetchall()
+    assert len(slow_log) == 1
+    assert '7 rows' in slow_log[0]
+
+
+def test_result_bytes_are_estimated(pg_db):
+    cur = pg_db.execute("SELECT repeat('x', 10) FROM generate_series(1, 100)")
+    cur.fetchall()
+    assert instrument.records[-1]['bytes'] == 1000
+    pg_db.rollback()
+
+
+def test_server_cursor_checked_after_its_fetches(pg_db, slow_log, monkeypatch):
+    monkeypatch.setattr(instrument, 'SLOW_MS', 100)
+    monkeypatch.setattr(instrument, 'EXPLAIN', True)
+    # DECLARE is instant, the time is spent fetching
+    rows = list(paging.stream(pg_db, "SELECT pg_sleep(0.05), g FROM generate_series(1, 4) g", (), 2))
+    pg_db.rollback()
+    assert len(rows) == 4
+    assert len(slow_log) == 1
+    assert '4 rows' in slow_log[0]
+    assert 'Function Scan' in slow_log[0]
+
+
+def test_server_cursor_closed_early_is_checked(pg_db, slow_log, monkeypatch):
+    monkeypatch.setattr(instrument, 'SLOW_MS', 50)
+    assert len(paging.fetch_page(pg_db, "SELECT pg_sleep(0.06), g FROM generate_series(1, 10) g", (), 1)) == 1
+    pg_db.rollback()
+    assert len(slow_log) == 1
@@ -0,0 +1,35 @@
+import pytest
+
+import loader
+
+
+def users(ids, bad=None):
+    return [('x' if i == bad else str(i), f"city {i}", '30') for i in ids]
+
+
+def count(conn, table='users'):
+    n = conn.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+    conn.rollback()
+    return n
+
+
+def test_failed_copy_resumes_after_the_last_chunk(pg_db):
+    import psycopg as pg
+
+    with pytest.raises(pg.Error):
+        loader.copy_rows(pg_db, 'users', users(range(100, 110), bad=107), source='users.csv',
+                         chunk_rows=3, progress=False)
+    # two chunks of three were committed before the bad one
+    assert loader.get_progress(pg_db, 'users', 'users.csv') == 6
+    assert loader.get_progress(pg_db, 'users', 'other.csv') == 0
+    assert count(pg_db) == 12
+
+    assert loader.copy_rows(pg_db, 'users', users(range(100, 110)), source='users.csv',
+                            chunk_rows=3, progress=False) == 4
+    assert count(pg_db) == 16
+    assert loader.get_progress(pg_db, 'users', 'users.csv') == 0
+
+
+def test_sqlite_inserts_in_chunks(sqlite_db):
+    assert loader.copy_rows(sqlite_db, 'users', users(range(100, 105)), chunk_rows=2, progress=False) == 5
+    assert count(sqlite_db) == 11
@@ -0,0 +1,60 @@
+import loader
+import migrations
+from conftest import BOOKS, USERS, RATINGS
+
+
+def empty_schema(conn):
+    conn.autocommit = True
+    conn.execute("DROP SCHEMA public CASCADE")
+    conn.execute("CREATE SCHEMA public")
+    conn.autocommit = False
+
+
+def test_all_migrations_applied_in_order(pg_db):
+    assert sorted(migrations.applied(pg_db)) == [m.version for m in migrations.MIGRATIONS]
+    assert migrations.migrate(pg_db) == []
+    assert migrations._relkind(pg_db, 'ratings') == 'p'
+
+
+def test_partitioning_a_loaded_table_waits_for_maintenance(pg_db):
+    empty_schema(pg_db)
+    assert migrations.migrate(pg_db, target=6) == [1, 2, 3, 4, 5, 6]
+    for table, rows in (('books', BOOKS), ('users', USERS), ('ratings', RATINGS)):
+        loader.copy_rows(pg_db, table, rows, progress=False)
+
+    # stops before the copy, and before what comes after it
+    assert migrations.migrate(pg_db) == []
+    assert migrations._relkind(pg_db, 'ratings') == 'r'
+    pg_db.rollback()
+
+    assert migrations.migrate(pg_db, maintenance=True) == [7, 8, 9]
+    assert migrations._relkind(pg_db, 'ratings') == 'p'
+    assert pg_db.execute("SELECT count(*) FROM ratings").fetchone()[0] == len(RATINGS)
+    pg_db.rollback()
+
+
+def test_rated_count_is_filled_in_on_an_older_schema(pg_db):
+    empty_schema(pg_db)
+    assert migrations.migrate(pg_db, target=8) == [1, 2, 3, 4, 5, 6, 7, 8]
+    # user_rating_stats as migration 3 built it before the column existed
+    pg_db.execute("ALTER TABLE user_rating_stats DROP COLUMN rated_count")
+    pg_db.commit()
+    for table, rows in (('books', BOOKS), ('users', USERS), ('ratings', RATINGS + [('6', '0000000022', '')])):
+        loader.copy_rows(pg_db, table, rows, progress=False)
+    pg_db.execute("INSERT INTO user_rating_stats (user_id, review_count, rating_sum) "
+                  "SELECT user_id, count(*), coalesce(sum(book_rating), 0) FROM ratings GROUP BY user_id")
+    pg_db.commit()
+
+    assert migrations.migrate(pg_db) == [9]
+    assert pg_db.execute("SELECT review_count, rated_count FROM user_rating_stats WHERE user_id = 6").fetchone() == (2, 1)
+    pg_db.rollback()
+
+
+def test_drop_sets_the_version_back_consistently(pg_db):
+    migrations.drop(pg_db, 'ratings')
+    # the base tables migration built ratings, so everything is redone
+    assert migrations.applied(pg_db) == {}
+    assert migrations.migrate(pg_db) == [m.version for m in migrations.MIGRATIONS]
+    assert migrations._relkind(pg_db, 'ratings') == 'p'
+    assert pg_db.execute("SELECT count(*) FROM books").fetchone()[0] == len(BOOKS)
+    pg_db.rollback()
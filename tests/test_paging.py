@@ -0,0 +1,63 @@
+import paging
+from books import Books
+
+
+def list_pager(rows, page_size, limit=None):
+    def fetch(after, size):
+        start = 0 if after is None else rows.index(after[0]) + 1
+        return rows[start:start + size]
+    return paging.KeysetPager(fetch, lambda row: (row,), page_size, limit=limit)
+
+
+def test_pager_walks_forward_and_back():
+    pager = list_pager(list(range(10)), 4)
+    assert pager.rows() == [0, 1, 2, 3]
+    assert pager.next()
+    assert pager.rows() == [4, 5, 6, 7]
+    assert pager.next()
+    assert pager.rows() == [8, 9]
+    assert not pager.has_next()
+    assert pager.prev()
+    assert pager.rows() == [4, 5, 6, 7]
+    assert pager.page_number == 2
+
+
+def test_pager_stops_at_limit():
+    pager = list_pager(list(range(10)), 4, limit=6)
+    assert pager.rows() == [0, 1, 2, 3]
+    assert pager.next()
+    assert pager.rows() == [4, 5]
+    assert not pager.has_next()
+
+
+def test_stream_and_fetch_page(sqlite_db):
+    rows = list(paging.stream(sqlite_db, "SELECT isbn FROM books ORDER BY isbn", (), 2))
+    assert len(rows) == 7
+    assert paging.fetch_page(sqlite_db, "SELECT isbn FROM books ORDER BY isbn", (), 3) == rows[:3]
+
+
+def test_books_by_author_pages(db):
+    pager = Books.books_by_author_pager(lambda func, *args: func(db, *args), 'stephen king', 2)
+    isbns = [row[3] for row in pager.rows()]
+    while pager.next():
+        isbns += [row[3] for row in pager.rows()]
+    assert isbns == ['0000000011', '0000000022', '0000000033']
+
+
+def test_pager_borrows_a_connection_per_page():
+    lent = []
+
+    def read(func, *args):
+        lent.append('out')
+        try:
+            return func('conn', *args)
+        finally:
+            lent.append('back')
+
+    pager = paging.KeysetPager(paging.borrowing(read, lambda conn, after, size: [conn] * size),
+                               lambda row: (row,), 2, limit=4)
+    assert pager.rows() == ['conn', 'conn']
+    assert lent == ['out', 'back']
+    pager.next()
+    pager.rows()
+    assert lent == ['out', 'back'] * 2
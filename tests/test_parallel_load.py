@@ -0,0 +1,35 @@
+import parallel_load
+from conftest import RATINGS
+
+
+def count(conn, table='users'):
+    n = conn.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+    conn.rollback()
+    return n
+
+
+def test_partitions_start_on_line_boundaries(tmp_path):
+    path = tmp_path / 'ratings.csv'
+    path.write_text(''.join(f'{u};"{isbn}";"{r}"\n' for u, isbn, r in RATINGS), encoding='utf-8')
+    for count_ in (1, 3, 5, 100):
+        ranges = parallel_load.partitions(str(path), count_)
+        assert ranges[0][0] == 0 and ranges[-1][1] == path.stat().st_size
+        assert all(a[1] == b[0] for a, b in zip(ranges, ranges[1:]))
+        lines = [line for s, e in ranges for line in parallel_load.read_range(str(path), s, e)]
+        assert lines == path.read_text(encoding='utf-8').splitlines(keepends=True)
+
+
+def test_parallel_load_rebuilds_keys_and_checks_counts(pg_db, tmp_path):
+    path = tmp_path / 'users.csv'
+    path.write_text(''.join(f'{i};"city {i}";"30"\n' for i in range(100, 160)), encoding='utf-8')
+    indexes = pg_db.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'users' "
+                            "ORDER BY indexname").fetchall()
+    pg_db.rollback()
+
+    report = parallel_load.load(pg_db, 'users', str(path), workers=3, chunk_rows=7)
+    assert report['consistent'], report
+    assert (report['rows'], report['partitions']) == (60, 3)
+    assert count(pg_db) == 66
+    assert pg_db.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'users' "
+                         "ORDER BY indexname").fetchall() == indexes
+    pg_db.rollback()
@@ -0,0 +1,75 @@
+import time
+
+import query_cache
+import search
+from query_cache import QueryCache, _MISSING
+
+
+def test_lru_evicts_least_recently_used():
+    cache = QueryCache(max_entries=2)
+    cache.put('a', 1, ('books',))
+    cache.put('b', 2, ('books',))
+    assert cache.get('a') == 1
+    cache.put('c', 3, ('books',))
+    assert cache.get('b') is _MISSING
+    assert cache.get('a') == 1
+    assert cache.get_stats()['evictions'] == 1
+
+
+def test_bounded_by_bytes():
+    cache = QueryCache(max_entries=100, max_bytes=2000)
+    for i in range(50):
+        cache.put(i, list(range(20)), ('books',))
+    assert cache.get_stats()['bytes'] <= 2000
+
+
+def test_entries_expire():
+    cache = QueryCache(ttl=0.01)
+    cache.put('a', 1, ('books',))
+    time.sleep(0.02)
+    assert cache.get('a') is _MISSING
+    assert cache.get_stats()['expirations'] == 1
+
+
+def test_invalidate_drops_entries_of_the_table_only():
+    cache = QueryCache()
+    cache.put('title', 't', ('books',))
+    cache.put('avg', 5, ('books', 'ratings'))
+    cache.put('user', 'u', ('users',))
+    cache.invalidate('ratings')
+    assert cache.get('avg') is _MISSING
+    assert cache.get('title') == 't'
+    assert cache.get('user') == 'u'
+
+
+def test_cached_decorator_normalizes_and_keeps_none():
+    calls = []
+
+    @query_cache.cached('books', normalize=query_cache.match_key)
+    def lookup(conn, name):
+        calls.append(name)
+        return None
+
+    assert lookup(None, 'Stephen King') is None
+    assert lookup(None, 'stephen king!') is None
+    assert calls == ['Stephen King']
+    query_cache.invalidate('books')
+    lookup(None, 'Stephen King')
+    assert len(calls) == 2
+
+
+def test_cached_decorator_takes_keywords():
+    calls = []
+
+    @query_cache.cached('books')
+    def top(conn, n, k=5):
+        calls.append((n, k))
+        return n * k
+
+    assert top(None, 2) == top(None, 2, 5) == top(None, n=2, k=5) == 10
+    assert top(None, 2, k=3) == 6
+    assert calls == [(2, 5), (2, 3)]
+
+
+def test_cached_queries_take_keywords(db):
+    assert search.suggest_authors(db, 'ste', limit=1) == search.suggest_authors(db, 'ste', 1)
@@ -0,0 +1,86 @@
+import query_cache
+import summaries
+from ratings import Ratings
+
+
+def test_avg_rating_by_author(db):
+    [(avg, books)] = Ratings.get_avg_rating_by_author(db, 'Stephen King')
+    assert (float(avg), books) == (6.5, 3)
+    assert Ratings.get_avg_rating_by_author(db, 'nobody') is None
+
+
+def test_avg_ratings_by_authors(db):
+    rv = Ratings.get_avg_ratings_by_authors(db, ['Stephen King', 'jane austen', 'nobody'])
+    assert {key: (float(avg), n) for key, (avg, n) in rv.items()} == {
+        'stephen king': (6.5, 3), 'jane austen': (4.3, 2)}
+
+
+def test_books_avg_rating(db):
+    [(avg, title, author)] = Ratings.get_books_avg_rating(db, 'the shining', 'stephen king')
+    assert (float(avg), title, author) == (6.2, 'The Shining', 'Stephen King')
+
+
+def test_avg_rating_from_most_reviews(db):
+    # users 1, 2 and 3 have three reviews each, the lowest user_id wins
+    assert float(Ratings.get_avg_rating_from_most_reviews(db)) == 5.7
+
+
+def test_null_rating_is_a_review_but_not_in_the_average(db):
+    cur = db.cursor()
+    cur.execute("INSERT INTO ratings (user_id, isbn, book_rating) VALUES (%s, %s, %s)", (1, '0000000055', None))
+    summaries.add_review(cur, 1, '0000000055', None)
+    db.commit()
+    query_cache.invalidate('ratings')
+    # user 1 now has the most reviews, (9 + 8 + 0) / 3 like AVG()
+    assert float(Ratings.get_avg_rating_from_most_reviews(db)) == 5.7
+    summaries.rebuild(db)
+    assert float(Ratings.get_avg_rating_from_most_reviews(db)) == 5.7
+
+
+def test_top_books(db):
+    # ties are broken by title and author, descending
+    assert Ratings.get_top_n_books(db, 3) == [('The Shining', 'Stephen King', 5),
+                                              ('Persuasion', 'Jane Austen', 2),
+                                              ('It', 'Stephen King', 2)]
+
+
+def test_top_books_pages_match_the_top_list(db):
+    # a book without an author, its page ends on a key with author ''
+    db.execute("INSERT INTO books (isbn, title) VALUES (%s, %s)", ('0000000088', 'Zazie'))
+    for user_id in (5, 6):
+        db.execute("INSERT INTO ratings VALUES (%s, %s, %s)", (user_id, '0000000088', 7))
+    db.commit()
+    summaries.rebuild(db)
+
+    pager = Ratings.top_n_books_pager(lambda func, *args: func(db, *args), 4, 2)
+    rows = list(pager.rows())
+    while pager.next():
+        rows += pager.rows()
+    assert rows[1][:2] == ('Zazie', None)
+    assert [(title, author, int(count)) for title, author, count in rows] == Ratings.get_top_n_books(db, 4)
+
+
+def work_stats(db):
+    rows = db.execute("SELECT title, author, rating_count FROM work_rating_stats "
+                      "WHERE rating_count > 0 ORDER BY title, author").fetchall()
+    db.rollback()
+    return [(title, author, int(count)) for title, author, count in rows]
+
+
+def book_stats(db):
+    rows = db.execute("SELECT isbn, rating_count, rating_sum FROM book_rating_stats ORDER BY isbn").fetchall()
+    db.rollback()
+    return [(isbn, int(count), int(total)) for isbn, count, total in rows]
+
+
+def test_insert_review_keeps_summaries_and_cache_in_step(db):
+    assert Ratings.get_top_n_books(db, 2)[1] == ('Persuasion', 'Jane Austen', 2)
+    assert Ratings.insert_review(db, 6, '0000000066', 9)
+    assert Ratings.insert_review(db, 4, '0000000066', 8)
+    assert Ratings.insert_review(db, 3, '0000000066', 7)
+    # cached result dropped by the write
+    assert Ratings.get_top_n_books(db, 2) == [('The Shining', 'Stephen King', 5), ('Dune', 'Frank Herbert', 5)]
+
+    stats = book_stats(db), work_stats(db)
+    summaries.rebuild(db)
+    assert (book_stats(db), work_stats(db)) == stats
@@ -0,0 +1,30 @@
+import itertools
+
+import render
+
+
+def test_grid_layout_and_numeric_alignment():
+    assert list(render.table([('Emma', 2), ('It', 10)], ['Title', 'Ratings'], max_width=80)) == [
+        '+-------+---------+',
+        '| Title | Ratings |',
+        '+=======+=========+',
+        '| Emma  |       2 |',
+        '+-------+---------+',
+        '| It    |      10 |',
+        '+-------+---------+',
+    ]
+
+
+def test_lines_fit_the_width_and_wide_characters_count_twice():
+    rows = [('x' * 100, '日本語のタイトル')]
+    lines = list(render.table(rows, ['A', 'B'], max_width=30))
+    assert all(render.width(line) <= 30 for line in lines)
+    assert render.ELLIPSIS in lines[3]
+    assert render.width('日本') == 4
+
+
+def test_rows_are_read_lazily():
+    rows = ((str(i),) for i in itertools.count())
+    lines = render.Table(['n'], max_width=20, sample=5).lines(rows)
+    # an endless result still prints its first rows
+    assert next(itertools.islice(lines, 3, None)) == '| 0 |'
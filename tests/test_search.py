@@ -0,0 +1,17 @@
+import search
+
+
+def test_prefix_suggestions_ranked_by_ratings(db):
+    assert search.suggest_authors(db, 'ste') == [('Stephen King', 8)]
+    assert search.suggest_authors(db, "o'b") == [("O'Brien, Flann", 0)]
+    assert search.suggest_titles(db, 'pers') == [('Persuasion', 'Jane Austen', 2)]
+    assert search.suggest_titles(db, '!!') == []
+
+
+def test_typos_found_on_postgres(pg_db):
+    assert search.suggest_authors(pg_db, 'stephen kng')[0] == ('Stephen King', 8)
+
+
+def test_is_exact():
+    assert search.is_exact('stephen KING', 'Stephen King')
+    assert not search.is_exact('stephen', 'Stephen King')
@@ -0,0 +1,84 @@
+import asyncio
+import json
+
+import query_cache
+import service
+from ratings import Ratings
+
+
+async def request(port: int, target: str, keep_alive: bool = False) -> tuple[bytes, bytes]:
+    """
+    one GET, read until the service closes the connection
+    :return: head, body (still chunked)
+    """
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    connection = 'keep-alive' if keep_alive else 'close'
+    writer.write(f"GET {target} HTTP/1.1\r\nHost: test\r\nConnection: {connection}\r\n\r\n".encode('latin-1'))
+    await writer.drain()
+    data = await asyncio.wait_for(reader.read(), 5)
+    writer.close()
+    head, _, body = data.partition(b"\r\n\r\n")
+    return head, body
+
+
+def lines(body: bytes) -> list:
+    rv = []
+    while True:
+        size, _, rest = body.partition(b"\r\n")
+        size = int(size, 16)
+        if size == 0:
+            assert rest == b"\r\n"
+            return rv
+        rv += [json.loads(line) for line in rest[:size].decode('utf-8').splitlines()]
+        body = rest[size + 2:]
+
+
+def run(coro_func, page_rows: int = 2):
+    async def main():
+        svc = service.Service(concurrency=2, page_rows=page_rows)
+        await svc.open()
+        server = await asyncio.start_server(svc.handle, '127.0.0.1', 0)
+        try:
+            return await coro_func(server.sockets[0].getsockname()[1])
+        finally:
+            server.close()
+            await server.wait_closed()
+            svc.close()
+    return asyncio.run(main())
+
+
+def test_top_books_stream_in_pages(sqlite_pool):
+    head, body = run(lambda port: request(port, '/books/top?n=3'))
+    assert head.startswith(b"HTTP/1.1 200")
+    assert [(row['title'], row['ratings']) for row in lines(body)] == [
+        ('The Shining', 5), ('Persuasion', 2), ('It', 2)]
+
+
+def test_failure_mid_stream_ends_the_body_and_the_connection(sqlite_pool, monkeypatch):
+    page = Ratings.get_top_books_page.uncached
+
+    def failing(conn, after, size):
+        if after is not None:
+            raise RuntimeError("lost the database")
+        return page(conn, after, size)
+
+    monkeypatch.setattr(Ratings, 'get_top_books_page', staticmethod(failing))
+    # asks to keep the connection, the service closes it anyway
+    head, body = run(lambda port: request(port, '/books/top?n=5', keep_alive=True))
+    # one 200 whose last line is the error, no second response after it
+    assert head.startswith(b"HTTP/1.1 200")
+    rows = lines(body)
+    assert [row.get('title') for row in rows[:2]] == ['The Shining', 'Persuasion']
+    assert rows[2:] == [{'error': 'internal error'}]
+    assert b"HTTP/1.1" not in body
+
+
+def test_top_books_pages_come_from_the_cache(sqlite_pool):
+    async def twice(port):
+        first = await request(port, '/books/top?n=3')
+        hits = query_cache.cache.get_stats()['hits']
+        second = await request(port, '/books/top?n=3')
+        return first[1] == second[1], query_cache.cache.get_stats()['hits'] - hits
+
+    # two pages of two rows, both cached by the first request
+    assert run(twice) == (True, 2)
@@ -0,0 +1,39 @@
+import similarity
+import summaries
+
+
+def index(db):
+    rows = db.execute("SELECT isbn, neighbor_isbn, score, co_raters FROM book_neighbors "
+                      "ORDER BY isbn, neighbor_isbn").fetchall()
+    vectors = db.execute("SELECT isbn, rating_count, rating_sum FROM book_vectors ORDER BY isbn").fetchall()
+    db.rollback()
+    return [(a, b, round(score, 6), n) for a, b, score, n in rows], [(isbn, int(c), int(s)) for isbn, c, s in vectors]
+
+
+def test_build_scores_shared_readers(db):
+    similarity.build(db)
+    neighbors, vectors = index(db)
+    # user 4 rated both Emma and Persuasion
+    assert ('0000000044', '0000000055') in [(a, b) for a, b, _, _ in neighbors]
+    # every rated book, Unread has no ratings
+    assert len(vectors) == 6
+    assert similarity.refresh(db)['books'] == 0
+
+
+def test_refresh_drops_books_without_raters_and_their_listings(db):
+    similarity.build(db)
+    # every rating of Persuasion goes, Emma listed it
+    cur = db.cursor()
+    for user_id, rating in ((3, 0), (4, 9)):
+        cur.execute("DELETE FROM ratings WHERE user_id = %s AND isbn = %s", (user_id, '0000000055'))
+        summaries.add_review(cur, user_id, '0000000055', rating, sign=-1)
+    db.commit()
+
+    stats = similarity.refresh(db)
+    assert (stats['books'], stats['removed']) == (1, 1)
+    refreshed = index(db)
+    assert '0000000055' not in [isbn for row in refreshed[0] for isbn in row[:2]]
+
+    similarity.build(db)
+    assert index(db) == refreshed
+    assert similarity.refresh(db)['books'] == 0
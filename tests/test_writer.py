@@ -0,0 +1,34 @@
+import time
+
+import writer
+
+
+def review_count(db):
+    count = db.execute("SELECT count(*) FROM ratings").fetchone()[0]
+    db.rollback()
+    return count
+
+
+def test_groups_commit_and_bad_rows_are_replayed(db):
+    with writer.BatchWriter(db, max_rows=3, max_delay=60) as w:
+        w.insert_review(6, '0000000022', 8)
+        w.insert_review(6, '0000000033', 7)
+        # duplicate user_id
+        bad = w.insert_user(1, 'elsewhere', '30')
+        w.insert_review(6, '0000000044', 6)
+    assert w.get_stats() == {'rows': 4, 'committed': 3, 'failed': 1, 'groups': 2, 'replayed_groups': 1}
+    assert [error.number for error in w.errors] == [bad]
+    assert review_count(db) == 17
+    assert db.execute("SELECT location FROM users WHERE user_id = 1").fetchone()[0] == 'city 1'
+    db.rollback()
+
+
+def test_partial_group_is_written_after_max_delay(db):
+    w = writer.BatchWriter(db, max_rows=100, max_delay=0.05)
+    w.insert_review(6, '0000000022', 8)
+    deadline = time.monotonic() + 5
+    while w.committed == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # no second row and no flush() call
+    assert w.get_stats()['groups'] == 1
+    assert review_count(db) == 15
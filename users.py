@@ -1,39 +1,53 @@
 import sqlite3 as sq
 import csv
+import psycopg as pg
 import connect_books as cb
+import loader
+import migrations
+import query_cache
 
 
 class Users:
     # class (static) data
-    dt = "DROP TABLE IF EXISTS users"
-    ct = """
-            CREATE TABLE IF NOT EXISTS users(
-            user_id  integer NOT NULL
-                CONSTRAINT users_pk
-                PRIMARY KEY,
-            location text,
-            age      text
-        );
-    """
     iit = "INSERT INTO users VALUES (?, ?, ?)"
 
-    def __init__(self, conn: cb.connect()):
-        self.conn = conn
+    def __init__(self, conn: pg.Connection = None):
+        # borrow a connection from the pool unless one was handed in
+        self.pooled = conn is None
+        self.conn = cb.get_pool().getconn() if self.pooled else conn
+
+    def close(self):
+        if self.pooled:
+            cb.get_pool().putconn(self.conn)
+            self.pooled = False
 
     def create_table(self):
-        self.conn.execute(Books.ct)
-        self.conn.commit()
+        # every table, see migrations (a sqlite snapshot gets its own dialect)
+        migrations.migrate(self.conn)
 
-    def load_users(self):
-        # context manager --> automatically closes file
-        with open('users.csv') as f:
-            reader = csv.reader(f, delimiter=';')
-            self.conn.executemany(Users.iit, list(reader))
-            self.conn.commit()
+    def load_users(self, path: str = 'users.csv', resume: bool = True, workers: int = 1,
+                   rejects: str = None):
+        """
+        stream users.csv into the users table with COPY, committing in chunks
+        :param path: ';' delimited csv file
+        :param resume: continue a previously failed load from its last chunk
+        :param workers: load in parallel with this many processes, see
+            parallel_load (no resume)
+        :param rejects: validate the raw file with ingest first, writing the
+            rows that fail here (always one process)
+        :return: number of rows loaded
+        """
+        if rejects:
+            import ingest
+            return ingest.load(self.conn, 'users', path, rejects, resume)[0]
+        if workers > 1:
+            import parallel_load
+            return parallel_load.load(self.conn, 'users', path, workers)['rows']
+        return loader.copy_csv(self.conn, 'users', path, resume=resume)
 
     def drop_table(self):
-        self.conn.execute(Users.dt)
-        self.conn.commit()
+        migrations.drop(self.conn, 'users')
+        loader.reset_progress(self.conn, 'users')
 
     # functions/queries specific to the parts table
     @staticmethod
@@ -43,10 +57,10 @@ class Users:
 
     # insert a user
     @staticmethod
-    def insert_user(conn: cb.connect(),
+    def insert_user(conn: pg.Connection,
                     user_id: int,
                     location: str,
-                    age: str) -> None:
+                    age: str) -> bool:
 
         cmd = """
             INSERT INTO
@@ -57,11 +71,15 @@ class Users:
 
         # get a cursor to execute the query
         cur = conn.cursor()
+        rv = True
         try:
             cur.execute(cmd, (user_id, location, age))
         except pg.Error as e:
             print(f"Error: {e}")
+            rv = False
 
         conn.commit()
+        query_cache.invalidate('users')
 
         cur.close()
+        return rv
@@ -0,0 +1,263 @@
+import argparse
+import contextlib
+import threading
+import time
+
+import psycopg as pg
+
+import loader
+import query_cache
+import sqlite_backend
+import summaries
+
+# row kind -> (insert statement, table), the summaries are kept in step in the
+# same transaction exactly like the single row insert_* methods do
+_inserts = {
+    'user': ("INSERT INTO users VALUES (%s, %s, %s)", 'users'),
+    'book': ("INSERT INTO books VALUES (%s, %s, %s, %s, %s, NULL, NULL, NULL)", 'books'),
+    'review': ("INSERT INTO ratings VALUES (%s, %s, %s)", 'ratings'),
+}
+
+DEFAULT_MAX_ROWS = 1000
+DEFAULT_MAX_DELAY = 0.5
+
+
+class RowError:
+    """
+    a queued row the database refused
+    """
+
+    def __init__(self, number: int, kind: str, values: tuple, message: str):
+        self.number = number
+        self.kind = kind
+        self.values = values
+        self.message = message
+
+    def __repr__(self):
+        return f"RowError({self.number}, {self.kind}, {self.values!r}, {self.message!r})"
+
+
+class BatchWriter:
+    """
+    queue inserts and write them in groups: a group is sent in one pipeline
+    (one round trip on postgres) and committed once, when max_rows rows are
+    queued or the oldest queued row is max_delay seconds old. A timer thread
+    writes a partial group when no more rows arrive, so don't use conn for
+    anything else while rows are queued.
+
+    If a group fails it is rolled back and replayed row by row, each row in
+    its own savepoint, so one bad row is reported in errors and the rest of
+    the group is still committed.
+    """
+
+    def __init__(self, conn: pg.Connection,
+                 max_rows: int = DEFAULT_MAX_ROWS,
+                 max_delay: float = DEFAULT_MAX_DELAY):
+        self.conn = conn
+        self.max_rows = max(max_rows, 1)
+        self.max_delay = max_delay
+        self.errors = []
+        self._queue = []
+        self._numbers = 0
+        # the timer flushes from its own thread
+        self._lock = threading.RLock()
+        self._timer = None
+
+        self.rows = 0
+        self.committed = 0
+        self.groups = 0
+        self.replayed_groups = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    def insert_user(self, user_id: int, location: str, age: str) -> int:
+        return self._add('user', (user_id, location, age))
+
+    def insert_book(self, isbn: str, title: str, author: str, year: int, publisher: str) -> int:
+        return self._add('book', (isbn, title, author, year, publisher))
+
+    def insert_review(self, user_id: int, isbn: str, rating: int) -> int:
+        return self._add('review', (user_id, isbn, rating))
+
+    def _add(self, kind: str, values: tuple) -> int:
+        """
+        :return: the row number, as used in errors
+        """
+        with self._lock:
+            self._numbers += 1
+            self._queue.append((self._numbers, kind, values))
+            self.rows += 1
+            if len(self._queue) >= self.max_rows:
+                self.flush()
+            elif self._timer is None:
+                # started by the first row of a group
+                self._timer = threading.Timer(self.max_delay, self._timed_flush)
+                self._timer.daemon = True
+                self._timer.start()
+            return self._numbers
+
+    def _timed_flush(self) -> None:
+        with self._lock:
+            # a flush since then may have started a newer timer
+            if self._timer is threading.current_thread():
+                self._timer = None
+                self._flush()
+
+    def reject(self, kind: str, values: tuple, message: str) -> int:
+        """
+        count a row that was refused before it reached the database (it could
+        not be parsed), so row numbers stay in step with the input
+        """
+        with self._lock:
+            self._numbers += 1
+            self.rows += 1
+            self.errors.append(RowError(self._numbers, kind, values, message))
+            return self._numbers
+
+    def _write(self, cur, kind: str, values: tuple) -> None:
+        cur.execute(_inserts[kind][0], values)
+        if kind == 'review':
+            summaries.add_review(cur, *values)
+        elif kind == 'book':
+            summaries.add_book(cur, values[2])
+
+    def flush(self) -> int:
+        """
+        write and commit everything queued
+        :return: number of rows committed
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            return self._flush()
+
+    def _flush(self) -> int:
+        queue, self._queue = self._queue, []
+        if not queue:
+            return 0
+
+        self.groups += 1
+        conn = self.conn
+        # sqlite has no pipeline, the group is still one transaction
+        pipeline = contextlib.nullcontext() if sqlite_backend.is_sqlite(conn) else conn.pipeline()
+        cur = conn.cursor()
+        try:
+            with pipeline:
+                for _, kind, values in queue:
+                    self._write(cur, kind, values)
+            conn.commit()
+            done = len(queue)
+        except pg.Error:
+            conn.rollback()
+            done = self._replay(cur, queue)
+        finally:
+            cur.close()
+
+        self.committed += done
+        query_cache.invalidate(*{_inserts[kind][1] for _, kind, _ in queue})
+        return done
+
+    def _replay(self, cur, queue: list) -> int:
+        """
+        write a failed group again one row at a time, skipping the rows that fail
+        :return: number of rows committed
+        """
+        self.replayed_groups += 1
+        done = 0
+        try:
+            cur.execute("SAVEPOINT writer_group")
+            for number, kind, values in queue:
+                cur.execute("SAVEPOINT writer_row")
+                try:
+                    self._write(cur, kind, values)
+                    cur.execute("RELEASE SAVEPOINT writer_row")
+                    done += 1
+                except pg.Error as e:
+                    cur.execute("ROLLBACK TO SAVEPOINT writer_row")
+                    self.errors.append(RowError(number, kind, values, str(e).strip()))
+            cur.execute("RELEASE SAVEPOINT writer_group")
+            self.conn.commit()
+        except pg.Error as e:
+            # the connection itself failed, nothing of the group was kept
+            self.conn.rollback()
+            print(f"Error: {e}")
+            failed = {error.number for error in self.errors}
+            self.errors.extend(RowError(number, kind, values, str(e).strip())
+                               for number, kind, values in queue if number not in failed)
+            done = 0
+        return done
+
+    def get_stats(self) -> dict:
+        return {
+            'rows': self.rows,
+            'committed': self.committed,
+            'failed': len(self.errors),
+            'groups': self.groups,
+            'replayed_groups': self.replayed_groups,
+        }
+
+
+def import_reviews(conn: pg.Connection,
+                   path: str,
+                   max_rows: int = DEFAULT_MAX_ROWS,
+                   max_delay: float = DEFAULT_MAX_DELAY,
+                   skip_header: bool = False,
+                   progress: bool = True) -> BatchWriter:
+    """
+    add the reviews of a ';' delimited user_id;isbn;rating file to the
+    ratings table, group committed, rows that can't be parsed or inserted
+    are collected in the returned writer's errors
+    :param conn: connection to the database
+    :param path: csv file, same layout as ratings.csv
+    :return: the writer, see get_stats() and errors
+    """
+    start = time.perf_counter()
+    writer = BatchWriter(conn, max_rows, max_delay)
+    with writer:
+        for number, record in enumerate(loader.read_csv(path, skip_header=skip_header), 1):
+            try:
+                user_id, isbn, rating = record
+                writer.insert_review(int(user_id), isbn.strip(), int(rating))
+            except ValueError:
+                writer.reject('review', tuple(record), "expected user_id;isbn;rating")
+            if progress and number % 100_000 == 0:
+                print(f"ratings: {number} rows read ({number / (time.perf_counter() - start):,.0f} rows/sec)")
+
+    if progress:
+        s = writer.get_stats()
+        elapsed = time.perf_counter() - start
+        print(f"Imported {s['committed']} of {s['rows']} reviews in {elapsed:.1f}s "
+              f"({s['committed'] / elapsed if elapsed else 0:,.0f} rows/sec), {s['groups']} commits, "
+              f"{s['failed']} rejected")
+    return writer
+
+
+if __name__ == "__main__":
+    # python writer.py reviews new_ratings.csv --errors rejected.txt
+    parser = argparse.ArgumentParser(description="group committed bulk import of reviews")
+    parser.add_argument('command', choices=['reviews'])
+    parser.add_argument('path')
+    parser.add_argument('--max-rows', type=int, default=DEFAULT_MAX_ROWS, help="rows per commit")
+    parser.add_argument('--max-delay', type=float, default=DEFAULT_MAX_DELAY, help="seconds before a partial group is committed")
+    parser.add_argument('--skip-header', action='store_true')
+    parser.add_argument('--errors', help="write rejected rows here instead of printing them")
+    args = parser.parse_args()
+
+    import connect_books as cb
+    with cb.connection() as conn:
+        result = import_reviews(conn, args.path, args.max_rows, args.max_delay, args.skip_header)
+
+    if args.errors:
+        with open(args.errors, 'w', encoding='utf-8') as f:
+            for error in result.errors:
+                f.write(f"{error.number}\t{';'.join(map(str, error.values))}\t{error.message}\n")
+    else:
+        for error in result.errors[:20]:
+            print(f"row {error.number}: {error.message}")
+        if len(result.errors) > 20:
+            print(f"... {len(result.errors) - 20} more, use --errors FILE to keep them all")